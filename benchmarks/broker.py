@@ -0,0 +1,206 @@
+"""In-process stand-in for RabbitMQ used by the benchmarks.
+
+Implements the subset of ``pika.BlockingConnection`` that the Django
+publisher and the consumer use: direct exchanges, durable queues with
+optional ``x-max-priority``, prefetch, acks/nacks and
+``add_callback_threadsafe``. There is no network or persistence, so the
+numbers it produces measure the services themselves.
+"""
+import heapq
+import itertools
+import threading
+from types import SimpleNamespace
+
+import pika
+
+
+class FakeQueue:
+    def __init__(self, name, arguments=None):
+        self.name = name
+        self.arguments = dict(arguments or {})
+        self.max_priority = self.arguments.get('x-max-priority')
+        self.messages = []
+        self.consumers = 0
+
+    def push(self, sequence, properties, body, routing_key):
+        priority = 0
+        if self.max_priority and properties is not None and properties.priority:
+            priority = min(properties.priority, self.max_priority)
+        heapq.heappush(self.messages, (-priority, sequence, properties, body, routing_key))
+
+    def pop(self):
+        return heapq.heappop(self.messages)
+
+
+class FakeBroker:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.bindings = {}
+        self.sequence = itertools.count(1)
+        self.connections = []
+
+    def connect(self, parameters=None):
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    def route(self, exchange, routing_key, properties, body):
+        with self.condition:
+            if exchange == '':
+                targets = [routing_key] if routing_key in self.queues else []
+            else:
+                targets = self.bindings.get((exchange, routing_key), [])
+            for name in targets:
+                self.queues[name].push(next(self.sequence), properties, body, routing_key)
+            self.condition.notify_all()
+
+    def depth(self):
+        with self.condition:
+            return sum(len(queue.messages) for queue in self.queues.values())
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.callbacks = []
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def add_callback_threadsafe(self, callback):
+        with self.broker.condition:
+            self.callbacks.append(callback)
+            self.broker.condition.notify_all()
+
+    def process_data_events(self, time_limit=0):
+        with self.broker.condition:
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        with self.broker.condition:
+            self.is_open = False
+            self.broker.condition.notify_all()
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.prefetch_count = 0
+        self.consumers = []
+        self.unacked = {}
+        self.delivery_tags = itertools.count(1)
+        self.consuming = False
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False, **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(NAME='Exchange.DeclareOk'))
+
+    def queue_declare(self, queue, passive=False, durable=False, exclusive=False,
+                      auto_delete=False, arguments=None):
+        with self.broker.condition:
+            if queue not in self.broker.queues:
+                if passive:
+                    self.is_open = False
+                    raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{queue}'")
+                self.broker.queues[queue] = FakeQueue(queue, arguments)
+            existing = self.broker.queues[queue]
+            if not passive and arguments is not None and dict(arguments) != existing.arguments:
+                self.is_open = False
+                raise pika.exceptions.ChannelClosedByBroker(
+                    406, f"PRECONDITION_FAILED - inequivalent arg for queue '{queue}'"
+                )
+            return SimpleNamespace(method=SimpleNamespace(
+                queue=queue,
+                message_count=len(existing.messages),
+                consumer_count=existing.consumers
+            ))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        with self.broker.condition:
+            targets = self.broker.bindings.setdefault((exchange, routing_key or queue), [])
+            if queue not in targets:
+                targets.append(queue)
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self.prefetch_count = prefetch_count
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if not self.is_open or not self.connection.is_open:
+            raise pika.exceptions.ChannelWrongStateError('Channel is closed.')
+        self.broker.route(exchange, routing_key, properties, body)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        with self.broker.condition:
+            self.broker.queues[queue].consumers += 1
+            self.consumers.append((queue, on_message_callback, auto_ack))
+        return f'ctag-{len(self.consumers)}'
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        with self.broker.condition:
+            for tag in self._settle(delivery_tag, multiple):
+                self.unacked.pop(tag)
+            self.broker.condition.notify_all()
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        with self.broker.condition:
+            for tag in self._settle(delivery_tag, multiple):
+                queue, message = self.unacked.pop(tag)
+                if requeue:
+                    heapq.heappush(queue.messages, message)
+            self.broker.condition.notify_all()
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            return [tag for tag in list(self.unacked) if tag <= delivery_tag]
+        return [delivery_tag] if delivery_tag in self.unacked else []
+
+    def _next_delivery(self):
+        if self.prefetch_count and len(self.unacked) >= self.prefetch_count:
+            return None
+        for name, callback, auto_ack in self.consumers:
+            queue = self.broker.queues[name]
+            if queue.messages:
+                message = queue.pop()
+                tag = next(self.delivery_tags)
+                if not auto_ack:
+                    self.unacked[tag] = (queue, message)
+                return callback, tag, message
+        return None
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming and self.is_open and self.connection.is_open:
+            self.connection.process_data_events()
+            with self.broker.condition:
+                delivery = self._next_delivery()
+                if delivery is None:
+                    if not self.connection.callbacks:
+                        self.broker.condition.wait(0.1)
+                    continue
+            callback, tag, (_, _, properties, body, routing_key) = delivery
+            method = SimpleNamespace(delivery_tag=tag, routing_key=routing_key, redelivered=False)
+            callback(self, method, properties, body)
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def cancel(self):
+        self.consuming = False
+
+    def close(self):
+        with self.broker.condition:
+            self.is_open = False
+            self.consuming = False
+            self.broker.condition.notify_all()
@@ -0,0 +1,283 @@
+"""End-to-end deployment benchmark.
+
+Drives ``POST /api/deployments/`` on the Django backend at a fixed rate and
+follows every accepted deployment through ``RabbitMQPublisher`` and the
+in-process broker stand-in into the consumer's deployment store. Both
+services run in this process against temporary databases, so it needs no
+RabbitMQ and no network.
+
+    python benchmarks/e2e.py --requests 2000 --rate 200 --output bench.json
+    python benchmarks/e2e.py --transport unix --output bench-unix.json
+
+``--transport unix`` replaces the broker with the Unix socket transport.
+``--live-broker`` uses a real RabbitMQ on localhost instead of the
+stand-in, which is what the Unix transport should be compared against.
+
+Requests are paced open-loop: each one has an intended start time and all
+latencies that include waiting (request, end-to-end) are measured from it,
+so a stall is not hidden by the driver slowing down with the system.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'simplismart_task'), os.path.join(ROOT, 'consumer')]
+
+from broker import FakeBroker  # noqa: E402
+
+PERCENTILES = (('p50', 0.50), ('p99', 0.99), ('p999', 0.999))
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    summary = {'count': len(ordered)}
+    for name, fraction in PERCENTILES:
+        summary[name] = round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+    summary['max'] = round(ordered[-1], 3)
+    summary['mean'] = round(sum(ordered) / len(ordered), 3)
+    return summary
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {'request': [], 'publish': [], 'queue': [], 'apply': [], 'end_to_end': []}
+        self.intended = {}
+        self.applied = {}
+        self.current = None
+
+    def add(self, kind, seconds):
+        with self.lock:
+            self.samples[kind].append(seconds * 1000)
+
+
+def setup_django(workdir, shards, transport, throttle):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'simplismart_task.settings')
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = os.path.join(workdir, 'django.sqlite3')
+    settings.DEPLOYMENT_SHARDS = shards
+    settings.DEPLOYMENT_TRANSPORT = {
+        'BACKEND': transport,
+        'SOCKET_PATH': os.path.join(workdir, 'deployments.sock'),
+    }
+    # Off by default: the benchmark measures the pipeline, and a single
+    # user at --rate would otherwise mostly see 429s.
+    settings.ALLOCATION_THROTTLE = {**settings.ALLOCATION_THROTTLE, 'ENABLED': throttle}
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+    setup_test_environment(debug=False)
+    call_command('migrate', verbosity=0)
+
+
+def setup_consumer(workdir, shards, transport):
+    os.environ['DEPLOYMENT_STORE_PATH'] = os.path.join(workdir, 'consumer.sqlite3')
+    os.environ['DEPLOYMENT_SHARDS'] = str(shards)
+    os.environ['DEPLOYMENT_TRANSPORT'] = transport
+    os.environ['DEPLOYMENT_SOCKET_PATH'] = os.path.join(workdir, 'deployments.sock')
+    os.environ.pop('CONSUMER_SHARDS', None)
+    from app import main
+    return main
+
+
+def run(args):
+    broker = FakeBroker()
+    recorder = Recorder()
+    workdir = tempfile.mkdtemp(prefix='simplismart-bench-')
+
+    if args.live_broker or args.transport == 'unix':
+        patch_broker = contextlib.nullcontext()
+    else:
+        patch_broker = mock.patch('pika.BlockingConnection', broker.connect)
+
+    with patch_broker:
+        consumer = setup_consumer(workdir, args.shards, args.transport)
+        setup_django(workdir, args.shards, args.transport, args.allocation_throttle)
+        logging.disable(logging.INFO if not args.verbose else logging.NOTSET)
+
+        from django.contrib.auth import get_user_model
+        from rest_framework.test import APIClient
+        from core.models import Cluster
+        from core.transports import deployment_publisher
+
+        def timed_publish(original):
+            def publish(deployment_data):
+                # The create serializer does not echo the id, so the request
+                # is matched to its deployment here, before it can be consumed.
+                if recorder.current is not None:
+                    with recorder.lock:
+                        recorder.intended[deployment_data['id']] = recorder.current
+                started = time.perf_counter()
+                try:
+                    return original(deployment_data)
+                finally:
+                    recorder.add('publish', time.perf_counter() - started)
+            return publish
+
+        def timed_apply(original):
+            def on_message(ch, method, properties, body):
+                started = time.time()
+                original(ch, method, properties, body)
+                finished = time.time()
+                headers = properties.headers or {}
+                deployment_id = headers.get('deployment_id')
+                with recorder.lock:
+                    if deployment_id not in recorder.intended:
+                        return
+                    intended = recorder.intended.pop(deployment_id)
+                    recorder.applied[deployment_id] = finished
+                recorder.add('queue', started - headers['published_at'])
+                recorder.add('apply', finished - started)
+                recorder.add('end_to_end', finished - intended)
+            return on_message
+
+        threads = []
+        for shard_consumer in consumer.consumers:
+            shard_consumer.on_message = timed_apply(shard_consumer.on_message)
+            if not shard_consumer.setup():
+                raise SystemExit(f"Could not start consumer for '{shard_consumer.queue}'")
+            thread = threading.Thread(target=shard_consumer.run, daemon=True)
+            thread.start()
+            threads.append(thread)
+        deployment_publisher.publish_deployment = timed_publish(deployment_publisher.publish_deployment)
+
+        user = get_user_model().objects.create_user(
+            email='bench@example.com', username='bench', password='bench'
+        )
+        clusters = [
+            Cluster.objects.create(
+                name=f'bench-{index}', owner=user,
+                total_cpu=10 ** 6, total_ram=10 ** 6, total_gpu=10 ** 6
+            )
+            for index in range(args.clusters)
+        ]
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        counts = {'sent': 0, 'accepted': 0, 'throttled': 0, 'failed': 0}
+        total = args.warmup + args.requests
+        interval = 1 / args.rate if args.rate else 0
+        measured_from = None
+        phase_started, phase_index = time.time(), 0
+        for index in range(total):
+            if index == args.warmup:
+                with recorder.lock:
+                    for samples in recorder.samples.values():
+                        samples.clear()
+                measured_from = phase_started = time.time()
+                phase_index = index
+            intended = phase_started + (index - phase_index) * interval
+            delay = intended - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if not interval:
+                intended = time.time()
+            recorder.current = intended if measured_from is not None else None
+            response = client.post('/api/deployments/', {
+                'name': f'bench-{index}',
+                'cluster': clusters[index % len(clusters)].id,
+                'docker_image': 'bench/image:latest',
+                'required_cpu': 0.01,
+                'required_ram': 0.01,
+                'required_gpu': 0,
+                'priority': args.priority,
+            }, format='json')
+            finished = time.time()
+            if measured_from is None:
+                continue
+            counts['sent'] += 1
+            recorder.add('request', finished - intended)
+            if response.status_code == 201:
+                counts['accepted'] += 1
+            elif response.status_code == 429:
+                counts['throttled'] += 1
+            else:
+                counts['failed'] += 1
+        sent_until = time.time()
+
+        deadline = time.time() + args.drain_timeout
+        while time.time() < deadline:
+            with recorder.lock:
+                if not recorder.intended:
+                    break
+            time.sleep(0.01)
+
+        with recorder.lock:
+            applied = list(recorder.applied.values())
+            lost = len(recorder.intended)
+        for shard_consumer in consumer.consumers:
+            shard_consumer.close()
+        for thread in threads:
+            thread.join(timeout=1)
+        consumer.deployment_store.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    applied_until = max(applied) if applied else sent_until
+    return {
+        'config': {
+            'transport': args.transport,
+            'live_broker': args.live_broker,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'rate': args.rate,
+            'shards': args.shards,
+            'clusters': args.clusters,
+            'priority': args.priority,
+            'allocation_throttle': args.allocation_throttle,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'requests': dict(counts, unapplied=lost),
+        'duration_s': round(applied_until - measured_from, 3),
+        'throughput_per_s': {
+            'requests': round(counts['sent'] / max(sent_until - measured_from, 1e-9), 1),
+            'applied': round(len(applied) / max(applied_until - measured_from, 1e-9), 1),
+        },
+        'latency_ms': {kind: summarize(samples) for kind, samples in recorder.samples.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='Measured deployment creations')
+    parser.add_argument('--warmup', type=int, default=100, help='Unmeasured requests sent first')
+    parser.add_argument('--rate', type=float, default=200, help='Target requests per second (0 for unpaced)')
+    parser.add_argument('--shards', type=int, default=1, help='Deployment shard queues and consumer threads')
+    parser.add_argument('--clusters', type=int, default=4, help='Clusters the deployments are spread over')
+    parser.add_argument('--transport', choices=['amqp', 'unix'], default='amqp', help='Deployment transport')
+    parser.add_argument('--live-broker', action='store_true', help='Use RabbitMQ on localhost for the amqp transport')
+    parser.add_argument('--allocation-throttle', action='store_true',
+                        help='Keep the per-user and per-cluster allocation rate limits on')
+    parser.add_argument('--priority', type=int, default=1, help='Priority of every deployment')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds to wait for the consumer to catch up')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='Keep INFO logging from both services')
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
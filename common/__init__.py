@@ -0,0 +1,6 @@
+"""Code shared by the Django backend and the consumer service.
+
+Both services put the repository root on ``sys.path`` (the Django settings
+do it, the consumer image copies this package next to ``app``), so import it
+as ``common.<module>``. Keep it free of Django and FastAPI imports.
+"""
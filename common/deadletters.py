@@ -0,0 +1,270 @@
+"""Inspecting and replaying the ``deployments.dlq`` dead-letter queue.
+
+Dead-lettered messages keep the headers the Django publisher set:
+``deployment_id`` and ``version`` (microseconds since the epoch of the
+deployment's ``updated_at``). Each service only supplies how it looks up the
+current version of a batch of deployments.
+"""
+import json
+import logging
+import math
+import time
+from collections import Counter
+
+import pika
+
+from .queues import DEAD_LETTER_QUEUE, EXCHANGE
+from .versions import parse_version
+
+logger = logging.getLogger(__name__)
+
+REPLAY_EXCHANGE = EXCHANGE
+DEFAULT_ROUTING_KEY = 'deployment'
+
+# Messages kept in the DLQ by a replay are republished to it, which drops the
+# broker's x-death header; their original reason and routing key travel in
+# these instead.
+REASON_HEADER = 'dlq-reason'
+ROUTING_KEY_HEADER = 'dlq-routing-key'
+
+# Cap on messages held unacknowledged by a dry run or an inspection: neither
+# acknowledges anything, so every message it visits stays in flight.
+MAX_UNACKED = 10000
+
+# What a version lookup reports for a deployment that no longer exists: any
+# message for it is superseded.
+GONE = math.inf
+
+def is_superseded(current, version):
+    """Whether a message at ``version`` is out of date given the ``current`` one.
+
+    Only a strictly newer version supersedes a message. A message at the
+    current version is replayed: the Django side cannot tell whether it ever
+    reached a consumer, and a consumer that did apply it drops the duplicate
+    as stale. ``current`` is ``None`` when the deployment is unknown, and
+    ``GONE`` when it has been deleted.
+    """
+    return current is not None and current > version
+
+
+class DeadLetter:
+    def __init__(self, method, properties, body):
+        self.method = method
+        self.properties = properties
+        self.body = body
+        self.headers = dict(properties.headers or {})
+        try:
+            self.data = json.loads(body)
+        except ValueError:
+            self.data = {}
+
+    @property
+    def deployment_id(self):
+        return self.headers.get('deployment_id', self.data.get('id'))
+
+    @property
+    def cluster(self):
+        return self.data.get('cluster')
+
+    @property
+    def version(self):
+        if 'version' in self.headers:
+            return int(self.headers['version'])
+        return parse_version(self.data.get('updated_at'))
+
+    @property
+    def death(self):
+        deaths = self.headers.get('x-death') or [{}]
+        return deaths[0]
+
+    @property
+    def reason(self):
+        return self.death.get('reason') or self.headers.get(REASON_HEADER, 'unknown')
+
+    @property
+    def routing_key(self):
+        routing_keys = self.death.get('routing-keys') or [self.headers.get(ROUTING_KEY_HEADER, DEFAULT_ROUTING_KEY)]
+        return routing_keys[0]
+
+
+class DeadLetterReplayer:
+    """Moves dead-lettered deployment messages back onto the live exchange.
+
+    ``connect`` returns a new ``pika.BlockingConnection``.
+    ``current_versions`` maps a set of deployment ids to their current
+    versions; see ``is_superseded`` for how they are compared.
+
+    Only the messages present when the run starts are visited. Matching
+    messages are republished unless superseded, in which case they are
+    dropped. Non-matching messages are moved to the back of the DLQ so they
+    are kept for a later run, with their dead-letter reason and routing key
+    carried over. Throughput is capped at ``rate`` messages per second and
+    each batch is acknowledged in one go once republished. A dry run visits
+    at most ``MAX_UNACKED`` messages. ``on_batch(stats, total)`` is called
+    after every batch.
+    """
+
+    def __init__(self, connect, current_versions, rate=500, batch_size=500, clusters=None,
+                 deployment_ids=None, reasons=None, limit=None, dry_run=False, on_batch=None):
+        self.connect = connect
+        self.current_versions = current_versions
+        self.rate = rate
+        self.batch_size = batch_size
+        self.clusters = set(clusters or [])
+        self.deployment_ids = set(deployment_ids or [])
+        self.reasons = set(reasons or [])
+        self.limit = limit
+        self.dry_run = dry_run
+        self.on_batch = on_batch
+        self.connection = None
+        self.channel = None
+        self.stats = Counter()
+        self.total = None
+        self.state = 'pending'
+        self.error = None
+
+    def setup_connection(self):
+        self.connection = self.connect()
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+        return self.channel.queue_declare(queue=DEAD_LETTER_QUEUE, passive=True).method.message_count
+
+    def matches(self, message):
+        if self.clusters and message.cluster not in self.clusters:
+            return False
+        if self.deployment_ids and message.deployment_id not in self.deployment_ids:
+            return False
+        if self.reasons and message.reason not in self.reasons:
+            return False
+        return True
+
+    def inspect(self, sample=1000):
+        total = self.setup_connection()
+        summary = {'total': total, 'sampled': 0, 'by_reason': Counter(), 'by_cluster': Counter()}
+        sample = min(sample, total, MAX_UNACKED)
+        try:
+            # Nothing is acknowledged, so the whole sample is in flight at once.
+            self.channel.basic_qos(prefetch_count=max(sample, 1))
+            for method, properties, body in self.channel.consume(
+                DEAD_LETTER_QUEUE, inactivity_timeout=1
+            ):
+                if method is None:
+                    break
+                message = DeadLetter(method, properties, body)
+                summary['sampled'] += 1
+                summary['by_reason'][message.reason] += 1
+                summary['by_cluster'][message.cluster] += 1
+                if summary['sampled'] >= sample:
+                    break
+        finally:
+            # Nothing was acknowledged, so closing hands every message back.
+            self.close()
+        return summary
+
+    def replay(self):
+        self.state = 'running'
+        started = time.monotonic()
+        try:
+            self.total = self.setup_connection()
+            if self.limit is not None:
+                self.total = min(self.total, self.limit)
+            if self.dry_run:
+                # A dry run never acknowledges, so every message it visits
+                # stays in flight until the connection closes and hands them
+                # all back. Bound how many that is.
+                self.total = min(self.total, MAX_UNACKED)
+                self.channel.basic_qos(prefetch_count=max(self.total, 1))
+            else:
+                self.channel.basic_qos(prefetch_count=self.batch_size)
+            while self.stats['visited'] < self.total:
+                batch = self.fetch_batch(min(self.batch_size, self.total - self.stats['visited']))
+                if not batch:
+                    break
+                self.process_batch(batch)
+                self.throttle(started)
+                if self.on_batch:
+                    self.on_batch(dict(self.stats), self.total)
+            self.state = 'finished'
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+            raise
+        finally:
+            self.close()
+            self.stats['elapsed'] = round(time.monotonic() - started, 3)
+            logger.info(f"Dead-letter replay {self.state}: {dict(self.stats)}")
+        return dict(self.stats)
+
+    def fetch_batch(self, size):
+        batch = []
+        for method, properties, body in self.channel.consume(
+            DEAD_LETTER_QUEUE, inactivity_timeout=1
+        ):
+            if method is None:
+                break
+            batch.append(DeadLetter(method, properties, body))
+            if len(batch) >= size:
+                break
+        return batch
+
+    def process_batch(self, batch):
+        wanted = [message for message in batch if self.matches(message)]
+        versions = self.current_versions({message.deployment_id for message in wanted})
+        for message in batch:
+            self.stats['visited'] += 1
+            if not self.matches(message):
+                self.stats['kept'] += 1
+                if not self.dry_run:
+                    self.publish(message, exchange='', routing_key=DEAD_LETTER_QUEUE, keep=True)
+                continue
+            if is_superseded(versions.get(message.deployment_id), message.version):
+                self.stats['superseded'] += 1
+                continue
+            self.stats['replayed'] += 1
+            if not self.dry_run:
+                self.publish(message, exchange=REPLAY_EXCHANGE, routing_key=message.routing_key)
+        if not self.dry_run:
+            self.channel.basic_ack(delivery_tag=batch[-1].method.delivery_tag, multiple=True)
+
+    def publish(self, message, exchange, routing_key, keep=False):
+        headers = {
+            key: value for key, value in message.headers.items()
+            if key not in ('x-death', REASON_HEADER, ROUTING_KEY_HEADER)
+        }
+        if keep:
+            headers[REASON_HEADER] = message.reason
+            headers[ROUTING_KEY_HEADER] = message.routing_key
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=message.body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                priority=message.properties.priority,
+                headers=headers,
+            )
+        )
+
+    def throttle(self, started):
+        if not self.rate:
+            return
+        expected = self.stats['visited'] / self.rate
+        elapsed = time.monotonic() - started
+        if expected > elapsed:
+            time.sleep(expected - elapsed)
+
+    def progress(self):
+        return {
+            'state': self.state,
+            'total': self.total,
+            'dry_run': self.dry_run,
+            'error': self.error,
+            **self.stats
+        }
+
+    def close(self):
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.error(f"Error closing dead-letter connection: {str(e)}")
@@ -0,0 +1,44 @@
+"""Length-prefixed JSON frames for the Unix socket transport.
+
+Each frame is a 4-byte big-endian payload length followed by the payload,
+one JSON document. Django writes deployments and stats requests with
+``encode_frame``; the consumer reads them with ``read_frame`` and answers
+stats requests the same way.
+"""
+import json
+import struct
+
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(message) -> bytes:
+    payload = json.dumps(message).encode()
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def read_exactly(sock, size):
+    """Read ``size`` bytes, or ``None`` if the peer closed before sending any."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if not data:
+                return None
+            raise ConnectionError("Socket closed mid-frame")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def read_frame(sock):
+    """Read one frame, or ``None`` if the peer closed between frames."""
+    header = read_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    payload = read_exactly(sock, size)
+    if payload is None:
+        raise ConnectionError("Socket closed mid-frame")
+    return json.loads(payload)
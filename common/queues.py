@@ -0,0 +1,77 @@
+"""The deployment queue topology both services declare and route to.
+
+Django publishes to the shard queue ``shard_for_cluster`` picks and the
+consumer declares and consumes the same queues, so the sharding, names and
+queue arguments live here once; if the two sides disagreed, messages would
+be routed to queues nobody consumes.
+
+RabbitMQ cannot change a queue's arguments in place. Redeclaring a queue
+with different ones fails with ``406 PRECONDITION_FAILED``, for example:
+``inequivalent arg 'x-max-priority' for queue 'deployments' in vhost '/'``.
+"""
+import re
+import zlib
+
+import pika
+
+EXCHANGE = 'deployments'
+DEAD_LETTER_EXCHANGE = 'deployments.dlx'
+DEAD_LETTER_QUEUE = 'deployments.dlq'
+STATUS_QUEUE = 'deployments.status'
+STATUS_ROUTING_KEY = 'status'
+MAX_PRIORITY = 3
+QUEUE_ARGUMENTS = {
+    'x-message-ttl': 60000,
+    'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE,
+    'x-max-priority': MAX_PRIORITY
+}
+
+
+def shard_for_cluster(cluster_id, shards):
+    if shards <= 1:
+        return 0
+    return zlib.crc32(str(cluster_id).encode()) % shards
+
+
+def shard_queue(shard):
+    # Shard 0 keeps the original names so a single-shard setup is unchanged.
+    return 'deployments' if shard == 0 else f'deployments.{shard}'
+
+
+def shard_routing_key(shard):
+    return 'deployment' if shard == 0 else f'deployment.{shard}'
+
+
+def get_connection_parameters():
+    return pika.ConnectionParameters(
+        host='localhost',
+        port=5672,
+        virtual_host='/',
+        credentials=pika.PlainCredentials('guest', 'guest'),
+        connection_attempts=5,
+        retry_delay=1,
+        socket_timeout=5,
+        heartbeat=60,
+        blocked_connection_timeout=30
+    )
+
+
+INEQUIVALENT_ARGUMENT = re.compile(r"inequivalent arg '([^']+)'")
+
+
+def incompatible_argument(reply_text):
+    """Name of the argument a 406 reply complains about, or ``None``."""
+    match = INEQUIVALENT_ARGUMENT.search(reply_text or '')
+    return match.group(1) if match else None
+
+
+def incompatible_declaration(kind, name, reply_text):
+    """Warning for reusing ``name`` after a 406, naming what is missing."""
+    argument = incompatible_argument(reply_text)
+    if argument is None:
+        return f"{kind.capitalize()} '{name}' exists with incompatible settings, reusing it: {reply_text}"
+    hint = ' (manage.py migrate_queues)' if kind == 'queue' else ''
+    return (
+        f"{kind.capitalize()} '{name}' exists without the current '{argument}' argument and is "
+        f"reused as it is, so '{argument}' has no effect on it until it is recreated{hint}: {reply_text}"
+    )
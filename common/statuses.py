@@ -0,0 +1,18 @@
+"""Deployment status transitions, enforced by both services.
+
+``stopped`` and ``failed`` are final, so a late ``running`` report cannot
+bring back a deployment that has since been stopped.
+"""
+
+STATUSES = ('pending', 'running', 'stopped', 'failed')
+
+TRANSITIONS = {
+    'pending': {'running', 'stopped', 'failed'},
+    'running': {'stopped', 'failed'},
+    'stopped': set(),
+    'failed': set(),
+}
+
+
+def can_transition(current, status):
+    return status in TRANSITIONS.get(current, ())
@@ -0,0 +1,18 @@
+"""W3C trace context, as Django propagates it to the consumers.
+
+Django starts a trace per request and sends its ``traceparent`` with each
+deployment message; the consumer continues the trace from it. Both write
+spans in the same JSON-lines format for ``manage.py trace_report``.
+"""
+
+
+def parse_traceparent(value):
+    """Parse a W3C ``traceparent`` into ``(trace_id, span_id, sampled)``."""
+    try:
+        version, trace_id, span_id, flags = value.strip().split('-')
+        sampled = bool(int(flags, 16) & 1)
+        if len(trace_id) != 32 or len(span_id) != 16 or not int(trace_id, 16) or not int(span_id, 16):
+            return None
+    except (AttributeError, ValueError):
+        return None
+    return trace_id, span_id, sampled
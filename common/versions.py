@@ -0,0 +1,33 @@
+"""Deployment versions, shared by the publisher, the consumers and the DLQ.
+
+A deployment's version is its ``updated_at`` in microseconds since the
+epoch. Django stamps it on every message as the ``version`` header; a
+consumer only applies a message that is strictly newer than what it holds.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_datetime(value) -> Optional[datetime]:
+    """``value`` (a datetime or ISO 8601 string) as an aware UTC datetime, or ``None``."""
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def parse_timestamp(value) -> float:
+    value = to_datetime(value)
+    return 0.0 if value is None else value.timestamp()
+
+
+def parse_version(value) -> int:
+    """Version for ``updated_at`` ``value``; 0 if it is missing or malformed."""
+    value = to_datetime(value)
+    return 0 if value is None else (value - EPOCH) // timedelta(microseconds=1)
@@ -0,0 +1,38 @@
+import logging
+import threading
+
+from common.deadletters import DeadLetterReplayer
+
+logger = logging.getLogger(__name__)
+
+
+def applied_versions(store):
+    """Version lookup for ``DeadLetterReplayer``: what this consumer has applied.
+
+    Deployments it has never seen are left out, so their messages replay.
+    """
+    def lookup(deployment_ids):
+        versions = {deployment_id: store.get_version(deployment_id) for deployment_id in deployment_ids}
+        return {deployment_id: version for deployment_id, version in versions.items() if version is not None}
+    return lookup
+
+
+class ReplayManager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+
+    def start(self, replayer: DeadLetterReplayer) -> bool:
+        with self.lock:
+            if self.current is not None and self.current.state in ('pending', 'running'):
+                return False
+            self.current = replayer
+        threading.Thread(target=self.run, args=(replayer,), name='dlq-replay', daemon=True).start()
+        return True
+
+    def run(self, replayer: DeadLetterReplayer) -> None:
+        # Failures are reported through GET /dlq/replay.
+        try:
+            replayer.replay()
+        except Exception as e:
+            logger.error(f"Dead-letter replay failed: {str(e)}")
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import logging
+from typing import Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, clusters: Optional[Set[int]], deployment_ids: Optional[Set[int]],
+                 buffer_size: int):
+        self.clusters = clusters
+        self.deployment_ids = deployment_ids
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def matches(self, deployment) -> bool:
+        if self.clusters and deployment.cluster not in self.clusters:
+            return False
+        if self.deployment_ids and deployment.id not in self.deployment_ids:
+            return False
+        return True
+
+    def offer(self, event) -> None:
+        # Slow subscribers lose their oldest buffered events rather than
+        # holding memory or back-pressuring the consumer thread.
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class DeploymentBroadcaster:
+    """Fans applied deployments out to streaming subscribers.
+
+    ``publish`` is called from the RabbitMQ consumer thread and hands the
+    event over to the event loop, where each matching subscriber gets it in
+    its own bounded buffer.
+    """
+
+    def __init__(self, buffer_size: int = 100):
+        self.buffer_size = buffer_size
+        self.subscriptions: Set[Subscription] = set()
+        self.loop = None
+
+    def bind(self, loop) -> None:
+        self.loop = loop
+
+    def subscribe(self, clusters=None, deployment_ids=None) -> Subscription:
+        subscription = Subscription(
+            set(clusters) if clusters else None,
+            set(deployment_ids) if deployment_ids else None,
+            self.buffer_size
+        )
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriptions.discard(subscription)
+        if subscription.dropped:
+            logger.info(f"Stream subscriber dropped {subscription.dropped} events")
+
+    def publish(self, deployment, version: int) -> None:
+        if self.loop is None or not self.subscriptions:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._dispatch, deployment, version)
+        except RuntimeError:
+            logger.warning("Event loop closed, dropping deployment event")
+
+    def _dispatch(self, deployment, version: int) -> None:
+        event = None
+        for subscription in list(self.subscriptions):
+            if not subscription.matches(deployment):
+                continue
+            if event is None:
+                event = format_event(deployment, version)
+            subscription.offer(event)
+
+
+def format_event(deployment, version: int) -> str:
+    data = json.dumps(jsonable_encoder(deployment))
+    return f"id: {version}\nevent: deployment\ndata: {data}\n\n"
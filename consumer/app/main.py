@@ -1,14 +1,31 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import pika
 import json
 import asyncio
-from typing import Dict, Any
+from datetime import datetime, timezone
+from typing import List, Optional
 import logging
+import os
 import signal
 import sys
+import threading
 import time
 
+from common.deadletters import DeadLetterReplayer
+from common.queues import STATUS_ROUTING_KEY, get_connection_parameters
+from common.statuses import STATUSES, can_transition
+from common.versions import parse_version
+
+from .dlq import ReplayManager, applied_versions
+from .events import DeploymentBroadcaster, format_event
+from .metrics import PriorityLatencyTracker
+from .rabbitmq import ShardConsumer
+from .store import SQLiteDeploymentStore
+from .tracing import SpanExporter
+from .unix import UnixSocketConsumer
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -23,153 +40,155 @@ class Deployment(BaseModel):
     required_ram: float
     required_gpu: float
     status: str
+    priority: int = 1
     created_at: str
     updated_at: str
 
+class StatusUpdate(BaseModel):
+    status: str
+
+class ReplayRequest(BaseModel):
+    rate: float = 500
+    batch_size: int = 500
+    limit: Optional[int] = None
+    clusters: Optional[List[int]] = None
+    deployment_ids: Optional[List[int]] = None
+    reasons: Optional[List[str]] = None
+    dry_run: bool = False
+
+
+deployment_store = SQLiteDeploymentStore(
+    Deployment,
+    path=os.environ.get('DEPLOYMENT_STORE_PATH', 'deployments.db'),
+    cache_size=int(os.environ.get('DEPLOYMENT_CACHE_SIZE', '10000'))
+)
+
+broadcaster = DeploymentBroadcaster(
+    buffer_size=int(os.environ.get('STREAM_BUFFER_SIZE', '100'))
+)
+STREAM_KEEPALIVE_SECONDS = 15
+
+replay_manager = ReplayManager()
+
+# Updated from every shard's consumer thread.
+consumer_stats = {"applied": 0, "skipped": 0}
+consumer_stats_lock = threading.Lock()
 
-received_deployments: Dict[int, Deployment] = {}
+def count(outcome):
+    with consumer_stats_lock:
+        consumer_stats[outcome] += 1
 
-connection = None
-channel = None
-is_consuming = False
+latency_tracker = PriorityLatencyTracker(
+    window=int(os.environ.get('LATENCY_WINDOW', '1000'))
+)
+
+span_exporter = SpanExporter(os.environ.get('TRACE_EXPORT_PATH'))
+
+DEPLOYMENT_SHARDS = int(os.environ.get('DEPLOYMENT_SHARDS', '1'))
+CONSUMER_SHARDS = [
+    int(shard) for shard in os.environ.get('CONSUMER_SHARDS', '').split(',') if shard.strip()
+] or list(range(DEPLOYMENT_SHARDS))
+
+def message_version(properties):
+    headers = (properties.headers if properties else None) or {}
+    deployment_id = headers.get('deployment_id')
+    version = headers.get('version')
+    if deployment_id is None or version is None:
+        return None, None
+    return int(deployment_id), int(version)
+
+def message_published_at(properties):
+    headers = (properties.headers if properties else None) or {}
+    published_at = headers.get('published_at')
+    return float(published_at) if published_at is not None else None
 
 def process_deployment(ch, method, properties, body):
+    started = time.time()
+    outcome = "error"
     try:
+        outcome = process_message(ch, method, properties, body)
+    finally:
+        published_at = message_published_at(properties)
+        latency_tracker.record(
+            (properties.priority if properties else None) or 0,
+            published_at,
+            started
+        )
+        if span_exporter.enabled:
+            trace_message(method, properties, published_at, started, outcome)
+
+def trace_message(method, properties, published_at, started, outcome):
+    headers = (properties.headers if properties else None) or {}
+    traceparent = headers.get('traceparent')
+    if not traceparent:
+        return
+    deployment_id = headers.get('deployment_id')
+    if published_at is not None:
+        span_exporter.record("broker.queue", traceparent, published_at, started, deployment_id=deployment_id)
+    span_exporter.record(
+        "deployment.process", traceparent, started, time.time(),
+        deployment_id=deployment_id, outcome=outcome,
+        redelivered=getattr(method, 'redelivered', None)
+    )
+
+def process_message(ch, method, properties, body):
+    try:
+        deployment_id, version = message_version(properties)
+        if deployment_id is not None:
+            current = deployment_store.get_version(deployment_id)
+            if current is not None and version <= current:
+                count("skipped")
+                logger.info(f"Skipped stale deployment {deployment_id} (version {version} <= {current})")
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return "stale"
+
         deployment_data = json.loads(body)
         deployment = Deployment(**deployment_data)
-        received_deployments[deployment.id] = deployment
-        logger.info(f"Processed deployment: {deployment.name}")
+        if version is None:
+            version = parse_version(deployment.updated_at)
+        if deployment_store.put(deployment, version):
+            count("applied")
+            broadcaster.publish(deployment, version)
+            logger.info(f"Processed deployment: {deployment.name}")
+            outcome = "applied"
+        else:
+            count("skipped")
+            logger.info(f"Skipped stale deployment {deployment.id} (version {version})")
+            outcome = "stale"
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        return outcome
     except Exception as e:
         logger.error(f"Error processing deployment: {str(e)}")
         ch.basic_nack(delivery_tag=method.delivery_tag)
+        return "error"
 
-def setup_rabbitmq():
-    global connection, channel, is_consuming
-    max_retries = 5
-    retry_delay = 2
-    
-    for attempt in range(max_retries):
-        try:
-            if connection and connection.is_open:
-                connection.close()
-            
-            credentials = pika.PlainCredentials('guest', 'guest')
-            parameters = pika.ConnectionParameters(
-                host='localhost',
-                port=5672,
-                virtual_host='/',
-                credentials=credentials,
-                connection_attempts=5,
-                retry_delay=1,
-                socket_timeout=5,
-                heartbeat=60,
-                blocked_connection_timeout=30
-            )
-            
-            connection = pika.BlockingConnection(parameters)
-            channel = connection.channel()
-            
-            try:
-                channel.exchange_delete(exchange='deployments')
-                logger.info("Deleted existing exchange 'deployments'")
-            except pika.exceptions.ChannelClosedByBroker:
-                logger.info("Exchange 'deployments' does not exist or could not be deleted")
-            
-            channel = connection.channel()
-            
-            channel.exchange_declare(
-                exchange='deployments',
-                exchange_type='direct',
-                durable=True
-            )
-            
-            try:
-                channel.queue_delete(queue='deployments')
-                logger.info("Deleted existing queue 'deployments'")
-            except pika.exceptions.ChannelClosedByBroker:
-                logger.info("Queue 'deployments' does not exist or could not be deleted")
-            
-            channel = connection.channel()
-            
-            channel.queue_declare(
-                queue='deployments',
-                durable=True,
-                arguments={
-                    'x-message-ttl': 60000,
-                    'x-dead-letter-exchange': 'deployments.dlx'
-                }
-            )
-            
-            channel.exchange_declare(
-                exchange='deployments.dlx',
-                exchange_type='direct',
-                durable=True
-            )
-            
-            channel.queue_declare(
-                queue='deployments.dlq',
-                durable=True
-            )
-            
-            channel.queue_bind(
-                exchange='deployments.dlx',
-                queue='deployments.dlq',
-                routing_key='deployment'
-            )
-            
-            channel.queue_bind(
-                exchange='deployments',
-                queue='deployments',
-                routing_key='deployment'
-            )
-            
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(
-                queue='deployments',
-                on_message_callback=process_deployment,
-                auto_ack=False
-            )
-            
-            is_consuming = True
-            logger.info("RabbitMQ connection established successfully")
+DEPLOYMENT_TRANSPORT = os.environ.get('DEPLOYMENT_TRANSPORT', 'amqp')
+
+if DEPLOYMENT_TRANSPORT == 'unix':
+    consumers = [UnixSocketConsumer(
+        os.environ.get('DEPLOYMENT_SOCKET_PATH', '/tmp/simplismart-deployments.sock'),
+        DEPLOYMENT_SHARDS,
+        process_deployment
+    )]
+else:
+    consumers = [ShardConsumer(shard, process_deployment) for shard in CONSUMER_SHARDS]
+
+def publish_status(deployment_id, status, previous_status):
+    body = json.dumps({
+        "id": deployment_id,
+        "status": status,
+        "previous_status": previous_status,
+        "reported_at": datetime.now(timezone.utc).isoformat()
+    })
+    properties = pika.BasicProperties(delivery_mode=2)
+    for consumer in consumers:
+        if consumer.publish_threadsafe(STATUS_ROUTING_KEY, body, properties):
             return True
-        except pika.exceptions.AMQPConnectionError as e:
-            logger.error(f"Failed to connect to RabbitMQ (attempt {attempt + 1}/{max_retries}): {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-            else:
-                logger.error("Max retries reached. Could not establish RabbitMQ connection.")
-                return False
-        except Exception as e:
-            logger.error(f"Unexpected error during RabbitMQ setup: {str(e)}")
-            return False
+    return False
 
 def close_rabbitmq():
-    global connection, channel, is_consuming
-    try:
-        is_consuming = False
-        if channel and channel.is_open:
-            try:
-                channel.close()
-            except pika.exceptions.ConnectionWrongStateError:
-                logger.warning("Channel was already closed")
-            except Exception as e:
-                logger.error(f"Error closing channel: {str(e)}")
-        
-        if connection and connection.is_open:
-            try:
-                connection.close()
-            except pika.exceptions.ConnectionWrongStateError:
-                logger.warning("Connection was already closed")
-            except Exception as e:
-                logger.error(f"Error closing connection: {str(e)}")
-        
-        connection = None
-        channel = None
-        logger.info("RabbitMQ connection closed")
-    except Exception as e:
-        logger.error(f"Error in close_rabbitmq: {str(e)}")
+    for consumer in consumers:
+        consumer.close()
 
 def signal_handler(sig, frame):
     logger.info("Shutting down...")
@@ -184,10 +203,13 @@ def signal_handler(sig, frame):
 async def startup_event():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    if setup_rabbitmq():
-        asyncio.create_task(run_consumer())
-    else:
-        logger.error("Failed to start RabbitMQ consumer")
+    loop = asyncio.get_running_loop()
+    broadcaster.bind(loop)
+    for consumer in consumers:
+        if consumer.setup():
+            threading.Thread(target=consumer.run, name=f"consumer-{consumer.queue}", daemon=True).start()
+        else:
+            logger.error(f"Failed to start RabbitMQ consumer for '{consumer.queue}'")
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -195,53 +217,144 @@ async def shutdown_event():
         close_rabbitmq()
     except Exception as e:
         logger.error(f"Error during shutdown event: {str(e)}")
+    deployment_store.close()
+
+@app.get("/deployments/", response_model=list[Deployment])
+async def get_deployments(
+    response: Response,
+    cluster: Optional[int] = None,
+    status: Optional[str] = None,
+    docker_image: Optional[str] = None,
+    updated_after: Optional[datetime] = None,
+    updated_before: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    try:
+        deployments, next_cursor = deployment_store.query(
+            cluster=cluster,
+            status=status,
+            docker_image=docker_image,
+            updated_after=updated_after,
+            updated_before=updated_before,
+            limit=limit,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return deployments
+
+@app.get("/deployments/stream")
+async def stream_deployments(
+    request: Request,
+    cluster: Optional[List[int]] = Query(None),
+    deployment_id: Optional[List[int]] = Query(None)
+):
+    subscription = broadcaster.subscribe(clusters=cluster, deployment_ids=deployment_id)
 
-async def run_consumer():
-    global is_consuming, connection, channel
-    while is_consuming:
+    async def events():
         try:
-            if not connection or not connection.is_open:
-                logger.warning("RabbitMQ connection lost. Attempting to reconnect...")
-                if not setup_rabbitmq():
-                    logger.error("Failed to reconnect to RabbitMQ")
-                    break
-            
-            try:
-                channel.start_consuming()
-            except pika.exceptions.ConnectionClosedByBroker:
-                logger.error("Connection closed by broker. Attempting to reconnect...")
-                time.sleep(2)
-                continue
-            except pika.exceptions.AMQPChannelError as err:
-                logger.error(f"Channel error: {str(err)}. Attempting to reconnect...")
-                time.sleep(2)
-                continue
-            except pika.exceptions.AMQPConnectionError:
-                logger.error("Connection error. Attempting to reconnect...")
-                time.sleep(2)
-                continue
-            except pika.exceptions.ConnectionWrongStateError:
-                logger.warning("Connection in wrong state. Attempting to reconnect...")
-                close_rabbitmq()
-                time.sleep(2)
-                continue
-        except Exception as e:
-            logger.error(f"Consumer error: {str(e)}")
-            break
+            for snapshot_id in deployment_id or []:
+                deployment = deployment_store.get(snapshot_id)
+                if deployment is not None and subscription.matches(deployment):
+                    yield format_event(deployment, deployment_store.get_version(snapshot_id))
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(subscription.queue.get(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
 
-@app.get("/deployments/", response_model=list[Deployment])
-async def get_deployments():
-    return list(received_deployments.values())
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/deployments/{deployment_id}", response_model=Deployment)
 async def get_deployment(deployment_id: int):
-    if deployment_id not in received_deployments:
+    deployment = deployment_store.get(deployment_id)
+    if deployment is None:
+        raise HTTPException(status_code=404, detail="Deployment not found")
+    return deployment
+
+@app.post("/deployments/{deployment_id}/status", status_code=202)
+async def report_status(deployment_id: int, update: StatusUpdate):
+    if update.status not in STATUSES:
+        raise HTTPException(status_code=400, detail=f"Unknown status '{update.status}'")
+    current = deployment_store.get(deployment_id)
+    if current is None:
         raise HTTPException(status_code=404, detail="Deployment not found")
-    return received_deployments[deployment_id]
+    if current.status == update.status:
+        return {"id": deployment_id, "status": update.status, "changed": False}
+    if not can_transition(current.status, update.status):
+        raise HTTPException(status_code=409, detail=f"Cannot move a {current.status} deployment to {update.status}")
+    # Applied locally first, so a report that loses a race with a newer
+    # delivery is never published. Django checks the same transition rules
+    # before applying it.
+    deployment = deployment_store.set_status(deployment_id, update.status, expected_status=current.status)
+    if deployment is None:
+        raise HTTPException(status_code=409, detail="Deployment changed while reporting its status")
+    if not publish_status(deployment_id, update.status, current.status):
+        deployment_store.set_status(deployment_id, current.status, expected_status=update.status)
+        raise HTTPException(status_code=503, detail="RabbitMQ connection unavailable")
+    broadcaster.publish(deployment, deployment_store.get_version(deployment_id))
+    return {"id": deployment_id, "status": update.status, "changed": True}
+
+def dead_letter_replayer(**options):
+    return DeadLetterReplayer(
+        connect=lambda: pika.BlockingConnection(get_connection_parameters()),
+        current_versions=applied_versions(deployment_store),
+        **options
+    )
+
+@app.get("/dlq")
+async def inspect_dlq(sample: int = Query(100, ge=1, le=10000)):
+    replayer = dead_letter_replayer()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, replayer.inspect, sample)
+    except pika.exceptions.AMQPError as e:
+        raise HTTPException(status_code=503, detail=f"Could not inspect dead-letter queue: {str(e)}")
+
+@app.post("/dlq/replay", status_code=202)
+async def replay_dlq(request: ReplayRequest):
+    replayer = dead_letter_replayer(
+        rate=request.rate,
+        batch_size=request.batch_size,
+        limit=request.limit,
+        clusters=request.clusters,
+        deployment_ids=request.deployment_ids,
+        reasons=request.reasons,
+        dry_run=request.dry_run
+    )
+    if not replay_manager.start(replayer):
+        raise HTTPException(status_code=409, detail="A replay is already running")
+    return replayer.progress()
+
+@app.get("/dlq/replay")
+async def replay_progress():
+    if replay_manager.current is None:
+        raise HTTPException(status_code=404, detail="No replay has been started")
+    return replay_manager.current.progress()
+
+@app.get("/metrics/latency")
+async def latency_metrics():
+    return latency_tracker.summary()
 
 @app.get("/health")
 async def health_check():
     return {
         "status": "healthy",
-        "rabbitmq_connected": connection.is_open if connection else False
+        "transport": DEPLOYMENT_TRANSPORT,
+        "rabbitmq_connected": all(consumer.is_connected for consumer in consumers),
+        "store": deployment_store.stats(),
+        "consumer": dict(consumer_stats),
+        "shards": {
+            consumer.queue: {"connected": consumer.is_connected, **consumer.stats}
+            for consumer in consumers
+        },
+        "stream_subscribers": len(broadcaster.subscriptions)
     } 
\ No newline at end of file
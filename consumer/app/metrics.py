@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+
+def percentile(ordered, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LatencyWindow:
+    def __init__(self, size: int):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "p50": round(percentile(ordered, 0.50), 2),
+            "p90": round(percentile(ordered, 0.90), 2),
+            "p99": round(percentile(ordered, 0.99), 2),
+            "max": round(ordered[-1], 2) if ordered else 0.0,
+        }
+
+
+class PriorityLatencyTracker:
+    """Keeps the most recent latency samples (in ms) per message priority.
+
+    ``queue_ms`` is how long a message waited between being published by
+    Django and reaching the consumer; ``process_ms`` is the time spent
+    applying it. Percentiles are computed over the last ``window`` samples of
+    each priority, so memory stays bounded however long the consumer runs.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.queue_ms = defaultdict(lambda: LatencyWindow(self.window))
+        self.process_ms = defaultdict(lambda: LatencyWindow(self.window))
+
+    def record(self, priority: int, published_at: Optional[float], started: float) -> None:
+        finished = time.time()
+        with self.lock:
+            if published_at is not None:
+                self.queue_ms[priority].add(max(0.0, (started - published_at) * 1000))
+            self.process_ms[priority].add((finished - started) * 1000)
+
+    def summary(self) -> dict:
+        with self.lock:
+            priorities = sorted(set(self.queue_ms) | set(self.process_ms), reverse=True)
+            return {
+                str(priority): {
+                    "queue_ms": self.queue_ms[priority].summary(),
+                    "process_ms": self.process_ms[priority].summary(),
+                }
+                for priority in priorities
+            }
@@ -0,0 +1,199 @@
+import logging
+import time
+
+import pika
+
+from common.queues import (
+    DEAD_LETTER_EXCHANGE,
+    DEAD_LETTER_QUEUE,
+    EXCHANGE,
+    QUEUE_ARGUMENTS,
+    STATUS_QUEUE,
+    STATUS_ROUTING_KEY,
+    get_connection_parameters,
+    incompatible_declaration,
+    shard_queue,
+    shard_routing_key,
+)
+
+from .transport import DeploymentTransport
+
+logger = logging.getLogger(__name__)
+
+
+def declare(connection, channel, kind, name, **kwargs):
+    # Declarations are idempotent when the existing entity matches. If it was
+    # created with different settings the broker answers PRECONDITION_FAILED
+    # and closes the channel; reuse the existing entity rather than deleting
+    # it and its backlog.
+    try:
+        return channel, getattr(channel, f'{kind}_declare')(name, durable=True, **kwargs)
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code != 406:
+            raise
+        logger.warning(incompatible_declaration(kind, name, e.reply_text))
+        channel = connection.channel()
+        return channel, getattr(channel, f'{kind}_declare')(name, passive=True)
+
+
+def declare_topology(connection, channel, shard):
+    queue = shard_queue(shard)
+    routing_key = shard_routing_key(shard)
+    channel, _ = declare(connection, channel, 'exchange', EXCHANGE, exchange_type='direct')
+    channel, _ = declare(connection, channel, 'exchange', DEAD_LETTER_EXCHANGE, exchange_type='direct')
+    channel, _ = declare(connection, channel, 'queue', DEAD_LETTER_QUEUE)
+    channel, _ = declare(connection, channel, 'queue', STATUS_QUEUE)
+    channel, result = declare(connection, channel, 'queue', queue, arguments=QUEUE_ARGUMENTS)
+    channel.queue_bind(
+        exchange=DEAD_LETTER_EXCHANGE,
+        queue=DEAD_LETTER_QUEUE,
+        routing_key=routing_key
+    )
+    channel.queue_bind(
+        exchange=EXCHANGE,
+        queue=STATUS_QUEUE,
+        routing_key=STATUS_ROUTING_KEY
+    )
+    channel.queue_bind(
+        exchange=EXCHANGE,
+        queue=queue,
+        routing_key=routing_key
+    )
+    return channel, result.method.message_count
+
+
+class ShardConsumer(DeploymentTransport):
+    """Consumes one deployment shard queue on its own connection and thread.
+
+    Messages for a cluster always hash to the same shard, and each shard is
+    consumed with ``prefetch_count=1``, so per-cluster order is preserved
+    while shards are processed in parallel. Keeping a single message in
+    flight also lets the broker hand over the highest-priority message
+    waiting each time, so urgent deployments skip the backlog.
+    """
+
+    def __init__(self, shard, on_message):
+        super().__init__()
+        self.shard = shard
+        self.queue = shard_queue(shard)
+        self.on_message = on_message
+        self.connection = None
+        self.channel = None
+        self.is_consuming = False
+
+    @property
+    def is_connected(self):
+        return bool(self.connection and self.connection.is_open)
+
+    def setup(self):
+        max_retries = 5
+        retry_delay = 2
+
+        for attempt in range(max_retries):
+            try:
+                if self.connection and self.connection.is_open:
+                    self.connection.close()
+
+                started = time.perf_counter()
+                self.connection = pika.BlockingConnection(get_connection_parameters())
+                self.channel = self.connection.channel()
+                self.channel, backlog = declare_topology(self.connection, self.channel, self.shard)
+
+                self.channel.basic_qos(prefetch_count=1)
+                self.channel.basic_consume(
+                    queue=self.queue,
+                    on_message_callback=self.on_message,
+                    auto_ack=False
+                )
+
+                self.is_consuming = True
+                self.stats["setup_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                self.stats["backlog"] = backlog
+                logger.info(
+                    f"RabbitMQ connection for '{self.queue}' established successfully in "
+                    f"{self.stats['setup_ms']} ms ({backlog} queued messages retained)"
+                )
+                return True
+            except pika.exceptions.AMQPConnectionError as e:
+                logger.error(f"Failed to connect to RabbitMQ (attempt {attempt + 1}/{max_retries}): {str(e)}")
+                if attempt < max_retries - 1:
+                    time.sleep(retry_delay)
+                else:
+                    logger.error("Max retries reached. Could not establish RabbitMQ connection.")
+                    return False
+            except Exception as e:
+                logger.error(f"Unexpected error during RabbitMQ setup: {str(e)}")
+                return False
+
+    def run(self):
+        while self.is_consuming:
+            try:
+                if not self.connection or not self.connection.is_open:
+                    logger.warning(f"RabbitMQ connection for '{self.queue}' lost. Attempting to reconnect...")
+                    if not self.setup():
+                        logger.error("Failed to reconnect to RabbitMQ")
+                        break
+
+                try:
+                    self.channel.start_consuming()
+                except pika.exceptions.ConnectionClosedByBroker:
+                    logger.error("Connection closed by broker. Attempting to reconnect...")
+                    time.sleep(2)
+                    continue
+                except pika.exceptions.AMQPChannelError as err:
+                    logger.error(f"Channel error: {str(err)}. Attempting to reconnect...")
+                    time.sleep(2)
+                    continue
+                except pika.exceptions.AMQPConnectionError:
+                    logger.error("Connection error. Attempting to reconnect...")
+                    time.sleep(2)
+                    continue
+                except pika.exceptions.ConnectionWrongStateError:
+                    logger.warning("Connection in wrong state. Attempting to reconnect...")
+                    self.close()
+                    time.sleep(2)
+                    continue
+            except Exception as e:
+                logger.error(f"Consumer error: {str(e)}")
+                break
+
+    def publish_threadsafe(self, routing_key, body, properties):
+        # The pika connection belongs to the consumer thread; hand the publish
+        # over to it instead of touching the channel from another thread.
+        if not self.is_connected:
+            return False
+        channel = self.channel
+        self.connection.add_callback_threadsafe(
+            lambda: channel.basic_publish(
+                exchange=EXCHANGE,
+                routing_key=routing_key,
+                body=body,
+                properties=properties
+            )
+        )
+        return True
+
+    def close(self):
+        try:
+            self.is_consuming = False
+            if self.channel and self.channel.is_open:
+                try:
+                    self.channel.close()
+                except pika.exceptions.ConnectionWrongStateError:
+                    logger.warning("Channel was already closed")
+                except Exception as e:
+                    logger.error(f"Error closing channel: {str(e)}")
+
+            if self.connection and self.connection.is_open:
+                try:
+                    self.connection.close()
+                except pika.exceptions.ConnectionWrongStateError:
+                    logger.warning("Connection was already closed")
+                except Exception as e:
+                    logger.error(f"Error closing connection: {str(e)}")
+
+            self.connection = None
+            self.channel = None
+            logger.info(f"RabbitMQ connection for '{self.queue}' closed")
+        except Exception as e:
+            logger.error(f"Error in close: {str(e)}")
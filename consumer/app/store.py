@@ -0,0 +1,301 @@
+import base64
+import json
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from common.versions import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+class DeploymentStore(ABC):
+    @abstractmethod
+    def get(self, deployment_id: int):
+        ...
+
+    @abstractmethod
+    def get_version(self, deployment_id: int) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def put(self, deployment, version: int = 0) -> bool:
+        ...
+
+    @abstractmethod
+    def set_status(self, deployment_id: int, status: str, expected_status: Optional[str] = None):
+        ...
+
+    @abstractmethod
+    def values(self) -> Iterator:
+        ...
+
+    @abstractmethod
+    def query(self, cluster: Optional[int] = None, status: Optional[str] = None,
+              docker_image: Optional[str] = None, updated_after: Optional[datetime] = None,
+              updated_before: Optional[datetime] = None, limit: int = 100,
+              cursor: Optional[str] = None) -> Tuple[List, Optional[str]]:
+        ...
+
+    def __contains__(self, deployment_id: int) -> bool:
+        return self.get(deployment_id) is not None
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value) -> None:
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def encode_cursor(updated_ts: float, deployment_id: int) -> str:
+    raw = json.dumps([updated_ts, deployment_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        updated_ts, deployment_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(updated_ts), int(deployment_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+class SQLiteDeploymentStore(DeploymentStore):
+    """Deployments persisted in SQLite, fronted by an in-memory LRU tier.
+
+    Writes go straight to disk; reads are served from the LRU tier and fall
+    through to SQLite on a miss. Pass ``path=':memory:'`` for a non-durable
+    store (tests, throwaway runs).
+
+    ``cluster``, ``status``, ``docker_image`` and ``updated_at`` are copied
+    into indexed columns on every write so filtered listings walk an index
+    ordered by ``(updated_ts, id)`` instead of scanning every deployment.
+
+    Every row carries the version it was written at; ``put`` only replaces a
+    row with a strictly newer version, so stale or duplicate deliveries are
+    no-ops no matter which consumer applies them first.
+    """
+
+    def __init__(self, model, path: str = 'deployments.db', cache_size: int = 10000,
+                 batch_size: int = 500):
+        self.model = model
+        self.path = path
+        self.batch_size = batch_size
+        self.cache = LRUCache(cache_size)
+        self.versions = LRUCache(cache_size)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS deployments ('
+            'id INTEGER PRIMARY KEY, '
+            'data TEXT NOT NULL, '
+            'cluster INTEGER, '
+            'status TEXT, '
+            'docker_image TEXT, '
+            'updated_ts REAL, '
+            'version INTEGER NOT NULL DEFAULT 0)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS deployments_updated ON deployments (updated_ts, id)')
+        for column in ('cluster', 'status', 'docker_image'):
+            self.db.execute(
+                f'CREATE INDEX IF NOT EXISTS deployments_{column} '
+                f'ON deployments ({column}, updated_ts, id)'
+            )
+        logger.info(f"Deployment store opened at {path} (cache size {cache_size})")
+
+    def _decode(self, raw: str):
+        return self.model(**json.loads(raw))
+
+    def get(self, deployment_id: int):
+        with self.lock:
+            deployment = self.cache.get(deployment_id)
+            if deployment is not None:
+                return deployment
+            row = self.db.execute(
+                'SELECT data FROM deployments WHERE id = ?', (deployment_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            deployment = self._decode(row[0])
+            self.cache.put(deployment_id, deployment)
+            return deployment
+
+    def get_version(self, deployment_id: int) -> Optional[int]:
+        with self.lock:
+            version = self.versions.get(deployment_id)
+            if version is not None:
+                return version
+            row = self.db.execute(
+                'SELECT version FROM deployments WHERE id = ?', (deployment_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.versions.put(deployment_id, row[0])
+            return row[0]
+
+    def put(self, deployment, version: int = 0) -> bool:
+        raw = json.dumps(jsonable_encoder(deployment))
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT INTO deployments (id, data, cluster, status, docker_image, updated_ts, version) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET data = excluded.data, cluster = excluded.cluster, '
+                'status = excluded.status, docker_image = excluded.docker_image, '
+                'updated_ts = excluded.updated_ts, version = excluded.version '
+                'WHERE excluded.version > deployments.version',
+                (deployment.id, raw, deployment.cluster, deployment.status,
+                 deployment.docker_image, parse_timestamp(deployment.updated_at), version)
+            )
+            if cursor.rowcount == 0:
+                return False
+            self.cache.put(deployment.id, deployment)
+            self.versions.put(deployment.id, version)
+            return True
+
+    def set_status(self, deployment_id: int, status: str, expected_status: Optional[str] = None):
+        """Change the stored deployment's status, keeping its version.
+
+        The read and the write happen under the lock, and the write only
+        applies to the version that was read, so a newer ``put`` is never
+        overwritten. With ``expected_status`` nothing changes unless the
+        stored status still is that. Returns the updated deployment, or
+        ``None`` when it is missing or has changed.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data, version FROM deployments WHERE id = ?', (deployment_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            raw, version = row
+            deployment = self.cache.get(deployment_id)
+            if deployment is None:
+                deployment = self._decode(raw)
+            if expected_status is not None and deployment.status != expected_status:
+                return None
+            updated = self.model(**{**jsonable_encoder(deployment), 'status': status})
+            cursor = self.db.execute(
+                'UPDATE deployments SET data = ?, status = ? WHERE id = ? AND version = ?',
+                (json.dumps(jsonable_encoder(updated)), status, deployment_id, version)
+            )
+            if cursor.rowcount == 0:
+                return None
+            self.cache.put(deployment_id, updated)
+            return updated
+
+    def values(self) -> Iterator:
+        last_id = None
+        while True:
+            with self.lock:
+                if last_id is None:
+                    rows = self.db.execute(
+                        'SELECT id, data FROM deployments ORDER BY id LIMIT ?',
+                        (self.batch_size,)
+                    ).fetchall()
+                else:
+                    rows = self.db.execute(
+                        'SELECT id, data FROM deployments WHERE id > ? ORDER BY id LIMIT ?',
+                        (last_id, self.batch_size)
+                    ).fetchall()
+                batch = []
+                for deployment_id, raw in rows:
+                    deployment = self.cache.entries.get(deployment_id)
+                    batch.append(deployment if deployment is not None else self._decode(raw))
+            yield from batch
+            if len(rows) < self.batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def query(self, cluster=None, status=None, docker_image=None, updated_after=None,
+              updated_before=None, limit=100, cursor=None):
+        clauses = []
+        params = []
+        for column, value in (('cluster', cluster), ('status', status), ('docker_image', docker_image)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        if updated_after is not None:
+            clauses.append('updated_ts >= ?')
+            params.append(parse_timestamp(updated_after))
+        if updated_before is not None:
+            clauses.append('updated_ts < ?')
+            params.append(parse_timestamp(updated_before))
+        if cursor:
+            clauses.append('(updated_ts, id) < (?, ?)')
+            params.extend(decode_cursor(cursor))
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ''
+        sql = f'SELECT id, data, updated_ts FROM deployments {where}ORDER BY updated_ts DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+            deployments = []
+            for deployment_id, raw, _ in rows[:limit]:
+                deployment = self.cache.entries.get(deployment_id)
+                deployments.append(deployment if deployment is not None else self._decode(raw))
+        next_cursor = None
+        if len(rows) > limit:
+            last_id, _, last_ts = rows[limit - 1]
+            next_cursor = encode_cursor(last_ts, last_id)
+        return deployments, next_cursor
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM deployments').fetchone()[0]
+
+    def stats(self) -> dict:
+        return {
+            'path': self.path,
+            'cached': len(self.cache),
+            'cache_size': self.cache.max_size,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'cache_evictions': self.cache.evictions,
+            'cached_versions': len(self.versions),
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+        logger.info("Deployment store closed")
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+from common.tracing import parse_traceparent
+
+logger = logging.getLogger(__name__)
+
+
+class SpanExporter:
+    """Continues traces started in Django and appends the spans to a file.
+
+    Spans use the same JSON-lines format as the Django exporter, so both
+    files can be combined with ``manage.py trace_report``.
+    """
+
+    def __init__(self, path: Optional[str], service: str = 'consumer'):
+        self.path = path
+        self.service = service
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, name, traceparent, start, end, **attributes) -> Optional[str]:
+        if not self.enabled:
+            return None
+        parent = parse_traceparent(traceparent)
+        if parent is None or not parent[2]:
+            return None
+        trace_id, parent_id, _ = parent
+        span_id = os.urandom(8).hex()
+        line = json.dumps({
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent_id,
+            "name": name,
+            "service": self.service,
+            "start": start,
+            "end": end,
+            "duration_ms": round((end - start) * 1000, 3),
+            "attributes": attributes,
+            "events": [],
+        }, default=str) + "\n"
+        try:
+            with self.lock, open(self.path, "a") as f:
+                f.write(line)
+        except OSError as e:
+            logger.error(f"Failed to export span: {str(e)}")
+        return span_id
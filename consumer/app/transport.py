@@ -0,0 +1,36 @@
+from abc import ABC, abstractmethod
+
+
+class DeploymentTransport(ABC):
+    """What ``main`` needs from a source of deployment messages.
+
+    ``setup`` connects (or binds) and returns whether it succeeded, ``run``
+    blocks delivering messages to ``on_message(ch, method, properties,
+    body)`` with pika's callback signature, and ``close`` stops it.
+    """
+
+    queue = None
+
+    def __init__(self):
+        self.stats = {"setup_ms": None, "backlog": None}
+
+    @property
+    @abstractmethod
+    def is_connected(self) -> bool:
+        ...
+
+    @abstractmethod
+    def setup(self) -> bool:
+        ...
+
+    @abstractmethod
+    def run(self) -> None:
+        ...
+
+    @abstractmethod
+    def publish_threadsafe(self, routing_key, body, properties) -> bool:
+        ...
+
+    @abstractmethod
+    def close(self) -> None:
+        ...
@@ -0,0 +1,234 @@
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+
+import pika
+
+from common.frames import encode_frame, read_frame
+from common.queues import EXCHANGE, QUEUE_ARGUMENTS, shard_queue, shard_routing_key
+
+from .transport import DeploymentTransport
+
+logger = logging.getLogger(__name__)
+
+# Backoff before a nacked message is retried: doubles per attempt up to the cap.
+RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 5.0
+
+
+class LocalChannel:
+    """Stands in for the pika channel handed to ``on_message``."""
+
+    def __init__(self):
+        self.outcome = None
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.outcome = 'ack'
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.outcome = 'requeue' if requeue else 'reject'
+
+
+class LocalShard:
+    # Mirrors a shard queue: highest priority first, FIFO within a priority,
+    # one message in flight, and nacked messages retried until they expire.
+    # Unlike a broker requeue, a retry waits out an exponential backoff so a
+    # message that keeps failing neither spins nor holds up the rest.
+
+    def __init__(self, shard, owner, ttl, retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY):
+        self.shard = shard
+        self.queue = shard_queue(shard)
+        self.owner = owner
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.messages = []
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.delivery_tags = itertools.count(1)
+        self.condition = threading.Condition()
+        self.running = False
+        self.expired = 0
+        self.retried = 0
+
+    def __len__(self):
+        return len(self.messages) + len(self.delayed)
+
+    def put(self, message, received_at):
+        priority = min(int(message.get('priority') or 0), QUEUE_ARGUMENTS['x-max-priority'])
+        with self.condition:
+            heapq.heappush(self.messages, (-priority, next(self.sequence), received_at, message, 0))
+            self.condition.notify()
+
+    def next_message(self):
+        # Called with the condition held. Waits until a message is ready,
+        # moving retries whose backoff has passed back into the queue.
+        while self.running:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                heapq.heappush(self.messages, heapq.heappop(self.delayed)[2])
+            if self.messages:
+                return heapq.heappop(self.messages)
+            self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                entry = self.next_message()
+            if entry is None:
+                return
+            priority, sequence, received_at, message, attempts = entry
+            if time.monotonic() - received_at > self.ttl:
+                self.expired += 1
+                logger.warning(f"Dropping expired message for deployment {message['headers'].get('deployment_id')}")
+                continue
+            channel = LocalChannel()
+            method = pika.spec.Basic.Deliver(
+                delivery_tag=next(self.delivery_tags),
+                redelivered=attempts > 0,
+                exchange=EXCHANGE,
+                routing_key=message['routing_key']
+            )
+            properties = pika.BasicProperties(
+                delivery_mode=2,
+                priority=message.get('priority'),
+                headers=message.get('headers') or {}
+            )
+            self.owner.on_message(channel, method, properties, message['body'].encode())
+            if channel.outcome == 'requeue':
+                self.retried += 1
+                delay = min(self.retry_delay * 2 ** attempts, self.max_retry_delay)
+                with self.condition:
+                    heapq.heappush(self.delayed, (
+                        time.monotonic() + delay, sequence,
+                        (priority, sequence, received_at, message, attempts + 1)
+                    ))
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.work, name=f"consumer-{self.queue}", daemon=True).start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+class UnixSocketConsumer(DeploymentTransport):
+    """Receives deployments from Django over a Unix domain socket.
+
+    For single-box installs where Django and the consumer share a host, this
+    skips the broker entirely. Django writes length-prefixed JSON frames
+    carrying the same routing key, priority and headers it would publish to
+    RabbitMQ, and each shard is applied in order on its own thread exactly
+    as ``ShardConsumer`` would. Messages live only in memory, so anything
+    queued is lost if the consumer stops; status feedback and the dead-letter
+    queue still need the AMQP transport.
+    """
+
+    def __init__(self, path, shards, on_message, ttl=None):
+        super().__init__()
+        self.path = path
+        self.queue = f"unix:{path}"
+        self.on_message = on_message
+        ttl = ttl if ttl is not None else QUEUE_ARGUMENTS['x-message-ttl'] / 1000
+        self.shards = {
+            shard_routing_key(shard): LocalShard(shard, self, ttl)
+            for shard in range(max(shards, 1))
+        }
+        self.server = None
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def is_connected(self) -> bool:
+        return self.server is not None
+
+    def setup(self) -> bool:
+        started = time.perf_counter()
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.path)
+            self.server.listen()
+        except OSError as e:
+            logger.error(f"Failed to listen on {self.path}: {str(e)}")
+            self.server = None
+            return False
+        for shard in self.shards.values():
+            shard.start()
+        self.stats["setup_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self.stats["backlog"] = 0
+        logger.info(f"Listening for deployments on {self.path} ({len(self.shards)} shards)")
+        return True
+
+    def run(self) -> None:
+        while self.server is not None:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                break
+            with self.lock:
+                self.connections.add(connection)
+            threading.Thread(target=self.serve, args=(connection,), name="consumer-unix-client", daemon=True).start()
+
+    def serve(self, connection):
+        try:
+            while True:
+                message = read_frame(connection)
+                if message is None:
+                    break
+                if message.get('type') == 'stats':
+                    connection.sendall(encode_frame(self.queue_stats()))
+                    continue
+                shard = self.shards.get(message.get('routing_key'))
+                if shard is None:
+                    logger.warning(f"Dropping message for unknown routing key {message.get('routing_key')!r}")
+                    continue
+                shard.put(message, time.monotonic())
+        except (OSError, ValueError) as e:
+            logger.error(f"Unix transport client error: {str(e)}")
+        finally:
+            with self.lock:
+                self.connections.discard(connection)
+            connection.close()
+
+    def queue_stats(self):
+        consumers = 1 if self.is_connected else 0
+        return {
+            "shards": [
+                {"depth": len(shard), "consumers": consumers}
+                for shard in self.shards.values()
+            ]
+        }
+
+    def publish_threadsafe(self, routing_key, body, properties) -> bool:
+        # Nothing on the Django side listens on the socket for status updates.
+        return False
+
+    def close(self) -> None:
+        server, self.server = self.server, None
+        if server is not None:
+            try:
+                # Wakes the thread blocked in accept().
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        for shard in self.shards.values():
+            shard.stop()
+        logger.info(f"Unix transport on {self.path} closed")
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# The `common` package shared with Django sits next to this project in a
+# checkout; the image copies it next to `app` instead.
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+# Importing app.main opens its store; keep test runs from writing deployments.db.
+os.environ.setdefault('DEPLOYMENT_STORE_PATH', ':memory:')
@@ -0,0 +1,28 @@
+from pydantic import BaseModel
+
+from common.versions import parse_version
+
+
+class Deployment(BaseModel):
+    id: int
+    name: str
+    cluster: int
+    docker_image: str
+    status: str
+    updated_at: str
+
+
+def make_deployment(deployment_id, updated_at='2024-01-01T00:00:00+00:00', cluster=1,
+                    status='pending', docker_image='nginx:latest'):
+    return Deployment(
+        id=deployment_id,
+        name=f'deployment-{deployment_id}',
+        cluster=cluster,
+        docker_image=docker_image,
+        status=status,
+        updated_at=updated_at,
+    )
+
+
+def version_of(deployment):
+    return parse_version(deployment.updated_at)
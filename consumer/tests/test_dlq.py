@@ -0,0 +1,87 @@
+import json
+import unittest
+from unittest.mock import MagicMock
+
+import pika
+from fastapi.encoders import jsonable_encoder
+
+from app.dlq import applied_versions
+from app.store import SQLiteDeploymentStore
+from common.deadletters import DEAD_LETTER_QUEUE, REPLAY_EXCHANGE, DeadLetter, DeadLetterReplayer
+
+from .helpers import Deployment, make_deployment, version_of
+
+
+def dead_letter(delivery_tag, deployment, version, reason='expired'):
+    method = MagicMock(delivery_tag=delivery_tag)
+    properties = pika.BasicProperties(
+        priority=1,
+        headers={
+            'deployment_id': deployment.id,
+            'version': version,
+            'x-death': [{'reason': reason, 'routing-keys': ['deployment.1']}],
+        },
+    )
+    return DeadLetter(method, properties, json.dumps(jsonable_encoder(deployment)))
+
+
+class TestDeadLetterReplay(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteDeploymentStore(Deployment, path=':memory:')
+        self.applied = make_deployment(1, '2024-01-02T00:00:00+00:00')
+        self.store.put(self.applied, version_of(self.applied))
+
+    def tearDown(self):
+        self.store.close()
+
+    def replayer(self, **options):
+        replayer = DeadLetterReplayer(
+            connect=MagicMock(), current_versions=applied_versions(self.store), **options
+        )
+        replayer.channel = MagicMock()
+        return replayer
+
+    def test_applied_versions_omits_unknown_deployments(self):
+        lookup = applied_versions(self.store)
+        self.assertEqual(lookup({1, 2}), {1: version_of(self.applied)})
+
+    def test_replays_all_but_superseded_messages(self):
+        replayer = self.replayer()
+        batch = [
+            dead_letter(1, self.applied, version_of(self.applied) - 1),
+            dead_letter(2, self.applied, version_of(self.applied)),
+            dead_letter(3, make_deployment(2), 1),
+        ]
+
+        replayer.process_batch(batch)
+
+        self.assertEqual(replayer.stats['visited'], 3)
+        self.assertEqual(replayer.stats['superseded'], 1)
+        self.assertEqual(replayer.stats['replayed'], 2)
+        published = replayer.channel.basic_publish.call_args_list
+        self.assertEqual([call.kwargs['exchange'] for call in published], [REPLAY_EXCHANGE] * 2)
+        self.assertEqual([call.kwargs['routing_key'] for call in published], ['deployment.1'] * 2)
+        self.assertNotIn('x-death', published[0].kwargs['properties'].headers)
+        replayer.channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+    def test_keeps_messages_outside_the_filter(self):
+        replayer = self.replayer(reasons=['rejected'])
+
+        replayer.process_batch([dead_letter(1, make_deployment(2), 1)])
+
+        self.assertEqual(replayer.stats['kept'], 1)
+        call = replayer.channel.basic_publish.call_args
+        self.assertEqual((call.kwargs['exchange'], call.kwargs['routing_key']), ('', DEAD_LETTER_QUEUE))
+
+    def test_dry_run_publishes_nothing(self):
+        replayer = self.replayer(dry_run=True)
+
+        replayer.process_batch([dead_letter(1, make_deployment(2), 1)])
+
+        self.assertEqual(replayer.stats['replayed'], 1)
+        replayer.channel.basic_publish.assert_not_called()
+        replayer.channel.basic_ack.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
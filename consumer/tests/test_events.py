@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+
+from app.events import DeploymentBroadcaster
+
+from .helpers import make_deployment, version_of
+
+
+class TestDeploymentBroadcaster(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.broadcaster = DeploymentBroadcaster(buffer_size=2)
+        self.broadcaster.bind(asyncio.get_running_loop())
+
+    async def publish(self, deployment):
+        self.broadcaster.publish(deployment, version_of(deployment))
+        # publish hands over with call_soon_threadsafe; let the loop run it.
+        await asyncio.sleep(0)
+
+    async def test_subscribers_get_matching_events(self):
+        everything = self.broadcaster.subscribe()
+        cluster_two = self.broadcaster.subscribe(clusters=[2])
+        one_deployment = self.broadcaster.subscribe(deployment_ids=[1])
+
+        deployment = make_deployment(1, cluster=1)
+        await self.publish(deployment)
+
+        event = everything.queue.get_nowait()
+        self.assertTrue(event.startswith(f'id: {version_of(deployment)}\nevent: deployment\n'))
+        self.assertIn('"deployment-1"', event)
+        self.assertEqual(one_deployment.queue.get_nowait(), event)
+        self.assertTrue(cluster_two.queue.empty())
+
+    async def test_slow_subscribers_drop_oldest_events(self):
+        subscription = self.broadcaster.subscribe()
+
+        for deployment_id in range(1, 4):
+            await self.publish(make_deployment(deployment_id))
+
+        self.assertEqual(subscription.dropped, 1)
+        self.assertIn('"deployment-2"', subscription.queue.get_nowait())
+        self.assertIn('"deployment-3"', subscription.queue.get_nowait())
+
+    async def test_unsubscribed_get_nothing(self):
+        subscription = self.broadcaster.subscribe()
+        self.broadcaster.unsubscribe(subscription)
+
+        await self.publish(make_deployment(1))
+
+        self.assertTrue(subscription.queue.empty())
+
+    async def test_publish_from_another_thread(self):
+        subscription = self.broadcaster.subscribe()
+        deployment = make_deployment(1)
+
+        await asyncio.to_thread(self.broadcaster.publish, deployment, version_of(deployment))
+
+        event = await asyncio.wait_for(subscription.queue.get(), timeout=1)
+        self.assertIn('"deployment-1"', event)
+
+
+if __name__ == '__main__':
+    unittest.main()
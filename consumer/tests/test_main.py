@@ -0,0 +1,176 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from fastapi.testclient import TestClient
+
+from app import main
+from app.events import DeploymentBroadcaster
+from app.store import SQLiteDeploymentStore
+
+from .helpers import Deployment, make_deployment, version_of
+
+
+class TestReportStatus(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteDeploymentStore(Deployment, path=':memory:')
+        self.addCleanup(self.store.close)
+        patcher = patch.object(main, 'deployment_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(main.app)
+        deployment = make_deployment(1)
+        self.store.put(deployment, version_of(deployment))
+
+    def report(self, status):
+        return self.client.post('/deployments/1/status', json={'status': status})
+
+    @patch('app.main.publish_status')
+    def test_applies_before_publishing(self, mock_publish):
+        mock_publish.side_effect = lambda *args: self.store.get(1).status == 'running'
+
+        response = self.report('running')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {'id': 1, 'status': 'running', 'changed': True})
+        mock_publish.assert_called_once_with(1, 'running', 'pending')
+
+    @patch('app.main.publish_status', return_value=False)
+    def test_failed_publish_reverts(self, mock_publish):
+        self.assertEqual(self.report('running').status_code, 503)
+        self.assertEqual(self.store.get(1).status, 'pending')
+
+    @patch('app.main.publish_status', return_value=True)
+    def test_lost_race_is_not_published(self, mock_publish):
+        real_set_status = self.store.set_status
+
+        def racing(deployment_id, status, expected_status=None):
+            # A newer delivery moves the deployment on before the report lands.
+            real_set_status(deployment_id, 'stopped')
+            return real_set_status(deployment_id, status, expected_status=expected_status)
+
+        with patch.object(self.store, 'set_status', racing):
+            self.assertEqual(self.report('running').status_code, 409)
+        mock_publish.assert_not_called()
+        self.assertEqual(self.store.get(1).status, 'stopped')
+
+    @patch('app.main.publish_status', return_value=True)
+    def test_final_statuses_cannot_be_left(self, mock_publish):
+        self.assertEqual(self.report('stopped').status_code, 202)
+        self.assertEqual(self.report('running').status_code, 409)
+        self.assertEqual(self.report('bogus').status_code, 400)
+        self.assertEqual(self.client.post('/deployments/2/status', json={'status': 'running'}).status_code, 404)
+
+
+
+class TestProcessMessage(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteDeploymentStore(main.Deployment, path=':memory:')
+        self.addCleanup(self.store.close)
+        for target, value in (('deployment_store', self.store), ('consumer_stats', {'applied': 0, 'skipped': 0})):
+            patcher = patch.object(main, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def body(self, deployment_id):
+        return json.dumps({
+            'id': deployment_id, 'name': f'deployment-{deployment_id}', 'cluster': 1,
+            'docker_image': 'nginx:latest', 'required_cpu': 1, 'required_ram': 1, 'required_gpu': 0,
+            'status': 'pending', 'created_at': '2024-01-01T00:00:00+00:00',
+            'updated_at': '2024-01-01T00:00:00+00:00',
+        })
+
+    def test_counts_from_concurrent_shards(self):
+        channel = MagicMock()
+
+        def consume(offset):
+            # Each shard's thread delivers its deployments twice.
+            for _ in range(2):
+                for deployment_id in range(offset, offset + 50):
+                    main.process_message(channel, MagicMock(), None, self.body(deployment_id))
+
+        threads = [threading.Thread(target=consume, args=(offset,)) for offset in (0, 50, 100, 150)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(main.consumer_stats, {'applied': 200, 'skipped': 200})
+        self.assertEqual(channel.basic_ack.call_count, 400)
+        self.assertEqual(len(self.store), 200)
+
+
+class StreamRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+class TestDeploymentStream(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = SQLiteDeploymentStore(Deployment, path=':memory:')
+        self.addCleanup(self.store.close)
+        self.broadcaster = DeploymentBroadcaster()
+        self.broadcaster.bind(asyncio.get_running_loop())
+        for target, value in (('deployment_store', self.store), ('broadcaster', self.broadcaster)):
+            patcher = patch.object(main, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for deployment in (make_deployment(1, cluster=1), make_deployment(2, cluster=2)):
+            self.store.put(deployment, version_of(deployment))
+        self.request = StreamRequest()
+
+    async def stream(self, **filters):
+        response = await main.stream_deployments(self.request, **filters)
+        self.assertEqual(response.media_type, 'text/event-stream')
+        return response.body_iterator
+
+    def publish(self, deployment):
+        self.broadcaster.publish(deployment, version_of(deployment))
+
+    async def test_snapshot_then_matching_updates(self):
+        events = await self.stream(cluster=[1], deployment_id=[1, 2, 3])
+
+        # Only the requested deployments that pass the cluster filter.
+        snapshot = await anext(events)
+        self.assertTrue(snapshot.startswith(f'id: {version_of(make_deployment(1))}\n'))
+        self.assertIn('"deployment-1"', snapshot)
+
+        self.publish(make_deployment(2, '2024-01-02T00:00:00+00:00', cluster=2, status='running'))
+        self.publish(make_deployment(4, '2024-01-02T00:00:00+00:00', cluster=1, status='running'))
+        self.publish(make_deployment(1, '2024-01-02T00:00:00+00:00', cluster=1, status='running'))
+        update = await asyncio.wait_for(anext(events), 1)
+        self.assertIn('"deployment-1"', update)
+        self.assertIn('"running"', update)
+        await events.aclose()
+
+    async def test_keepalive_while_idle(self):
+        with patch.object(main, 'STREAM_KEEPALIVE_SECONDS', 0.01):
+            events = await self.stream(cluster=None, deployment_id=None)
+            self.assertEqual(await anext(events), ': keepalive\n\n')
+        await events.aclose()
+
+    async def test_unsubscribes_on_disconnect(self):
+        events = await self.stream(cluster=None, deployment_id=[1])
+        await anext(events)
+        self.assertEqual(len(self.broadcaster.subscriptions), 1)
+
+        self.request.disconnected = True
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
+        self.assertEqual(self.broadcaster.subscriptions, set())
+
+    async def test_unsubscribes_when_the_response_is_closed(self):
+        events = await self.stream(cluster=None, deployment_id=[1])
+        await anext(events)
+
+        await events.aclose()
+        self.assertEqual(self.broadcaster.subscriptions, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
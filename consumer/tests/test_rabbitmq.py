@@ -0,0 +1,128 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pika
+
+from app.rabbitmq import ShardConsumer
+from common.queues import EXCHANGE, QUEUE_ARGUMENTS, shard_for_cluster, shard_queue, shard_routing_key
+
+
+def broker(backlog=0):
+    connection = MagicMock()
+    channel = connection.channel.return_value
+    channel.queue_declare.return_value.method.message_count = backlog
+    return connection, channel
+
+
+@patch('app.rabbitmq.time.sleep')
+@patch('app.rabbitmq.pika.BlockingConnection')
+class TestShardConsumer(unittest.TestCase):
+    def test_consumes_its_own_shard_queue(self, mock_connection, mock_sleep):
+        connection, channel = broker(backlog=7)
+        mock_connection.return_value = connection
+        on_message = MagicMock()
+        consumer = ShardConsumer(2, on_message)
+
+        self.assertTrue(consumer.setup())
+
+        queue_declare = channel.queue_declare.call_args_list[-1]
+        self.assertEqual(queue_declare.args[0], 'deployments.2')
+        self.assertEqual(queue_declare.kwargs['arguments'], QUEUE_ARGUMENTS)
+        channel.queue_bind.assert_any_call(exchange=EXCHANGE, queue='deployments.2', routing_key='deployment.2')
+        channel.basic_qos.assert_called_once_with(prefetch_count=1)
+        channel.basic_consume.assert_called_once_with(
+            queue='deployments.2', on_message_callback=on_message, auto_ack=False
+        )
+        self.assertEqual(consumer.stats['backlog'], 7)
+        self.assertTrue(consumer.is_connected)
+
+    def test_every_cluster_lands_on_a_consumed_queue(self, mock_connection, mock_sleep):
+        # Django routes with shard_for_cluster + shard_routing_key; each
+        # routing key must be bound to the queue its ShardConsumer reads.
+        bound = {}
+        for shard in range(4):
+            connection, channel = broker()
+            mock_connection.return_value = connection
+            consumer = ShardConsumer(shard, MagicMock())
+            consumer.setup()
+            for call in channel.queue_bind.call_args_list:
+                if call.kwargs['exchange'] == EXCHANGE and call.kwargs['queue'] == consumer.queue:
+                    bound[call.kwargs['routing_key']] = consumer.queue
+
+        for cluster_id in range(100):
+            shard = shard_for_cluster(cluster_id, 4)
+            self.assertEqual(bound[shard_routing_key(shard)], shard_queue(shard))
+
+    def test_setup_retries_until_the_broker_answers(self, mock_connection, mock_sleep):
+        connection, _ = broker()
+        mock_connection.side_effect = [pika.exceptions.AMQPConnectionError('down'), connection]
+
+        self.assertTrue(ShardConsumer(0, MagicMock()).setup())
+        self.assertEqual(mock_connection.call_count, 2)
+        mock_sleep.assert_called_once()
+
+    def test_setup_gives_up_after_max_retries(self, mock_connection, mock_sleep):
+        mock_connection.side_effect = pika.exceptions.AMQPConnectionError('down')
+
+        self.assertFalse(ShardConsumer(0, MagicMock()).setup())
+        self.assertEqual(mock_connection.call_count, 5)
+
+    def test_publish_threadsafe_runs_on_the_consumer_thread(self, mock_connection, mock_sleep):
+        connection, channel = broker()
+        mock_connection.return_value = connection
+        consumer = ShardConsumer(0, MagicMock())
+
+        self.assertFalse(consumer.publish_threadsafe('status', b'{}', None))
+        consumer.setup()
+        self.assertTrue(consumer.publish_threadsafe('status', b'{}', None))
+
+        channel.basic_publish.assert_not_called()
+        callback = connection.add_callback_threadsafe.call_args.args[0]
+        callback()
+        channel.basic_publish.assert_called_once_with(
+            exchange=EXCHANGE, routing_key='status', body=b'{}', properties=None
+        )
+
+
+    def test_reuses_queue_declared_with_other_arguments(self, mock_connection, mock_sleep):
+        connection = MagicMock()
+        first, second = MagicMock(), MagicMock()
+        connection.channel.side_effect = [first, second]
+        mock_connection.return_value = connection
+
+        def declare_queue(name, **kwargs):
+            if kwargs.get('arguments'):
+                raise pika.exceptions.ChannelClosedByBroker(
+                    406, "PRECONDITION_FAILED - inequivalent arg 'x-max-priority' for queue "
+                         "'deployments.1' in vhost '/': received '3' but current is none"
+                )
+            return MagicMock()
+
+        first.queue_declare.side_effect = declare_queue
+        second.queue_declare.return_value.method.message_count = 12
+        consumer = ShardConsumer(1, MagicMock())
+
+        with self.assertLogs('app.rabbitmq', 'WARNING') as logs:
+            self.assertTrue(consumer.setup())
+
+        self.assertIn('x-max-priority', logs.output[0])
+        second.queue_declare.assert_called_once_with('deployments.1', passive=True)
+        second.queue_bind.assert_any_call(exchange=EXCHANGE, queue='deployments.1', routing_key='deployment.1')
+        second.basic_consume.assert_called_once()
+        self.assertIs(consumer.channel, second)
+        self.assertEqual(consumer.stats['backlog'], 12)
+        for channel in (first, second):
+            channel.queue_delete.assert_not_called()
+            channel.exchange_delete.assert_not_called()
+
+    def test_other_declaration_errors_are_not_swallowed(self, mock_connection, mock_sleep):
+        connection, channel = broker()
+        channel.queue_declare.side_effect = pika.exceptions.ChannelClosedByBroker(403, 'ACCESS_REFUSED')
+        mock_connection.return_value = connection
+
+        self.assertFalse(ShardConsumer(0, MagicMock()).setup())
+        channel.queue_declare.assert_called_with('deployments.dlq', durable=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import json
+import threading
+import unittest
+
+from fastapi.encoders import jsonable_encoder
+
+from app.store import LRUCache, SQLiteDeploymentStore, decode_cursor
+
+from .helpers import Deployment, make_deployment, version_of
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_zero_size_caches_nothing(self):
+        cache = LRUCache(0)
+        cache.put(1, 'a')
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get(1))
+
+
+class TestSQLiteDeploymentStore(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteDeploymentStore(Deployment, path=':memory:', cache_size=2, batch_size=2)
+
+    def tearDown(self):
+        self.store.close()
+
+    def put(self, deployment):
+        return self.store.put(deployment, version_of(deployment))
+
+    def test_put_only_applies_newer_versions(self):
+        newer = make_deployment(1, '2024-01-02T00:00:00+00:00', status='running')
+        older = make_deployment(1, '2024-01-01T00:00:00+00:00', status='pending')
+
+        self.assertTrue(self.put(newer))
+        self.assertFalse(self.put(older))
+        self.assertFalse(self.put(newer))
+
+        self.assertEqual(self.store.get(1).status, 'running')
+        self.assertEqual(self.store.get_version(1), version_of(newer))
+        self.assertEqual(len(self.store), 1)
+
+    def test_reads_fall_through_to_sqlite_after_eviction(self):
+        for deployment_id in range(1, 4):
+            self.put(make_deployment(deployment_id))
+
+        self.assertEqual(len(self.store.cache), 2)
+        self.assertEqual(self.store.cache.evictions, 1)
+        self.assertEqual(self.store.get(1).name, 'deployment-1')
+        self.assertIn(1, self.store.cache.entries)
+        self.assertEqual(sorted(d.id for d in self.store.values()), [1, 2, 3])
+
+    def test_query_paginates_newest_first(self):
+        for deployment_id in range(1, 6):
+            # Two deployments per timestamp, so the cursor has to break ties on id.
+            self.put(make_deployment(deployment_id, f'2024-01-0{(deployment_id + 1) // 2}T00:00:00+00:00'))
+
+        pages = []
+        cursor = None
+        while True:
+            deployments, cursor = self.store.query(limit=2, cursor=cursor)
+            pages.append([deployment.id for deployment in deployments])
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, [[5, 4], [3, 2], [1]])
+
+    def test_query_filters(self):
+        self.put(make_deployment(1, '2024-01-01T00:00:00+00:00', cluster=1))
+        self.put(make_deployment(2, '2024-01-02T00:00:00+00:00', cluster=2, status='running'))
+        self.put(make_deployment(3, '2024-01-03T00:00:00+00:00', cluster=2))
+
+        deployments, cursor = self.store.query(cluster=2)
+        self.assertEqual([d.id for d in deployments], [3, 2])
+        self.assertIsNone(cursor)
+
+        deployments, _ = self.store.query(cluster=2, status='pending')
+        self.assertEqual([d.id for d in deployments], [3])
+
+        deployments, _ = self.store.query(updated_after='2024-01-02T00:00:00Z',
+                                          updated_before='2024-01-03T00:00:00Z')
+        self.assertEqual([d.id for d in deployments], [2])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_set_status_keeps_version(self):
+        deployment = make_deployment(1)
+        self.put(deployment)
+
+        updated = self.store.set_status(1, 'running')
+
+        self.assertEqual(updated.status, 'running')
+        self.assertEqual(self.store.get(1).status, 'running')
+        self.assertEqual(self.store.query(status='running')[0], [updated])
+        self.assertEqual(self.store.get_version(1), version_of(deployment))
+
+    def test_set_status_checks_expected_status(self):
+        self.put(make_deployment(1))
+
+        self.assertIsNone(self.store.set_status(1, 'failed', expected_status='running'))
+        self.assertIsNone(self.store.set_status(2, 'running'))
+        self.assertEqual(self.store.get(1).status, 'pending')
+
+    def test_set_status_does_not_overwrite_newer_put(self):
+        self.put(make_deployment(1))
+        newer = make_deployment(1, '2024-01-02T00:00:00+00:00', docker_image='nginx:1.25')
+        real_execute = self.store.db.execute
+        store = self.store
+
+        class Racing:
+            # Lands a newer put between set_status's read and its write, as a
+            # consumer thread could if the two were not under one lock.
+            def execute(self, sql, *args):
+                if sql.startswith('UPDATE deployments SET data'):
+                    real_execute(
+                        'UPDATE deployments SET data = ?, version = ? WHERE id = ?',
+                        (json.dumps(jsonable_encoder(newer)), version_of(newer), 1)
+                    )
+                return real_execute(sql, *args)
+
+        store.db = Racing()
+        try:
+            self.assertIsNone(store.set_status(1, 'running'))
+        finally:
+            store.db = real_execute.__self__
+
+        row = store.db.execute('SELECT data FROM deployments WHERE id = 1').fetchone()
+        self.assertIn('nginx:1.25', row[0])
+        self.assertIn('"pending"', row[0])
+
+    def test_concurrent_writers(self):
+        def write(offset):
+            for deployment_id in range(offset, offset + 50):
+                self.put(make_deployment(deployment_id))
+                self.store.set_status(deployment_id, 'running')
+
+        threads = [threading.Thread(target=write, args=(offset,)) for offset in (0, 50, 100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.store), 150)
+        self.assertEqual(len(self.store.query(status='running', limit=200)[0]), 150)
+
+
+if __name__ == '__main__':
+    unittest.main()
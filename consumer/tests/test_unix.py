@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+from app.unix import LocalShard
+
+
+def frame(deployment_id, priority=1):
+    return {
+        'routing_key': 'deployment',
+        'priority': priority,
+        'headers': {'deployment_id': deployment_id},
+        'body': f'{{"id": {deployment_id}}}',
+    }
+
+
+class Recorder:
+    """``on_message`` that nacks deployment 1 until ``failures`` run out."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.delivered = []
+        self.done = threading.Event()
+
+    def on_message(self, channel, method, properties, body):
+        deployment_id = properties.headers['deployment_id']
+        self.delivered.append((deployment_id, method.redelivered, time.monotonic()))
+        if deployment_id == 1 and self.failures:
+            self.failures -= 1
+            channel.basic_nack(delivery_tag=method.delivery_tag)
+            return
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        if deployment_id == 1:
+            self.done.set()
+
+
+class TestLocalShard(unittest.TestCase):
+    def test_nacked_messages_back_off_without_blocking_others(self):
+        owner = Recorder(failures=3)
+        shard = LocalShard(0, owner, ttl=60, retry_delay=0.05, max_retry_delay=0.1)
+        shard.start()
+        self.addCleanup(shard.stop)
+
+        shard.put(frame(1), time.monotonic())
+        shard.put(frame(2), time.monotonic())
+
+        self.assertTrue(owner.done.wait(5))
+        deliveries = [(deployment_id, redelivered) for deployment_id, redelivered, _ in owner.delivered]
+        self.assertEqual(deliveries, [(1, False), (2, False), (1, True), (1, True), (1, True)])
+        attempts = [at for deployment_id, _, at in owner.delivered if deployment_id == 1]
+        gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+        self.assertGreaterEqual(gaps[0], 0.05)
+        self.assertGreaterEqual(gaps[1], 0.1)
+        self.assertEqual(shard.retried, 3)
+        self.assertEqual(len(shard), 0)
+
+    def test_retries_stop_once_expired(self):
+        owner = Recorder(failures=10 ** 6)
+        shard = LocalShard(0, owner, ttl=0.2, retry_delay=0.05, max_retry_delay=0.05)
+        shard.start()
+        self.addCleanup(shard.stop)
+
+        shard.put(frame(1), time.monotonic())
+        time.sleep(0.5)
+
+        self.assertEqual(shard.expired, 1)
+        self.assertLess(len(owner.delivered), 10)
+        self.assertEqual(len(shard), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
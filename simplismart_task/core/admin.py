@@ -1,6 +1,43 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Cluster, ResourceUsage, Deployment, Organization, OrganizationMembership
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
+from .models import User, Cluster, ResourceUsage, Deployment, Organization, OrganizationMembership, OrganizationCapacity
+from .deployments import stop_deployments
+
+class EstimatedCountPaginator(Paginator):
+    """Uses the planner's row estimate for unfiltered PostgreSQL changelists.
+
+    An exact ``COUNT(*)`` over a large table is a full scan on every page
+    load; the estimate is only used above ``threshold`` rows, so small tables
+    and filtered or searched lists still show exact counts.
+    """
+
+    threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > self.threshold:
+                return row[0]
+        return super().count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Skips the second, unfiltered COUNT(*) next to filtered results.
+    show_full_result_count = False
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -21,10 +58,12 @@ class CustomUserAdmin(UserAdmin):
     )
 
 @admin.register(Cluster)
-class ClusterAdmin(admin.ModelAdmin):
+class ClusterAdmin(ScalableAdmin):
     list_display = ('name', 'owner', 'total_cpu', 'total_ram', 'total_gpu', 'available_cpu', 'available_ram', 'available_gpu', 'created_at')
-    list_filter = ('owner', 'created_at')
-    search_fields = ('name', 'description')
+    list_filter = ('created_at',)
+    list_select_related = ('owner',)
+    search_fields = ('name', 'description', 'owner__email')
+    autocomplete_fields = ('owner',)
     readonly_fields = ('available_cpu', 'available_ram', 'available_gpu', 'created_at', 'updated_at')
     fieldsets = (
         ('Basic Information', {
@@ -43,16 +82,47 @@ class ClusterAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_queryset(self, request):
+        # One aggregate per row instead of three per-row queries through the
+        # model's available_* properties. The difference is annotated too so
+        # the Available columns sort by availability.
+        resources = ('cpu', 'ram', 'gpu')
+        return super().get_queryset(request).annotate(**{
+            f'used_{resource}_total': Coalesce(Sum(f'resource_usage__used_{resource}'), Value(0))
+            for resource in resources
+        }).annotate(**{
+            f'{resource}_available': F(f'total_{resource}') - F(f'used_{resource}_total')
+            for resource in resources
+        })
+
+    @admin.display(description='Available CPU', ordering='cpu_available')
+    def available_cpu(self, obj):
+        return obj.cpu_available
+
+    @admin.display(description='Available RAM', ordering='ram_available')
+    def available_ram(self, obj):
+        return obj.ram_available
+
+    @admin.display(description='Available GPU', ordering='gpu_available')
+    def available_gpu(self, obj):
+        return obj.gpu_available
+
 @admin.register(ResourceUsage)
-class ResourceUsageAdmin(admin.ModelAdmin):
-    list_display = ('cluster', 'used_cpu', 'used_ram', 'used_gpu', 'created_at')
-    list_filter = ('cluster', 'created_at')
+class ResourceUsageAdmin(ScalableAdmin):
+    list_display = ('cluster', 'used_cpu', 'used_ram', 'used_gpu', 'lease_expires_at', 'created_at')
+    list_filter = ('created_at',)
+    list_select_related = ('cluster__owner',)
     search_fields = ('cluster__name',)
+    autocomplete_fields = ('cluster',)
     readonly_fields = ('created_at',)
     fieldsets = (
         ('Resource Usage', {
             'fields': ('cluster', 'used_cpu', 'used_ram', 'used_gpu')
         }),
+        ('Lease', {
+            'fields': ('lease_seconds', 'lease_expires_at'),
+            'classes': ('collapse',)
+        }),
         ('Timestamps', {
             'fields': ('created_at',),
             'classes': ('collapse',)
@@ -60,14 +130,17 @@ class ResourceUsageAdmin(admin.ModelAdmin):
     )
 
 @admin.register(Deployment)
-class DeploymentAdmin(admin.ModelAdmin):
-    list_display = ('name', 'cluster', 'docker_image', 'status', 'created_at')
-    list_filter = ('status', 'cluster', 'created_at')
+class DeploymentAdmin(ScalableAdmin):
+    list_display = ('name', 'cluster', 'docker_image', 'status', 'priority', 'created_at')
+    list_filter = ('status', 'priority', 'created_at')
+    list_select_related = ('cluster__owner',)
     search_fields = ('name', 'docker_image', 'cluster__name')
+    autocomplete_fields = ('cluster',)
     readonly_fields = ('created_at', 'updated_at')
+    actions = ['stop']
     fieldsets = (
         ('Basic Information', {
-            'fields': ('name', 'cluster', 'docker_image', 'status')
+            'fields': ('name', 'cluster', 'docker_image', 'status', 'priority')
         }),
         ('Resource Requirements', {
             'fields': ('required_cpu', 'required_ram', 'required_gpu')
@@ -78,10 +151,23 @@ class DeploymentAdmin(admin.ModelAdmin):
         }),
     )
 
+    @admin.action(description="Stop selected deployments and release their resources")
+    def stop(self, request, queryset):
+        result = stop_deployments(queryset)
+        released = result['released']
+        self.message_user(
+            request,
+            f"Stopped {len(result['stopped'])} deployments, released {released['cpu']} CPU, "
+            f"{released['ram']} GB RAM and {released['gpu']} GPU.",
+            messages.SUCCESS
+        )
+
 @admin.register(Organization)
 class OrganizationAdmin(admin.ModelAdmin):
     list_display = ('name', 'created_by', 'created_at')
     list_filter = ('created_at',)
+    list_select_related = ('created_by',)
+    autocomplete_fields = ('created_by',)
     search_fields = ('name', 'description', 'created_by__email')
     readonly_fields = ('created_at', 'updated_at')
     fieldsets = (
@@ -98,7 +184,9 @@ class OrganizationAdmin(admin.ModelAdmin):
 class OrganizationMembershipAdmin(admin.ModelAdmin):
     list_display = ('user', 'organization', 'role', 'joined_at')
     list_filter = ('role', 'joined_at')
+    list_select_related = ('user', 'organization')
     search_fields = ('user__email', 'organization__name')
+    autocomplete_fields = ('user', 'organization')
     readonly_fields = ('joined_at',)
     fieldsets = (
         ('Membership Details', {
@@ -108,4 +196,20 @@ class OrganizationMembershipAdmin(admin.ModelAdmin):
             'fields': ('joined_at',),
             'classes': ('collapse',)
         }),
-    ) 
\ No newline at end of file
+    ) 
+
+@admin.register(OrganizationCapacity)
+class OrganizationCapacityAdmin(admin.ModelAdmin):
+    list_display = ('organization', 'member_count', 'cluster_count', 'total_cpu', 'available_cpu', 'quota_cpu', 'total_ram', 'available_ram', 'quota_ram', 'total_gpu', 'available_gpu', 'quota_gpu', 'updated_at')
+    list_select_related = ('organization',)
+    search_fields = ('organization__name',)
+    readonly_fields = [
+        field.name for field in OrganizationCapacity._meta.fields if not field.name.startswith('quota_')
+    ] + ['available_cpu', 'available_ram', 'available_gpu']
+    actions = ['rebuild']
+
+    @admin.action(description="Recompute from clusters and usage")
+    def rebuild(self, request, queryset):
+        for capacity in queryset:
+            capacity.rebuild()
+        self.message_user(request, f"Rebuilt {queryset.count()} organization capacities.")
@@ -0,0 +1,207 @@
+import hashlib
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import django
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Sum
+from django.utils import timezone
+
+from .capacity import RESOURCES, cluster_report, fragmentation, number
+from .models import Deployment, UsageEvent
+
+logger = logging.getLogger(__name__)
+
+EVENT_DTYPE = np.dtype([
+    ('cluster', np.int64),
+    ('time', np.float64),
+    ('cpu', np.float64),
+    ('ram', np.float64),
+    ('gpu', np.float64),
+])
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    # Spawned rather than forked: the API worker has open database and broker
+    # connections and background threads that a fork would copy. Each worker
+    # sets Django up once and opens its own database connection, so the bulk
+    # loads below run there rather than in the API worker.
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                max_workers=settings.CAPACITY_ANALYTICS['WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup
+            )
+        return pool
+
+
+def run_in_worker(function, *args):
+    """Call ``function`` in a pool worker, closing its connections afterwards."""
+    try:
+        return function(*args)
+    finally:
+        connections.close_all()
+
+
+def load_usage(cluster_ids, start):
+    """Load usage changes for ``cluster_ids`` since ``start`` as one structured array.
+
+    Changes come from the ``UsageEvent`` history, so allocations released
+    since still show up while they were held. The baseline is each
+    cluster's usage at ``start``.
+    """
+    positions = {cluster_id: index for index, cluster_id in enumerate(cluster_ids)}
+    rows = (
+        UsageEvent.objects
+        .filter(cluster_id__in=cluster_ids, created_at__gte=start)
+        .order_by('cluster_id', 'created_at', 'id')
+        .values_list('cluster_id', 'created_at', 'used_cpu', 'used_ram', 'used_gpu')
+        .iterator(chunk_size=settings.CAPACITY_ANALYTICS['CHUNK_SIZE'])
+    )
+    events = np.fromiter(
+        (
+            (positions[cluster_id], created_at.timestamp(), cpu, ram, gpu)
+            for cluster_id, created_at, cpu, ram, gpu in rows
+        ),
+        dtype=EVENT_DTYPE
+    )
+    # Positions follow cluster_ids, which is sorted, so the database order
+    # already is (cluster, time).
+    baseline = np.zeros((len(cluster_ids), 3))
+    before = (
+        UsageEvent.objects
+        .filter(cluster_id__in=cluster_ids, created_at__lt=start)
+        .values('cluster_id')
+        .annotate(cpu=Sum('used_cpu'), ram=Sum('used_ram'), gpu=Sum('used_gpu'))
+        .order_by()
+    )
+    for row in before:
+        baseline[positions[row['cluster_id']]] = [row[resource] for resource in RESOURCES]
+    return events, baseline
+
+
+def deployment_shape(cluster_ids):
+    """Median cpu/ram/gpu of active deployments, or ``None`` without any."""
+    requirements = np.array(
+        Deployment.objects
+        .filter(cluster_id__in=cluster_ids, status__in=['pending', 'running'])
+        .values_list('required_cpu', 'required_ram', 'required_gpu'),
+        dtype=np.float64
+    )
+    if not len(requirements):
+        return None
+    return np.median(requirements, axis=0)
+
+
+def batch_report(batch):
+    """Load usage for one batch of clusters and report on it."""
+    events, baseline = load_usage(batch['cluster_ids'], batch['since'])
+    rows = cluster_report({
+        'cluster': events['cluster'],
+        'times': events['time'],
+        'used': np.column_stack([events[resource] for resource in RESOURCES]),
+        'baseline': baseline,
+        'totals': batch['totals'],
+        'shape': batch['shape'],
+        'start': batch['since'].timestamp(),
+        'end': batch['end'],
+        'points': batch['points'],
+    })
+    return len(events), rows
+
+
+def split_batches(cluster_ids, totals, shape, start, end):
+    # Contiguous cluster ranges, one per worker, each loaded by the worker
+    # that reports on it.
+    config = settings.CAPACITY_ANALYTICS
+    k = len(cluster_ids)
+    batches = []
+    for chunk in np.array_split(np.arange(k), max(1, min(config['WORKERS'], k))):
+        if not len(chunk):
+            continue
+        low, high = chunk[0], chunk[-1] + 1
+        batches.append({
+            'cluster_ids': cluster_ids[low:high],
+            'totals': totals[low:high],
+            'shape': shape,
+            'since': start,
+            'end': end,
+            'points': config['GRID_POINTS'],
+        })
+    return batches
+
+
+def capacity_report(clusters, days):
+    """Utilization, forecast and fragmentation report for ``clusters``.
+
+    Both the bulk loads and the arithmetic run in the worker pool (inline
+    when ``WORKERS`` is 0); the API worker only waits for the results.
+    Reports are cached for ``CACHE_TTL`` seconds.
+    """
+    config = settings.CAPACITY_ANALYTICS
+    clusters = sorted(clusters, key=lambda cluster: cluster.id)
+    cluster_ids = [cluster.id for cluster in clusters]
+    key = 'analytics:capacity:' + hashlib.sha1(f"{cluster_ids}:{days}".encode()).hexdigest()
+    report = cache.get(key)
+    if report is not None:
+        return report
+
+    end = timezone.now()
+    start = end - timedelta(days=days)
+    totals = np.array(
+        [[cluster.total_cpu, cluster.total_ram, cluster.total_gpu] for cluster in clusters],
+        dtype=np.float64
+    ).reshape(-1, 3)
+
+    if config['WORKERS']:
+        workers = get_pool()
+        shape = workers.submit(run_in_worker, deployment_shape, cluster_ids).result(timeout=config['TIMEOUT'])
+        batches = split_batches(cluster_ids, totals, shape, start, end.timestamp())
+        results = workers.map(run_in_worker, [batch_report] * len(batches), batches,
+                              timeout=config['TIMEOUT'])
+    else:
+        shape = deployment_shape(cluster_ids)
+        batches = split_batches(cluster_ids, totals, shape, start, end.timestamp())
+        results = map(batch_report, batches)
+    events = 0
+    rows = []
+    for count, result in results:
+        events += count
+        rows.extend(result)
+
+    used = np.array([[row[resource]['used'] for resource in RESOURCES] for row in rows]).reshape(-1, 3)
+    fleet_fragmentation = None
+    if shape is not None and len(rows):
+        _, fleet_fragmentation = fragmentation(totals - used, totals, shape)
+    report = {
+        'window': {'start': start, 'end': end, 'days': days},
+        'events': events,
+        'deployment_shape': None if shape is None else dict(zip(RESOURCES, shape.tolist())),
+        'fleet': {
+            **{
+                resource: {
+                    'total': float(totals[:, r].sum()),
+                    'used': float(used[:, r].sum()),
+                }
+                for r, resource in enumerate(RESOURCES)
+            },
+            'fragmentation': None if fleet_fragmentation is None else number(fleet_fragmentation),
+        },
+        'clusters': [
+            {'id': cluster.id, 'name': cluster.name, **row}
+            for cluster, row in zip(clusters, rows)
+        ],
+    }
+    cache.set(key, report, config['CACHE_TTL'])
+    return report
@@ -0,0 +1,112 @@
+"""Capacity analytics over usage history, computed with NumPy only.
+
+Nothing here imports Django; ``core.analytics`` loads the rows and calls
+into this module. Arrays describe a batch of
+clusters by position ``0..k-1``:
+
+- ``cluster``: position of each usage event, sorted by ``(cluster, time)``
+- ``times``: event time in seconds since the epoch
+- ``used``: ``(n, 3)`` cpu/ram/gpu allocated by each event
+- ``baseline``: ``(k, 3)`` usage already allocated before the window
+- ``totals``: ``(k, 3)`` cluster capacity
+"""
+import warnings
+
+import numpy as np
+
+RESOURCES = ('cpu', 'ram', 'gpu')
+PERCENTILES = (50, 90, 99)
+
+
+def usage_on_grid(cluster, times, used, baseline, start, end, points):
+    """Sample each cluster's cumulative usage at ``points`` evenly spaced times.
+
+    Returns the grid offsets in seconds and a ``(k, points, 3)`` array.
+    """
+    k = len(baseline)
+    offsets = np.linspace(0, end - start, points)
+    # One sorted key per event lets a single searchsorted find, for every
+    # cluster and grid time at once, how many events have happened.
+    width = end - start + 1
+    keys = cluster * width + (times - start)
+    grid_keys = np.arange(k)[:, None] * width + offsets[None, :]
+    seen = np.searchsorted(keys, grid_keys.ravel(), side='right').reshape(k, points)
+    first = np.searchsorted(cluster, np.arange(k), side='left')
+    cumulative = np.vstack([np.zeros((1, 3)), np.cumsum(used, axis=0)])
+    values = cumulative[seen] - cumulative[first][:, None, :]
+    return offsets, baseline[:, None, :] + values
+
+
+def fragmentation(free, totals, shape):
+    """Share of free capacity stranded once ``shape``-sized deployments are packed.
+
+    ``free`` and ``totals`` are ``(k, 3)``. Each resource is weighed by the
+    cluster's capacity so GB of RAM do not drown out GPUs. Returns per-row
+    scores and the fleet-wide score, ``nan`` where nothing is free.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        needed = shape > 0
+        fits = np.floor(np.min(np.where(needed, free / np.where(needed, shape, 1), np.inf), axis=1))
+        fits = np.clip(np.nan_to_num(fits, posinf=0), 0, None)
+        stranded = np.clip(free - fits[:, None] * shape, 0, None)
+        weights = np.where(totals > 0, 1 / totals, 0)
+        stranded_share = (stranded * weights).sum(axis=1)
+        free_share = (np.clip(free, 0, None) * weights).sum(axis=1)
+        scores = stranded_share / free_share
+        fleet = stranded_share.sum() / free_share.sum()
+    return scores, fleet
+
+
+def cluster_report(batch):
+    """Per-cluster utilization, trend and fragmentation for one batch."""
+    start, end = batch['start'], batch['end']
+    totals = batch['totals']
+    offsets, usage = usage_on_grid(
+        batch['cluster'], batch['times'], batch['used'], batch['baseline'], start, end, batch['points']
+    )
+    current = usage[:, -1, :]
+    # Clusters without a resource (e.g. no GPUs) come out as nan, not errors.
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        utilization = usage / np.where(totals > 0, totals, np.nan)[:, None, :]
+        percentiles = np.nanpercentile(utilization, PERCENTILES, axis=1)
+        mean = np.nanmean(utilization, axis=1)
+        peak = np.nanmax(utilization, axis=1)
+        peak_to_average = peak / mean
+
+        # Least-squares growth rate over the window, per cluster and resource.
+        hours = offsets / 3600
+        centred = hours - hours.mean()
+        slope = (centred[None, :, None] * (usage - usage.mean(axis=1, keepdims=True))).sum(axis=1) / (centred ** 2).sum()
+        hours_left = np.where(slope > 0, (totals - current) / slope, np.nan)
+
+    scores = np.full(len(totals), np.nan)
+    if batch['shape'] is not None:
+        scores, _ = fragmentation(totals - current, totals, batch['shape'])
+
+    return [
+        {
+            **{
+                resource: {
+                    'total': float(totals[i, r]),
+                    'used': float(current[i, r]),
+                    'utilization': {
+                        **{f'p{p}': number(percentiles[j, i, r]) for j, p in enumerate(PERCENTILES)},
+                        'mean': number(mean[i, r]),
+                        'peak': number(peak[i, r]),
+                    },
+                    'peak_to_average': number(peak_to_average[i, r]),
+                    'growth_per_hour': number(slope[i, r]),
+                    'hours_to_exhaustion': number(hours_left[i, r]),
+                }
+                for r, resource in enumerate(RESOURCES)
+            },
+            'fragmentation': number(scores[i]),
+        }
+        for i in range(len(totals))
+    ]
+
+
+def number(value, digits=4):
+    value = float(value)
+    return None if np.isnan(value) or np.isinf(value) else round(value, digits)
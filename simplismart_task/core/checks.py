@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Warning, register
+from django_redis.cache import RedisCache
+
+
+@register(deploy=True)
+def allocation_throttle_cache(app_configs, **kwargs):
+    config = settings.ALLOCATION_THROTTLE
+    if not config['ENABLED'] or isinstance(caches[config['CACHE']], RedisCache):
+        return []
+    return [Warning(
+        f"ALLOCATION_THROTTLE uses the {config['CACHE']!r} cache, which is not Redis",
+        hint="Each worker keeps its own token buckets, so the limits are multiplied by the "
+             "number of workers. Set REDIS_URL to share them.",
+        id='core.W001',
+    )]
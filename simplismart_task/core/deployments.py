@@ -0,0 +1,97 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Deployment, OrganizationCapacity, ResourceUsage, UsageEvent
+from .signals import organizations_of
+from .transports import deployment_publisher
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+# Stopped deployments are published from here rather than in the request.
+# One thread keeps batches in order; it is started on first use, so after
+# any fork.
+publish_queue = ThreadPoolExecutor(max_workers=1, thread_name_prefix='publish-stopped')
+
+
+def release_usage(usage):
+    """Delete the ``usage`` rows and take them out of the capacity rollups.
+
+    Runs one aggregate per cluster owner and per cluster, one UPDATE per
+    owner, one INSERT into the usage history and one DELETE. Call it inside
+    a transaction. Returns the released totals.
+    """
+    per_owner = usage.values('cluster__owner_id').annotate(
+        used_cpu=Sum('used_cpu'),
+        used_ram=Sum('used_ram'),
+        used_gpu=Sum('used_gpu')
+    ).order_by()
+    released = {'cpu': 0, 'ram': 0, 'gpu': 0}
+    for row in per_owner:
+        OrganizationCapacity.adjust(
+            organizations_of(row['cluster__owner_id']),
+            used_cpu=-row['used_cpu'],
+            used_ram=-row['used_ram'],
+            used_gpu=-row['used_gpu']
+        )
+        for resource in released:
+            released[resource] += row[f'used_{resource}']
+    per_cluster = usage.values('cluster_id').annotate(
+        used_cpu=Sum('used_cpu'),
+        used_ram=Sum('used_ram'),
+        used_gpu=Sum('used_gpu')
+    ).order_by()
+    UsageEvent.objects.bulk_create([
+        UsageEvent(
+            cluster_id=row['cluster_id'],
+            used_cpu=-row['used_cpu'],
+            used_ram=-row['used_ram'],
+            used_gpu=-row['used_gpu']
+        )
+        for row in per_cluster
+    ])
+    # A plain DELETE: QuerySet.delete() would load every row to send the
+    # post_delete signals that the adjustment above already covers.
+    usage._raw_delete(usage.db)
+    return released
+
+
+def stop_deployments(deployments):
+    """Stop the active deployments in ``deployments`` and release their usage.
+
+    Runs a fixed number of set-based queries in one transaction, whatever
+    the number of deployments: no per-row ``save()``, so no per-row
+    capacity validation or signals. The stopped deployments are then
+    published in the background, on ``publish_queue``, so the consumer sees
+    them stop without the request waiting on the broker. Returns the stopped
+    ids and the released totals.
+
+    Only usage linked to a stopped deployment is released. Usage reserved
+    directly through ``use_resources``, and legacy rows migration 0007 could
+    not link to a deployment, have no owner to stop with; release them with
+    ``DELETE /api/resource-usage/{id}/``.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            deployments.filter(status__in=ACTIVE_STATUSES)
+            .select_for_update()
+            .values_list('id', flat=True)
+        )
+        if not ids:
+            return {'stopped': [], 'released': {'cpu': 0, 'ram': 0, 'gpu': 0}}
+
+        released = release_usage(ResourceUsage.objects.filter(deployment_id__in=ids))
+        Deployment.objects.filter(id__in=ids).update(status='stopped', updated_at=now)
+
+    logger.info(f"Stopped {len(ids)} deployments, released {released}")
+    # Imported here: serializers -> leases -> this module.
+    from .serializers import DeploymentSerializer
+    stopped = DeploymentSerializer(Deployment.objects.filter(id__in=ids), many=True).data
+    publish_queue.submit(deployment_publisher.publish_deployments, list(stopped))
+    return {'stopped': ids, 'released': released}
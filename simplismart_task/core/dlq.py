@@ -0,0 +1,28 @@
+import pika
+
+from common.deadletters import GONE, DeadLetter, DeadLetterReplayer  # noqa: F401
+from common.queues import get_connection_parameters
+from common.versions import parse_version
+
+from .models import Deployment
+
+
+def latest_versions(deployment_ids):
+    """Version lookup for ``DeadLetterReplayer``: the deployments in the database.
+
+    Deleted deployments are reported as ``GONE`` so their messages are dropped.
+    """
+    versions = dict.fromkeys(deployment_ids, GONE)
+    for deployment_id, updated_at in Deployment.objects.filter(
+        id__in=deployment_ids
+    ).values_list('id', 'updated_at'):
+        versions[deployment_id] = parse_version(updated_at)
+    return versions
+
+
+def dead_letter_replayer(**options):
+    return DeadLetterReplayer(
+        connect=lambda: pika.BlockingConnection(get_connection_parameters()),
+        current_versions=latest_versions,
+        **options
+    )
@@ -0,0 +1,134 @@
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyRecord
+
+HEADER = 'Idempotency-Key'
+
+
+def request_fingerprint(request):
+    # Hashes the parsed data: the raw body has already been consumed by the
+    # time throttles have run.
+    payload = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method} {request.path}\n{payload}".encode()).hexdigest()
+
+
+def replay_marker(user, key):
+    return f"idempotency:{user.pk}:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def will_replay(request):
+    """Whether this request will be answered from a stored response.
+
+    Throttles ask this before the view runs, so it only reads the marker
+    left in the cache when the response was stored, not the database.
+    """
+    key = request.headers.get(HEADER)
+    if not key or not request.user.is_authenticated:
+        return False
+    return cache.get(replay_marker(request.user, key)) is not None
+
+
+def claim(request, key, fingerprint):
+    """Claim ``key`` for this request.
+
+    Returns ``(record, True)`` with the new in-flight record,
+    ``(record, False)`` with the live record already holding the key, or
+    ``(None, False)`` if the key was freed and retaken by a racing request
+    on every attempt. A claim only lasts ``IN_FLIGHT_TTL`` seconds until its
+    response is stored, so a key held by a worker that died mid-request can
+    be taken over.
+    """
+    now = timezone.now()
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                record = IdempotencyRecord.objects.create(
+                    user=request.user,
+                    key=key,
+                    fingerprint=fingerprint,
+                    expires_at=now + timedelta(seconds=settings.IDEMPOTENCY['IN_FLIGHT_TTL'])
+                )
+            return record, True
+        except IntegrityError:
+            record = IdempotencyRecord.objects.filter(user=request.user, key=key).first()
+            if record is None or record.expires_at <= now:
+                # Expired, abandoned in flight, or just purged: the key is free again.
+                IdempotencyRecord.objects.filter(user=request.user, key=key, expires_at__lte=now).delete()
+                continue
+            return record, False
+    return None, False
+
+
+def idempotent(view_method):
+    """Replay the first response to a POST repeated with the same ``Idempotency-Key``.
+
+    The key is scoped to the user. The first request claims it before the
+    view runs, so a retry arriving while it is still in flight gets ``409``
+    instead of allocating twice, as does one that loses the race to claim it
+    outright. The claim lapses after ``IN_FLIGHT_TTL``
+    seconds if no response is stored, e.g. because the worker was killed.
+    Reusing a key with a different method, path or body gets ``422``.
+    Responses below 500 are stored for ``TTL`` seconds and replayed with
+    ``Idempotent-Replayed: true``. After a server error or exception the
+    claim is released so the client can retry.
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > IdempotencyRecord._meta.get_field('key').max_length:
+            return Response({'error': f'{HEADER} must be at most 255 characters'},
+                         status=status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = request_fingerprint(request)
+        record, claimed = claim(request, key, fingerprint)
+        if not claimed:
+            if record is not None and record.fingerprint != fingerprint:
+                return Response({'error': f'{HEADER} was already used for a different request'},
+                             status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if record is None or record.status_code is None:
+                # Still in flight, or the key kept changing hands while we
+                # tried to claim it: never run the view unprotected.
+                response = Response({'error': 'A request with this key is still in progress'},
+                                    status=status.HTTP_409_CONFLICT)
+                response['Retry-After'] = '1'
+                return response
+            response = Response(record.response, status=record.status_code)
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        # Only touch our own claim: if it outlived IN_FLIGHT_TTL, a retry may
+        # have taken the key over.
+        own = IdempotencyRecord.objects.filter(pk=record.pk)
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            own.delete()
+            raise
+        if response.status_code >= 500:
+            own.delete()
+        elif own.update(
+            status_code=response.status_code,
+            response=response.data,
+            expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY['TTL'])
+        ):
+            cache.set(replay_marker(request.user, key), True, settings.IDEMPOTENCY['TTL'])
+        return response
+
+    return wrapper
+
+
+def purge_expired(now=None):
+    return IdempotencyRecord.objects.filter(expires_at__lte=now or timezone.now()).delete()[0]
@@ -0,0 +1,63 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .deployments import release_usage
+from .models import ResourceUsage
+
+logger = logging.getLogger(__name__)
+
+
+def lease_expiry(seconds, now=None):
+    return (now or timezone.now()) + timedelta(seconds=seconds)
+
+
+def renew_lease(usage, seconds=None):
+    """Push back the expiry of a live lease; returns the new expiry or ``None``.
+
+    The UPDATE only matches while the lease has not expired, so a heartbeat
+    racing the sweeper cannot revive usage that is being reclaimed.
+    """
+    now = timezone.now()
+    expires_at = lease_expiry(seconds or usage.lease_seconds, now)
+    renewed = ResourceUsage.objects.filter(pk=usage.pk, lease_expires_at__gt=now).update(
+        lease_expires_at=expires_at,
+        updated_at=now
+    )
+    return expires_at if renewed else None
+
+
+def sweep_expired_leases(batch_size=None, now=None):
+    """Reclaim every lease expired at ``now``, ``batch_size`` rows per transaction.
+
+    Each batch is read through the partial index on ``lease_expires_at``, so
+    the cost follows the number of expired rows rather than the table size.
+    Returns the number of rows reclaimed and the capacity released.
+    """
+    batch_size = batch_size or settings.RESOURCE_LEASES['SWEEP_BATCH_SIZE']
+    now = now or timezone.now()
+    reclaimed = 0
+    released = {'cpu': 0, 'ram': 0, 'gpu': 0}
+    while True:
+        with transaction.atomic():
+            expired = ResourceUsage.objects.filter(lease_expires_at__lte=now)
+            ids = list(
+                expired.order_by('lease_expires_at')
+                .select_for_update()
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            # Re-check expiry: a lease renewed since the select is kept.
+            batch = release_usage(expired.filter(id__in=ids))
+        reclaimed += len(ids)
+        for resource in released:
+            released[resource] += batch[resource]
+        if len(ids) < batch_size:
+            break
+    if reclaimed:
+        logger.info(f"Reclaimed {reclaimed} expired leases, released {released}")
+    return reclaimed, released
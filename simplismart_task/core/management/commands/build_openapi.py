@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.openapi import FORMATS, artifact_path, build_schema, built_fingerprint, schema_fingerprint
+
+
+class Command(BaseCommand):
+    help = "Generate the OpenAPI schema artifact served at /api/schema.json and /api/schema.yaml"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Fail if the artifact for the current code is missing instead of building it")
+        parser.add_argument('--if-stale', action='store_true',
+                            help="Only build if the served artifact is not the one for the current code")
+
+    def handle(self, *args, **options):
+        fingerprint = schema_fingerprint()
+        current = built_fingerprint() == fingerprint and all(
+            artifact_path(fingerprint, fmt).exists() for fmt in FORMATS
+        )
+        if options['check'] or options['if_stale']:
+            if current:
+                self.stdout.write(f"OpenAPI schema {fingerprint} is up to date")
+                return
+            if options['check']:
+                raise CommandError(f"OpenAPI schema {fingerprint} is not built")
+        build_schema(fingerprint)
+        for fmt in FORMATS:
+            self.stdout.write(self.style.SUCCESS(f"Wrote {artifact_path(fingerprint, fmt)}"))
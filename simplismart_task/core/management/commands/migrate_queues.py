@@ -0,0 +1,90 @@
+import pika
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.queues import (
+    EXCHANGE,
+    QUEUE_ARGUMENTS,
+    get_connection_parameters,
+    incompatible_argument,
+    shard_queue,
+    shard_routing_key,
+)
+
+
+class Command(BaseCommand):
+    help = "Recreate drained deployment queues that were declared with outdated arguments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, action='append', dest='shards',
+                            help="Only check this shard's queue (repeatable)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report which queues need recreating without changing them")
+
+    def handle(self, *args, **options):
+        self.connection = pika.BlockingConnection(get_connection_parameters())
+        try:
+            for shard in options['shards'] or range(settings.DEPLOYMENT_SHARDS):
+                self.migrate(shard_queue(shard), shard_routing_key(shard), options['dry_run'])
+        finally:
+            if self.connection.is_open:
+                self.connection.close()
+
+    def channel(self):
+        channel = self.connection.channel()
+        channel.confirm_delivery()
+        return channel
+
+    def migrate(self, queue, routing_key, dry_run):
+        channel = self.channel()
+        try:
+            channel.queue_declare(queue=queue, durable=True, arguments=QUEUE_ARGUMENTS)
+            self.stdout.write(f"{queue}: up to date")
+            return
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 406:
+                raise
+            argument = incompatible_argument(e.reply_text) or e.reply_text
+        if dry_run:
+            self.stdout.write(f"{queue}: needs recreating ({argument})")
+            return
+
+        # Deployments published while the queue is being recreated are
+        # routed to a holding queue and moved over afterwards, so none are
+        # dropped as unroutable. The holding queue and the new queue are both
+        # bound for a moment; consumers drop the duplicates as stale.
+        holding = f'{queue}.migrating'
+        channel = self.channel()
+        channel.queue_declare(queue=holding, durable=True, arguments=QUEUE_ARGUMENTS)
+        channel.queue_bind(exchange=EXCHANGE, queue=holding, routing_key=routing_key)
+        try:
+            # The broker refuses atomically if messages or consumers remain.
+            channel.queue_delete(queue=queue, if_unused=True, if_empty=True)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 406:
+                raise
+            # Everything in the holding queue also reached the old queue.
+            channel = self.channel()
+            channel.queue_unbind(exchange=EXCHANGE, queue=holding, routing_key=routing_key)
+            channel.queue_delete(queue=holding)
+            self.stdout.write(self.style.WARNING(
+                f"{queue}: skipped ({argument}), it still has messages or consumers; "
+                f"stop its consumers, let it drain and run this again"
+            ))
+            return
+
+        channel.queue_declare(queue=queue, durable=True, arguments=QUEUE_ARGUMENTS)
+        channel.queue_bind(exchange=EXCHANGE, queue=queue, routing_key=routing_key)
+        channel.queue_unbind(exchange=EXCHANGE, queue=holding, routing_key=routing_key)
+        moved = 0
+        while True:
+            method, properties, body = channel.basic_get(queue=holding)
+            if method is None:
+                break
+            channel.basic_publish(exchange='', routing_key=queue, body=body, properties=properties)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            moved += 1
+        channel.queue_delete(queue=holding)
+        self.stdout.write(self.style.SUCCESS(
+            f"{queue}: recreated with {argument} ({moved} deployments published meanwhile moved over)"
+        ))
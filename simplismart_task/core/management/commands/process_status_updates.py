@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from core.status_feedback import StatusFeedbackWorker
+
+
+class Command(BaseCommand):
+    help = "Drain deployment status transitions reported by the consumer and apply them in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Maximum number of messages applied per transaction")
+        parser.add_argument('--max-wait', type=float, default=1.0,
+                            help="Seconds to wait for a batch to fill before applying it")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        worker = StatusFeedbackWorker(
+            batch_size=options['batch_size'],
+            max_wait=options['max_wait']
+        )
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter: by the time this command executes, everything
+# it would measure has already been imported.
+STARTUP_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+urls = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+wsgi = time.perf_counter()
+print(json.dumps({
+    "django.setup": setup - started,
+    "urlconf": urls - setup,
+    "wsgi application": wsgi - urls,
+    "total": wsgi - started,
+}))
+'''
+
+
+def parse_importtime(output):
+    """Parse ``-X importtime`` lines into ``{module: (self_us, cumulative_us)}``."""
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            own, cumulative, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = (int(own), int(cumulative))
+        except ValueError:
+            # The header row.
+            continue
+    return modules
+
+
+class Command(BaseCommand):
+    help = "Report how long a worker takes to start, per phase and per imported module"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=25, help="Show the N slowest modules")
+        parser.add_argument('--prefix', action='append', dest='prefixes',
+                            help="Only show modules under this package, e.g. core (repeatable)")
+        parser.add_argument('--sort', choices=['self', 'cumulative'], default='cumulative',
+                            help="Order modules by their own time or including their imports")
+        parser.add_argument('--json', action='store_true', help="Print JSON instead of a table")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE
+        ))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True
+        )
+        if result.returncode:
+            raise CommandError(f"Startup failed:\n{result.stderr[-2000:]}")
+
+        phases = json.loads(result.stdout.strip().splitlines()[-1])
+        modules = parse_importtime(result.stderr)
+        if options['prefixes']:
+            modules = {
+                name: times for name, times in modules.items()
+                if any(name == prefix or name.startswith(prefix + '.') for prefix in options['prefixes'])
+            }
+        column = 0 if options['sort'] == 'self' else 1
+        slowest = sorted(modules.items(), key=lambda item: -item[1][column])[:options['limit']]
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in phases.items()},
+                'modules': [
+                    {'module': name, 'self_ms': own / 1000, 'cumulative_ms': cumulative / 1000}
+                    for name, (own, cumulative) in slowest
+                ],
+            }, indent=2))
+            return
+
+        for phase, seconds in phases.items():
+            self.stdout.write(f"{phase:<20} {seconds * 1000:>9.1f} ms")
+        self.stdout.write('')
+        self.stdout.write(f"{'self ms':>9} {'cumul ms':>9}  module")
+        for name, (own, cumulative) in slowest:
+            self.stdout.write(f"{own / 1000:>9.1f} {cumulative / 1000:>9.1f}  {name}")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from core.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete stored Idempotency-Key responses past their TTL"
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Purged {purge_expired()} expired idempotency records")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Organization, OrganizationCapacity
+
+
+def snapshot(capacity):
+    return [getattr(capacity, field.attname) for field in capacity._meta.fields if field.name != 'updated_at']
+
+
+class Command(BaseCommand):
+    help = "Recompute organization capacity rollups from clusters and resource usage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('organization_ids', nargs='*', type=int,
+                            help="Only rebuild these organizations (default: all)")
+
+    def handle(self, *args, **options):
+        organizations = Organization.objects.all()
+        if options['organization_ids']:
+            organizations = organizations.filter(id__in=options['organization_ids'])
+        for organization in organizations.iterator():
+            capacity, _ = OrganizationCapacity.objects.get_or_create(organization=organization)
+            before = snapshot(capacity)
+            capacity.rebuild()
+            if before != snapshot(capacity):
+                self.stdout.write(self.style.WARNING(f"Corrected {organization.name}"))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {organizations.count()} organizations"))
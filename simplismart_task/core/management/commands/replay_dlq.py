@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.dlq import dead_letter_replayer
+
+
+class Command(BaseCommand):
+    help = "Inspect or replay dead-lettered deployment messages back onto the deployments exchange"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inspect', action='store_true',
+                            help="Summarise the dead-letter queue without changing it")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report what would be replayed without republishing anything")
+        parser.add_argument('--rate', type=float, default=500,
+                            help="Maximum messages processed per second (0 for unlimited)")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--limit', type=int, default=None,
+                            help="Stop after visiting this many messages")
+        parser.add_argument('--cluster', type=int, action='append', dest='clusters',
+                            help="Only replay messages for this cluster (repeatable)")
+        parser.add_argument('--deployment', type=int, action='append', dest='deployment_ids',
+                            help="Only replay messages for this deployment (repeatable)")
+        parser.add_argument('--reason', action='append', dest='reasons',
+                            choices=['expired', 'rejected', 'maxlen', 'delivery_limit'],
+                            help="Only replay messages dead-lettered for this reason (repeatable)")
+
+    def handle(self, *args, **options):
+        replayer = dead_letter_replayer(
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+            clusters=options['clusters'],
+            deployment_ids=options['deployment_ids'],
+            reasons=options['reasons'],
+            limit=options['limit'],
+            dry_run=options['dry_run'],
+            on_batch=self.report_progress
+        )
+        if options['inspect']:
+            summary = replayer.inspect(sample=options['limit'] or 1000)
+            self.stdout.write(json.dumps(summary, indent=2, default=str))
+            return
+        stats = replayer.replay()
+        self.stdout.write(self.style.SUCCESS(json.dumps(stats)))
+
+    def report_progress(self, stats, total):
+        self.stdout.write(
+            f"{stats.get('visited', 0)}/{total} visited, "
+            f"{stats.get('replayed', 0)} replayed, "
+            f"{stats.get('superseded', 0)} superseded, "
+            f"{stats.get('kept', 0)} kept"
+        )
@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.leases import sweep_expired_leases
+
+
+class Command(BaseCommand):
+    help = "Reclaim resource usage whose lease has expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.RESOURCE_LEASES['SWEEP_BATCH_SIZE'],
+                            help="Rows reclaimed per transaction")
+        parser.add_argument('--interval', type=float, default=settings.RESOURCE_LEASES['SWEEP_INTERVAL'],
+                            help="Seconds between sweeps")
+        parser.add_argument('--once', action='store_true', help="Sweep once and exit")
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                reclaimed, released = sweep_expired_leases(options['batch_size'])
+                if reclaimed or options['once']:
+                    self.stdout.write(
+                        f"Reclaimed {reclaimed} leases ({released['cpu']} CPU, "
+                        f"{released['ram']} GB RAM, {released['gpu']} GPU)"
+                    )
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
@@ -0,0 +1,47 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.tracing import breakdown, load_traces
+
+
+class Command(BaseCommand):
+    help = "Show the latency breakdown of traced deployments across the API and the consumer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help="Span files to combine (default: TRACING['EXPORT_PATH'])")
+        parser.add_argument('--deployment', type=int, action='append', dest='deployment_ids',
+                            help="Only show traces for this deployment (repeatable)")
+        parser.add_argument('--trace', action='append', dest='trace_ids',
+                            help="Only show this trace id (repeatable)")
+        parser.add_argument('--limit', type=int, default=20,
+                            help="Show the most recent N matching traces")
+        parser.add_argument('--json', action='store_true', help="Print JSON instead of a table")
+
+    def handle(self, *args, **options):
+        traces = load_traces(options['paths'] or [settings.TRACING['EXPORT_PATH']])
+        reports = []
+        for trace_id, spans in traces.items():
+            report = breakdown(spans)
+            if options['trace_ids'] and trace_id not in options['trace_ids']:
+                continue
+            if options['deployment_ids'] and not set(options['deployment_ids']) & set(report['deployment_ids']):
+                continue
+            reports.append(report)
+        reports.sort(key=lambda report: traces[report['trace_id']][0]['start'])
+        reports = reports[-options['limit']:]
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+        for report in reports:
+            deployments = ', '.join(str(deployment_id) for deployment_id in report['deployment_ids']) or '-'
+            self.stdout.write(f"trace {report['trace_id']}  deployment {deployments}  total {report['total_ms']:.1f} ms")
+            for span in report['spans']:
+                events = f"  [{', '.join(span['events'])}]" if span['events'] else ''
+                self.stdout.write(
+                    f"  {span['offset_ms']:>10.1f} ms  {span['duration_ms']:>10.1f} ms  "
+                    f"{span['service']}/{span['name']}{events}"
+                )
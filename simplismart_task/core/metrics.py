@@ -0,0 +1,75 @@
+import os
+
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every worker
+# writes its samples to memory-mapped files there and the metrics view
+# aggregates them, so a scrape sees all workers whichever one serves it.
+
+REQUEST_LATENCY = Histogram(
+    'django_http_request_duration_seconds',
+    'Time spent handling a request',
+    ['view', 'method', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    'django_http_request_db_queries',
+    'Database queries executed per request',
+    ['view'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 250),
+)
+REQUEST_QUERY_TIME = Histogram(
+    'django_http_request_db_duration_seconds',
+    'Time spent in the database per request',
+    ['view'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+PUBLISH_ATTEMPTS = Counter(
+    'deployment_publish_total',
+    'Deployment publishes by outcome',
+    ['transport', 'outcome'],
+)
+PUBLISH_RETRIES = Counter(
+    'deployment_publish_retries_total',
+    'Deployment publish attempts that were retried',
+    ['transport'],
+)
+PUBLISH_LATENCY = Histogram(
+    'deployment_publish_duration_seconds',
+    'Time spent publishing a deployment, retries included',
+    ['transport'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 2.5, 5),
+)
+
+
+def record_request(view, method, status, duration, queries, query_time):
+    REQUEST_LATENCY.labels(view, method, status).observe(duration)
+    REQUEST_QUERIES.labels(view).observe(queries)
+    REQUEST_QUERY_TIME.labels(view).observe(query_time)
+
+
+def record_publish(transport, published, duration):
+    PUBLISH_ATTEMPTS.labels(transport, 'success' if published else 'failure').inc()
+    PUBLISH_LATENCY.labels(transport).observe(duration)
+
+
+def record_publish_retry(transport):
+    PUBLISH_RETRIES.labels(transport).inc()
+
+
+def metrics_view(request):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,179 @@
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .metrics import record_request
+from .tracing import start_span
+
+
+sql_logger = logging.getLogger('core.sql')
+
+IN_LIST = re.compile(r'\bIN \((?:%s|\?)(?:, (?:%s|\?))*\)')
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    # Statements that differ only in parameters, literals or the length of
+    # an IN list collapse to the same pattern.
+    sql = WHITESPACE.sub(' ', sql).strip()
+    sql = LITERAL.sub('?', sql)
+    return IN_LIST.sub('IN (...)', sql)
+
+
+class QueryRecorder:
+    """``execute_wrapper`` hook counting queries and time spent in them.
+
+    With ``keep_statements`` every statement is also kept as
+    ``(sql, params, seconds)`` for later breakdown.
+    """
+
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = [] if keep_statements else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+            if self.statements is not None:
+                self.statements.append((sql, params, elapsed))
+
+    def patterns(self):
+        grouped = defaultdict(lambda: {'count': 0, 'time_ms': 0.0, 'params': defaultdict(int)})
+        for sql, params, elapsed in self.statements:
+            pattern = grouped[normalize_sql(sql)]
+            pattern['count'] += 1
+            pattern['time_ms'] += elapsed * 1000
+            pattern['params'][repr(params)] += 1
+        return [
+            {
+                'sql': sql,
+                'count': pattern['count'],
+                'time_ms': round(pattern['time_ms'], 3),
+                # Same statement with the same parameters.
+                'duplicates': pattern['count'] - len(pattern['params']),
+                'distinct_params': len(pattern['params']),
+            }
+            for sql, pattern in sorted(grouped.items(), key=lambda item: -item[1]['time_ms'])
+        ]
+
+
+def view_label(request):
+    # Label by resolved view name rather than path so ids in URLs do not
+    # create a new time series per object.
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        record_request(
+            view_label(request),
+            request.method,
+            response.status_code,
+            time.perf_counter() - started,
+            recorder.count,
+            recorder.duration
+        )
+        return response
+
+
+class SQLInspectorMiddleware:
+    """Opt-in per-request SQL breakdown, enabled by ``SQL_INSTRUMENTATION``.
+
+    Adds ``X-DB-Queries`` and ``X-DB-Time`` (ms) to every response. A
+    statement pattern run ``REPEAT_THRESHOLD`` times or more with different
+    parameters is flagged as a likely N+1, and any exact repeat as a
+    duplicate. Requests slower than ``SLOW_REQUEST_MS`` or with a flagged
+    pattern are written with their breakdown to the ``core.sql`` logger,
+    which settings route to a rotating file.
+    """
+
+    def __init__(self, get_response):
+        self.config = settings.SQL_INSTRUMENTATION
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder(keep_statements=True)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        duration_ms = (time.perf_counter() - started) * 1000
+        response['X-DB-Queries'] = str(recorder.count)
+        response['X-DB-Time'] = f"{recorder.duration * 1000:.2f}"
+
+        patterns = recorder.patterns()
+        n_plus_one = [
+            pattern for pattern in patterns
+            if pattern['distinct_params'] >= self.config['REPEAT_THRESHOLD']
+        ]
+        duplicates = [pattern for pattern in patterns if pattern['duplicates']]
+        if duration_ms >= self.config['SLOW_REQUEST_MS'] or n_plus_one or duplicates:
+            sql_logger.warning(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': view_label(request),
+                'status': response.status_code,
+                'duration_ms': round(duration_ms, 2),
+                'queries': recorder.count,
+                'db_ms': round(recorder.duration * 1000, 2),
+                'n_plus_one': [pattern['sql'] for pattern in n_plus_one],
+                'duplicates': [pattern['sql'] for pattern in duplicates],
+                'patterns': patterns[:self.config['MAX_PATTERNS']],
+            }))
+        return response
+
+
+class TracingMiddleware:
+    """Opens the root span of each request when ``TRACING`` is enabled.
+
+    An incoming W3C ``traceparent`` header is continued, so a caller's trace
+    extends through the API, the publish and on into the consumer. The trace
+    id is returned in ``X-Trace-Id``.
+    """
+
+    def __init__(self, get_response):
+        if not settings.TRACING['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with start_span(
+            'http.request',
+            traceparent=request.headers.get('traceparent'),
+            method=request.method,
+            path=request.path
+        ) as span:
+            response = self.get_response(request)
+            span.set_attribute('view', view_label(request))
+            span.set_attribute('status', response.status_code)
+        response['X-Trace-Id'] = span.trace_id
+        return response
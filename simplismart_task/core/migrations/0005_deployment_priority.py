@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 04:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_organization_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deployment',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Low'), (1, 'Normal'), (2, 'High'), (3, 'Urgent')], default=1, help_text='Delivery priority on the deployments queue'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:11
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def backfill_capacity(apps, schema_editor):
+    Organization = apps.get_model('core', 'Organization')
+    OrganizationCapacity = apps.get_model('core', 'OrganizationCapacity')
+    OrganizationMembership = apps.get_model('core', 'OrganizationMembership')
+    Cluster = apps.get_model('core', 'Cluster')
+    ResourceUsage = apps.get_model('core', 'ResourceUsage')
+    for organization in Organization.objects.all():
+        members = OrganizationMembership.objects.filter(organization=organization).values('user_id')
+        clusters = Cluster.objects.filter(owner_id__in=members)
+        totals = clusters.aggregate(
+            cluster_count=Count('id'),
+            total_cpu=Sum('total_cpu'),
+            total_ram=Sum('total_ram'),
+            total_gpu=Sum('total_gpu')
+        )
+        totals.update(ResourceUsage.objects.filter(cluster__in=clusters).aggregate(
+            used_cpu=Sum('used_cpu'),
+            used_ram=Sum('used_ram'),
+            used_gpu=Sum('used_gpu')
+        ))
+        OrganizationCapacity.objects.create(
+            organization=organization,
+            member_count=members.count(),
+            **{field: value or 0 for field, value in totals.items()}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_deployment_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrganizationCapacity',
+            fields=[
+                ('organization', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='capacity', serialize=False, to='core.organization')),
+                ('member_count', models.IntegerField(default=0)),
+                ('cluster_count', models.IntegerField(default=0)),
+                ('total_cpu', models.BigIntegerField(default=0)),
+                ('total_ram', models.BigIntegerField(default=0)),
+                ('total_gpu', models.BigIntegerField(default=0)),
+                ('used_cpu', models.BigIntegerField(default=0)),
+                ('used_ram', models.BigIntegerField(default=0)),
+                ('used_gpu', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_capacity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_usage(apps, schema_editor):
+    # Usage used to be matched to its deployment by cluster and amounts (see
+    # DeploymentViewSet.perform_update); link each deployment to the oldest
+    # unlinked row that matches.
+    Deployment = apps.get_model('core', 'Deployment')
+    ResourceUsage = apps.get_model('core', 'ResourceUsage')
+    for deployment in Deployment.objects.order_by('created_at').iterator():
+        usage = ResourceUsage.objects.filter(
+            deployment__isnull=True,
+            cluster_id=deployment.cluster_id,
+            used_cpu=deployment.required_cpu,
+            used_ram=deployment.required_ram,
+            used_gpu=deployment.required_gpu
+        ).order_by('created_at').first()
+        if usage is not None:
+            usage.deployment = deployment
+            usage.save(update_fields=['deployment'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_organizationcapacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resourceusage',
+            name='deployment',
+            field=models.ForeignKey(blank=True, help_text='Deployment this usage was reserved for, if any', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='resource_usages', to='core.deployment'),
+        ),
+        migrations.RunPython(link_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_resourceusage_deployment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resourceusage',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, help_text='When the lease lapses and the sweeper reclaims this usage', null=True),
+        ),
+        migrations.AddField(
+            model_name='resourceusage',
+            name='lease_seconds',
+            field=models.PositiveIntegerField(blank=True, help_text='Lease length renewed by each heartbeat; empty for permanent usage', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='resourceusage',
+            index=models.Index(condition=models.Q(('lease_expires_at__isnull', False)), fields=['lease_expires_at'], name='resourceusage_lease_expiry'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-19 05:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_resourceusage_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organizationcapacity',
+            name='quota_cpu',
+            field=models.BigIntegerField(blank=True, help_text='CPU cores the members may use; empty for no limit', null=True),
+        ),
+        migrations.AddField(
+            model_name='organizationcapacity',
+            name='quota_gpu',
+            field=models.BigIntegerField(blank=True, help_text='GPU units the members may use; empty for no limit', null=True),
+        ),
+        migrations.AddField(
+            model_name='organizationcapacity',
+            name='quota_ram',
+            field=models.BigIntegerField(blank=True, help_text='GB of RAM the members may use; empty for no limit', null=True),
+        ),
+    ]
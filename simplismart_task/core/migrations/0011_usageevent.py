@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-19 06:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def seed_events(apps, schema_editor):
+    # Allocations released before this migration left no trace; start the
+    # history from the usage that is still held.
+    ResourceUsage = apps.get_model('core', 'ResourceUsage')
+    UsageEvent = apps.get_model('core', 'UsageEvent')
+    rows = ResourceUsage.objects.values_list('cluster_id', 'used_cpu', 'used_ram', 'used_gpu', 'created_at')
+    UsageEvent.objects.bulk_create(
+        (
+            UsageEvent(cluster_id=cluster_id, used_cpu=cpu, used_ram=ram, used_gpu=gpu, created_at=created_at)
+            for cluster_id, cpu, ram, gpu, created_at in rows.iterator()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('used_cpu', models.IntegerField(default=0)),
+                ('used_ram', models.IntegerField(default=0)),
+                ('used_gpu', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('cluster', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_events', to='core.cluster')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['cluster', 'created_at'], name='usageevent_cluster_time')],
+            },
+        ),
+        migrations.RunPython(seed_events, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Q, Sum
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 
 class User(AbstractUser):
     email = models.EmailField(_('email address'), unique=True)
@@ -121,6 +124,14 @@ class Cluster(models.Model):
 
 class ResourceUsage(models.Model):
     cluster = models.ForeignKey(Cluster, on_delete=models.CASCADE, related_name='resource_usage')
+    deployment = models.ForeignKey(
+        'Deployment',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='resource_usages',
+        help_text="Deployment this usage was reserved for, if any"
+    )
     
     used_cpu = models.IntegerField(
         default=0,
@@ -137,6 +148,16 @@ class ResourceUsage(models.Model):
         validators=[MinValueValidator(0)],
         help_text="Number of GPU units used"
     )
+    lease_seconds = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Lease length renewed by each heartbeat; empty for permanent usage"
+    )
+    lease_expires_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the lease lapses and the sweeper reclaims this usage"
+    )
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -146,6 +167,15 @@ class ResourceUsage(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Partial, so permanent usage rows never enter the index and the
+            # sweeper only reads expired leases.
+            models.Index(
+                fields=['lease_expires_at'],
+                name='resourceusage_lease_expiry',
+                condition=models.Q(lease_expires_at__isnull=False)
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if self.used_cpu > self.cluster.available_cpu:
@@ -154,7 +184,31 @@ class ResourceUsage(models.Model):
             raise ValueError(f"Cannot use {self.used_ram} GB RAM. Only {self.cluster.available_ram} available.")
         if self.used_gpu > self.cluster.available_gpu:
             raise ValueError(f"Cannot use {self.used_gpu} GPU units. Only {self.cluster.available_gpu} available.")
-        super().save(*args, **kwargs)
+        # Organization quotas are reserved by the post_save handler, which
+        # raises QuotaExceeded to roll the insert back.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+class UsageEvent(models.Model):
+    """A change in a cluster's usage: positive when allocated, negative when released.
+
+    Written whenever usage rows are created, resized or released, so
+    capacity analytics can replay usage over time after the allocations
+    themselves are gone.
+    """
+    cluster = models.ForeignKey(Cluster, on_delete=models.CASCADE, related_name='usage_events')
+    used_cpu = models.IntegerField(default=0)
+    used_ram = models.IntegerField(default=0)
+    used_gpu = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cluster', 'created_at'], name='usageevent_cluster_time'),
+        ]
+
+    def __str__(self):
+        return f"Usage change for cluster {self.cluster_id} at {self.created_at}"
 
 class Deployment(models.Model):
     name = models.CharField(max_length=255)
@@ -173,6 +227,16 @@ class Deployment(models.Model):
         ],
         default='pending'
     )
+    priority = models.PositiveSmallIntegerField(
+        choices=[
+            (0, 'Low'),
+            (1, 'Normal'),
+            (2, 'High'),
+            (3, 'Urgent')
+        ],
+        default=1,
+        help_text="Delivery priority on the deployments queue"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -225,4 +289,157 @@ class OrganizationMembership(models.Model):
         ordering = ['-joined_at']
 
     def __str__(self):
-        return f"{self.user.email} - {self.organization.name} ({self.role})" 
\ No newline at end of file
+        return f"{self.user.email} - {self.organization.name} ({self.role})" 
+
+class QuotaExceeded(ValueError):
+    pass
+
+class OrganizationCapacity(models.Model):
+    """Running capacity totals over every cluster owned by an organization's members.
+
+    Kept current by the handlers in ``core.signals`` as clusters, resource
+    usage and memberships change, so reading it is a single row lookup.
+    ``rebuild`` recomputes it from scratch.
+    """
+    organization = models.OneToOneField(
+        Organization,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='capacity'
+    )
+    member_count = models.IntegerField(default=0)
+    cluster_count = models.IntegerField(default=0)
+    total_cpu = models.BigIntegerField(default=0)
+    total_ram = models.BigIntegerField(default=0)
+    total_gpu = models.BigIntegerField(default=0)
+    used_cpu = models.BigIntegerField(default=0)
+    used_ram = models.BigIntegerField(default=0)
+    used_gpu = models.BigIntegerField(default=0)
+    quota_cpu = models.BigIntegerField(null=True, blank=True, help_text="CPU cores the members may use; empty for no limit")
+    quota_ram = models.BigIntegerField(null=True, blank=True, help_text="GB of RAM the members may use; empty for no limit")
+    quota_gpu = models.BigIntegerField(null=True, blank=True, help_text="GPU units the members may use; empty for no limit")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def available_cpu(self):
+        return self.total_cpu - self.used_cpu
+
+    @property
+    def available_ram(self):
+        return self.total_ram - self.used_ram
+
+    @property
+    def available_gpu(self):
+        return self.total_gpu - self.used_gpu
+
+    def __str__(self):
+        return f"Capacity of {self.organization.name}"
+
+    @classmethod
+    def adjust(cls, organization_ids, **deltas):
+        """Add ``deltas`` to the rows of ``organization_ids`` in one UPDATE.
+
+        ``organization_ids`` may be a list or a ``values('organization_id')``
+        subquery.
+        """
+        changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if changes:
+            cls.objects.filter(organization_id__in=organization_ids).update(
+                updated_at=timezone.now(),
+                **changes
+            )
+
+    @classmethod
+    def reserve(cls, organization_ids, **deltas):
+        """``adjust``, refused unless every organization stays within its quotas.
+
+        The quota check is part of the UPDATE's WHERE clause, so concurrent
+        allocations cannot both pass it on a stale read. Raises
+        ``QuotaExceeded`` when any organization would go over; run it inside
+        a transaction so rows already updated are rolled back.
+        """
+        ids = list(cls.objects.filter(organization_id__in=organization_ids).values_list('organization_id', flat=True))
+        within = Q()
+        for field, delta in deltas.items():
+            if delta > 0 and field.startswith('used_'):
+                quota = field.replace('used_', 'quota_')
+                within &= Q(**{f'{quota}__isnull': True}) | Q(**{f'{quota}__gte': F(field) + delta})
+        changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if not ids or not changes:
+            return
+        updated = cls.objects.filter(within, organization_id__in=ids).update(updated_at=timezone.now(), **changes)
+        if updated < len(ids):
+            raise QuotaExceeded(cls.describe_excess(ids, deltas))
+
+    @classmethod
+    def describe_excess(cls, organization_ids, deltas):
+        for capacity in cls.objects.filter(organization_id__in=organization_ids).select_related('organization'):
+            for resource in ('cpu', 'ram', 'gpu'):
+                quota = getattr(capacity, f'quota_{resource}')
+                used = getattr(capacity, f'used_{resource}')
+                requested = deltas.get(f'used_{resource}', 0)
+                if quota is not None and requested > 0 and used + requested > quota:
+                    return (
+                        f"Organization '{capacity.organization.name}' {resource.upper()} quota exceeded: "
+                        f"{used} of {quota} in use, {requested} requested."
+                    )
+        return "Organization quota exceeded."
+
+    @staticmethod
+    def user_capacity(user_id):
+        """What the clusters owned by ``user_id`` add to each of their organizations."""
+        clusters = Cluster.objects.filter(owner_id=user_id)
+        capacity = clusters.aggregate(
+            cluster_count=Count('id'),
+            total_cpu=Sum('total_cpu'),
+            total_ram=Sum('total_ram'),
+            total_gpu=Sum('total_gpu')
+        )
+        capacity.update(ResourceUsage.objects.filter(cluster__owner_id=user_id).aggregate(
+            used_cpu=Sum('used_cpu'),
+            used_ram=Sum('used_ram'),
+            used_gpu=Sum('used_gpu')
+        ))
+        return {field: value or 0 for field, value in capacity.items()}
+
+    def rebuild(self):
+        members = OrganizationMembership.objects.filter(organization_id=self.organization_id).values('user_id')
+        self.member_count = members.count()
+        clusters = Cluster.objects.filter(owner_id__in=members)
+        totals = clusters.aggregate(
+            cluster_count=Count('id'),
+            total_cpu=Sum('total_cpu'),
+            total_ram=Sum('total_ram'),
+            total_gpu=Sum('total_gpu')
+        )
+        totals.update(ResourceUsage.objects.filter(cluster__in=clusters).aggregate(
+            used_cpu=Sum('used_cpu'),
+            used_ram=Sum('used_ram'),
+            used_gpu=Sum('used_gpu')
+        ))
+        for field, value in totals.items():
+            setattr(self, field, value or 0)
+        self.save()
+
+class IdempotencyRecord(models.Model):
+    """The first response to a POST sent with an ``Idempotency-Key`` header.
+
+    ``status_code`` is empty while that first request is still running.
+    Records are ignored after ``expires_at`` and purged by
+    ``manage.py purge_idempotency_keys``.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_records')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64, help_text="SHA-256 of the method, path and body")
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.user.email})"
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+import drf_yasg
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_cache_control
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+from drf_yasg.generators import OpenAPISchemaGenerator
+
+logger = logging.getLogger(__name__)
+
+API_INFO = openapi.Info(
+    title="SimpliSmart API",
+    default_version='v1',
+    description="API for SimpliSmart Task Management",
+    terms_of_service="https://www.google.com/policies/terms/",
+    contact=openapi.Contact(email="contact@simplismart.local"),
+    license=openapi.License(name="BSD License"),
+)
+
+FORMATS = {
+    'json': ('application/json', OpenAPICodecJson),
+    'yaml': ('application/yaml', OpenAPICodecYaml),
+}
+
+lock = threading.Lock()
+loaded = {}
+
+
+def source_files():
+    # Everything the generator reads from: views, serializers, urls and
+    # settings. Migrations and tests never change the schema.
+    for path in sorted(Path(settings.BASE_DIR).rglob('*.py')):
+        if 'migrations' not in path.parts and path.name != 'tests.py':
+            yield path
+
+
+def schema_fingerprint():
+    digest = hashlib.sha256(drf_yasg.__version__.encode())
+    for path in source_files():
+        digest.update(str(path.relative_to(settings.BASE_DIR)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def artifact_path(fingerprint, fmt):
+    return Path(settings.OPENAPI_SCHEMA['DIR']) / f'schema-{fingerprint}.{fmt}'
+
+
+def manifest_path():
+    return Path(settings.OPENAPI_SCHEMA['DIR']) / 'current'
+
+
+def built_fingerprint():
+    """Fingerprint of the artifact last built, or ``None`` before any build."""
+    try:
+        return manifest_path().read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def build_schema(fingerprint=None):
+    """Generate the schema and write it as ``schema-<fingerprint>.{json,yaml}``.
+
+    The ``current`` manifest is pointed at the new artifact before artifacts
+    left over from older code are removed. Returns the fingerprint.
+    """
+    fingerprint = fingerprint or schema_fingerprint()
+    schema = OpenAPISchemaGenerator(API_INFO).get_schema(request=None, public=True)
+    directory = Path(settings.OPENAPI_SCHEMA['DIR'])
+    directory.mkdir(parents=True, exist_ok=True)
+    for fmt, (_, codec) in FORMATS.items():
+        write_atomic(artifact_path(fingerprint, fmt), codec(validators=[]).encode(schema))
+    write_atomic(manifest_path(), fingerprint.encode())
+    for stale in directory.glob('schema-*.*'):
+        if not stale.name.startswith(f'schema-{fingerprint}.'):
+            stale.unlink()
+    logger.info(f"Built OpenAPI schema {fingerprint}")
+    return fingerprint
+
+
+def write_atomic(path, content):
+    # Write then rename so a concurrent reader never sees half a file.
+    partial = path.with_name(f'{path.name}.tmp')
+    partial.write_bytes(content)
+    partial.replace(path)
+
+
+def load_schema():
+    """Return ``{'fingerprint', 'json', 'yaml'}`` for the built artifact, or ``None``.
+
+    Nothing is generated or hashed here: the artifact is built by
+    ``manage.py build_openapi`` in the image build and again by gunicorn's
+    ``on_starting`` when the code has changed since. It is read once per
+    process.
+    """
+    with lock:
+        if not loaded:
+            fingerprint = built_fingerprint()
+            if fingerprint is None:
+                return None
+            try:
+                schema = {fmt: artifact_path(fingerprint, fmt).read_bytes() for fmt in FORMATS}
+            except FileNotFoundError:
+                return None
+            loaded.update(schema, fingerprint=fingerprint)
+        return loaded
+
+
+def schema_response(request, fmt):
+    schema = load_schema()
+    if schema is None:
+        logger.error("OpenAPI schema requested before it was built")
+        return JsonResponse(
+            {'error': 'OpenAPI schema is not built, run `python manage.py build_openapi`'},
+            status=503
+        )
+    etag = f'"{schema["fingerprint"]}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        content_type, _ = FORMATS[fmt]
+        response = HttpResponse(schema[fmt], content_type=content_type)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.OPENAPI_SCHEMA['MAX_AGE'])
+    return response
+
+
+def schema_json(request):
+    return schema_response(request, 'json')
+
+
+def schema_yaml(request):
+    return schema_response(request, 'yaml')
@@ -1,57 +1,158 @@
 import pika
 import json
 from django.conf import settings
+from django.core.cache import cache
 import logging
+import os
+from abc import ABC, abstractmethod
+import threading
 import time
 
+from common.queues import (
+    EXCHANGE,
+    MAX_PRIORITY,
+    QUEUE_ARGUMENTS,
+    get_connection_parameters,
+    incompatible_declaration,
+    shard_for_cluster,
+    shard_queue,
+    shard_routing_key,
+)
+from common.versions import parse_version
+
+from .metrics import record_publish, record_publish_retry
+from .tracing import add_event, current_span, start_span
+
 logger = logging.getLogger(__name__)
 
-class RabbitMQPublisher:
+QUEUE_STATS_CACHE_KEY = 'rabbitmq:deployments:queue-stats'
+
+def deployment_message(deployment_data, shards):
+    shard = shard_for_cluster(deployment_data.get('cluster'), shards)
+    headers = {
+        'deployment_id': deployment_data.get('id'),
+        'version': parse_version(deployment_data.get('updated_at')),
+        'published_at': time.time(),
+    }
+    span = current_span()
+    if span is not None:
+        headers['traceparent'] = span.traceparent
+    return {
+        'routing_key': shard_routing_key(shard),
+        'body': json.dumps(deployment_data),
+        'priority': min(int(deployment_data.get('priority') or 0), MAX_PRIORITY),
+        'headers': headers,
+    }
+
+class DeploymentPublisher(ABC):
+    """Interface the views and throttles use to hand deployments over.
+
+    Implementations send with ``send_deployment`` (returning whether it
+    succeeded; ``publish_deployment`` wraps it with metrics and a trace
+    span, and ``record_retry`` marks retries on both) and report
+    backlog through ``sample_queue_stats`` as ``{'depth', 'consumers',
+    'shards'}``, or ``None`` when unreachable.
+    """
+
+    transport = None
+
+    def __init__(self):
+        self.shards = settings.DEPLOYMENT_SHARDS
+
+    def publish_deployment(self, deployment_data):
+        with start_span(
+            'deployment.publish',
+            deployment_id=deployment_data.get('id'),
+            cluster=deployment_data.get('cluster'),
+            transport=self.transport
+        ) as span:
+            started = time.perf_counter()
+            published = self.send_deployment(deployment_data)
+            record_publish(self.transport, published, time.perf_counter() - started)
+            if span is not None:
+                span.set_attribute('published', published)
+        return published
+
+    def publish_deployments(self, deployments):
+        """Publish ``deployments`` in order, stopping at the first failure.
+
+        A broker that is down costs one retry budget for the whole batch
+        rather than one per deployment. Returns how many were published.
+        """
+        for published, deployment_data in enumerate(deployments):
+            if not self.publish_deployment(deployment_data):
+                logger.error(
+                    f"Gave up publishing {len(deployments) - published} deployments "
+                    f"after deployment {deployment_data.get('id')} failed"
+                )
+                return published
+        return len(deployments)
+
+    def record_retry(self, attempt, error):
+        record_publish_retry(self.transport)
+        add_event('retry', attempt=attempt, error=str(error))
+
+    @abstractmethod
+    def send_deployment(self, deployment_data):
+        ...
+
+    def queue_stats(self):
+        # Sampled at most once per SAMPLE_TTL across all workers sharing the
+        # cache; an unreachable broker is cached too so it is not retried on
+        # every request.
+        stats = cache.get(QUEUE_STATS_CACHE_KEY)
+        if stats is None:
+            stats = self.sample_queue_stats() or {}
+            cache.set(QUEUE_STATS_CACHE_KEY, stats, settings.DEPLOYMENT_BACKPRESSURE['SAMPLE_TTL'])
+        return stats
+
+    @abstractmethod
+    def sample_queue_stats(self):
+        ...
+
+    def connect_in_background(self):
+        """Start connecting without blocking the caller, e.g. after a fork."""
+
+    @abstractmethod
+    def close(self):
+        ...
+
+class RabbitMQPublisher(DeploymentPublisher):
+    transport = 'amqp'
+
     def __init__(self):
+        super().__init__()
+        # Nothing is opened here: the module is imported by every worker,
+        # management command and test run, and connecting blocks for up to
+        # connection_attempts * retry_delay when the broker is down.
         self.connection = None
         self.channel = None
-        self.setup_connection()
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+        self.connector = None
 
     def setup_connection(self):
         try:
             if self.connection and self.connection.is_open:
                 self.connection.close()
             
-            self.connection = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host='localhost',
-                    port=5672,
-                    virtual_host='/',
-                    credentials=pika.PlainCredentials('guest', 'guest'),
-                    connection_attempts=5,
-                    retry_delay=1,
-                    socket_timeout=5,
-                    heartbeat=60,
-                    blocked_connection_timeout=30
-                )
-            )
+            self.connection = pika.BlockingConnection(get_connection_parameters())
             self.channel = self.connection.channel()
             
             self.channel.exchange_declare(
-                exchange='deployments',
+                exchange=EXCHANGE,
                 exchange_type='direct',
                 durable=True
             )
             
-            self.channel.queue_declare(
-                queue='deployments',
-                durable=True,
-                arguments={
-                    'x-message-ttl': 60000,
-                    'x-dead-letter-exchange': 'deployments.dlx'
-                }
-            )
-            
-            self.channel.queue_bind(
-                exchange='deployments',
-                queue='deployments',
-                routing_key='deployment'
-            )
+            for shard in range(self.shards):
+                self.declare_queue(shard_queue(shard))
+                
+                self.channel.queue_bind(
+                    exchange=EXCHANGE,
+                    queue=shard_queue(shard),
+                    routing_key=shard_routing_key(shard)
+                )
             
             logger.info("RabbitMQ connection established successfully")
             return True
@@ -59,43 +160,88 @@ class RabbitMQPublisher:
             logger.error(f"Failed to setup RabbitMQ connection: {str(e)}")
             return False
 
+    def declare_queue(self, queue):
+        try:
+            self.channel.queue_declare(queue=queue, durable=True, arguments=QUEUE_ARGUMENTS)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 406:
+                raise
+            # The queue predates the current arguments (e.g. no priority
+            # support); keep publishing to it rather than failing every call.
+            logger.warning(incompatible_declaration('queue', queue, e.reply_text))
+            self.channel = self.connection.channel()
+            self.channel.queue_declare(queue=queue, passive=True)
+
     def ensure_connection(self):
-        if not self.connection or not self.connection.is_open:
-            logger.warning("RabbitMQ connection lost. Attempting to reconnect...")
-            return self.setup_connection()
-        return True
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked after connecting (gunicorn --preload): the socket is
+                # the parent's, so drop it without closing and open our own.
+                self.connection = None
+                self.channel = None
+                self.pid = os.getpid()
+            if self.connection is None:
+                return self.setup_connection()
+            if not self.connection.is_open:
+                logger.warning("RabbitMQ connection lost. Attempting to reconnect...")
+                return self.setup_connection()
+            return True
 
-    def publish_deployment(self, deployment_data):
+    def is_connected(self):
+        with self.lock:
+            return (self.pid == os.getpid() and self.connection is not None
+                    and self.connection.is_open)
+
+    def connect_in_background(self):
+        with self.lock:
+            if self.connector is not None and self.connector.is_alive():
+                return
+            self.connector = threading.Thread(
+                target=self.ensure_connection, name='rabbitmq-connect', daemon=True
+            )
+            self.connector.start()
+
+    def send_deployment(self, deployment_data):
         max_retries = 3
         retry_delay = 2
         
         for attempt in range(max_retries):
             try:
-                if not self.ensure_connection():
+                # The channel is shared with background publishes (see
+                # core.deployments), and pika channels are not thread-safe.
+                with self.lock:
+                    connected = self.ensure_connection()
+                    if connected:
+                        message = deployment_message(deployment_data, self.shards)
+                        self.channel.basic_publish(
+                            exchange=EXCHANGE,
+                            routing_key=message['routing_key'],
+                            body=message['body'],
+                            properties=pika.BasicProperties(
+                                delivery_mode=2,
+                                priority=message['priority'],
+                                headers=message['headers'],
+                            )
+                        )
+                if not connected:
                     if attempt < max_retries - 1:
+                        self.record_retry(attempt + 1, 'connection unavailable')
                         time.sleep(retry_delay)
                         continue
                     return False
-                
-                self.channel.basic_publish(
-                    exchange='deployments',
-                    routing_key='deployment',
-                    body=json.dumps(deployment_data),
-                    properties=pika.BasicProperties(
-                        delivery_mode=2,
-                    )
-                )
                 logger.info(f"Successfully published deployment: {deployment_data.get('id')}")
                 return True
             except pika.exceptions.AMQPChannelError as e:
                 logger.error(f"Channel error: {str(e)}")
                 if attempt < max_retries - 1:
+                    self.record_retry(attempt + 1, e)
                     time.sleep(retry_delay)
                     continue
                 return False
             except pika.exceptions.AMQPConnectionError as e:
                 logger.error(f"Connection error: {str(e)}")
                 if attempt < max_retries - 1:
+                    self.record_retry(attempt + 1, e)
                     time.sleep(retry_delay)
                     continue
                 return False
@@ -103,6 +249,37 @@ class RabbitMQPublisher:
                 logger.error(f"Error publishing to RabbitMQ: {str(e)}")
                 return False
 
+    def sample_queue_stats(self):
+        # Called from the throttle on the request path, so it never connects
+        # itself: that blocks for up to connection_attempts * retry_delay
+        # while the broker is down. Without a connection there is nothing to
+        # sample until the background connect finishes.
+        if not self.is_connected():
+            self.connect_in_background()
+            return None
+        try:
+            with self.lock:
+                if not self.channel or not self.channel.is_open:
+                    self.channel = self.connection.channel()
+                shards = []
+                for shard in range(self.shards):
+                    result = self.channel.queue_declare(queue=shard_queue(shard), passive=True)
+                    shards.append({
+                        'depth': result.method.message_count,
+                        'consumers': result.method.consumer_count,
+                    })
+            # Back-pressure follows the worst shard: one cluster's backlog
+            # is enough to push its deployments past the TTL.
+            return {
+                'depth': max(shard['depth'] for shard in shards),
+                'consumers': min(shard['consumers'] for shard in shards),
+                'shards': shards,
+                'sampled_at': time.time(),
+            }
+        except pika.exceptions.AMQPError as e:
+            logger.error(f"Failed to sample deployments queue: {str(e)}")
+            return None
+
     def close(self):
         try:
             if self.connection and self.connection.is_open:
@@ -110,5 +287,3 @@ class RabbitMQPublisher:
                 logger.info("RabbitMQ connection closed")
         except Exception as e:
             logger.error(f"Error closing RabbitMQ connection: {str(e)}")
-
-rabbitmq_publisher = RabbitMQPublisher() 
\ No newline at end of file
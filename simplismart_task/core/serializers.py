@@ -1,6 +1,8 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Cluster, ResourceUsage, Deployment, Organization
+from .leases import lease_expiry
+from .models import Cluster, ResourceUsage, Deployment, Organization, OrganizationCapacity
 
 User = get_user_model()
 
@@ -15,6 +17,41 @@ class OrganizationCreateSerializer(serializers.ModelSerializer):
         model = Organization
         fields = ['name', 'description']
 
+class OrganizationCapacitySerializer(serializers.ModelSerializer):
+    available_cpu = serializers.IntegerField(read_only=True)
+    available_ram = serializers.IntegerField(read_only=True)
+    available_gpu = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = OrganizationCapacity
+        fields = (
+            'organization', 'member_count', 'cluster_count',
+            'total_cpu', 'total_ram', 'total_gpu',
+            'used_cpu', 'used_ram', 'used_gpu',
+            'available_cpu', 'available_ram', 'available_gpu',
+            'updated_at'
+        )
+        read_only_fields = fields
+
+class OrganizationQuotaSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OrganizationCapacity
+        fields = ('quota_cpu', 'quota_ram', 'quota_gpu')
+        extra_kwargs = {field: {'min_value': 0} for field in fields}
+
+    def to_representation(self, instance):
+        resources = {}
+        for resource in ('cpu', 'ram', 'gpu'):
+            used = getattr(instance, f'used_{resource}')
+            quota = getattr(instance, f'quota_{resource}')
+            resources[resource] = {
+                'used': used,
+                'quota': quota,
+                'remaining': None if quota is None else quota - used,
+                'utilization': None if not quota else round(used / quota, 4),
+            }
+        return {'organization': instance.organization_id, **resources}
+
 class OrganizationInviteSerializer(serializers.Serializer):
     invite_code = serializers.CharField()
 
@@ -38,13 +75,34 @@ class UserSerializer(serializers.ModelSerializer):
 class ResourceUsageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ResourceUsage
-        fields = ('id', 'cluster', 'used_cpu', 'used_ram', 'used_gpu', 'created_at', 'updated_at')
-        read_only_fields = ('created_at', 'updated_at')
+        fields = ('id', 'cluster', 'used_cpu', 'used_ram', 'used_gpu',
+                  'lease_seconds', 'lease_expires_at', 'created_at', 'updated_at')
+        read_only_fields = ('lease_seconds', 'lease_expires_at', 'created_at', 'updated_at')
 
 class ResourceUsageCreateSerializer(serializers.ModelSerializer):
+    ttl = serializers.IntegerField(
+        required=False,
+        write_only=True,
+        help_text="Lease the resources for this many seconds, renewed by heartbeats"
+    )
+
     class Meta:
         model = ResourceUsage
-        fields = ('used_cpu', 'used_ram', 'used_gpu')
+        fields = ('used_cpu', 'used_ram', 'used_gpu', 'ttl')
+
+    def validate_ttl(self, value):
+        config = settings.RESOURCE_LEASES
+        if not config['MIN_TTL'] <= value <= config['MAX_TTL']:
+            raise serializers.ValidationError(
+                f"Must be between {config['MIN_TTL']} and {config['MAX_TTL']} seconds."
+            )
+        return value
+
+    def save(self, **kwargs):
+        ttl = self.validated_data.pop('ttl', None)
+        if ttl is not None:
+            kwargs.update(lease_seconds=ttl, lease_expires_at=lease_expiry(ttl))
+        return super().save(**kwargs)
 
 class ClusterSerializer(serializers.ModelSerializer):
     available_cpu = serializers.IntegerField(read_only=True)
@@ -81,14 +139,14 @@ class DeploymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Deployment
         fields = ['id', 'name', 'cluster', 'docker_image', 'required_cpu', 
-                 'required_ram', 'required_gpu', 'status', 'created_at', 'updated_at']
+                 'required_ram', 'required_gpu', 'priority', 'status', 'created_at', 'updated_at']
         read_only_fields = ['status', 'created_at', 'updated_at']
 
 class DeploymentCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Deployment
         fields = ['name', 'cluster', 'docker_image', 'required_cpu', 
-                 'required_ram', 'required_gpu']
+                 'required_ram', 'required_gpu', 'priority']
 
     def validate(self, data):
         if (data['required_cpu'] < 0 or 
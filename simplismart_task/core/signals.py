@@ -0,0 +1,121 @@
+from django.db.models import Sum
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import (
+    Cluster,
+    Organization,
+    OrganizationCapacity,
+    OrganizationMembership,
+    ResourceUsage,
+    UsageEvent,
+)
+
+CLUSTER_FIELDS = ('total_cpu', 'total_ram', 'total_gpu')
+USAGE_FIELDS = ('used_cpu', 'used_ram', 'used_gpu')
+
+
+def organizations_of(user_id):
+    return OrganizationMembership.objects.filter(user_id=user_id).values('organization_id')
+
+
+def negate(capacity):
+    return {field: -value for field, value in capacity.items()}
+
+
+def record_usage(cluster_id, **change):
+    if any(change.values()):
+        UsageEvent.objects.create(cluster_id=cluster_id, **change)
+
+
+# Each handler reads the current database state, so the totals stay right
+# whatever order a cascade (e.g. deleting a user) removes rows in.
+
+@receiver(post_save, sender=Organization)
+def create_capacity(sender, instance, created, **kwargs):
+    if created:
+        OrganizationCapacity.objects.get_or_create(organization=instance)
+
+
+@receiver(pre_save, sender=Cluster)
+@receiver(pre_save, sender=ResourceUsage)
+def remember_previous(sender, instance, **kwargs):
+    fields = CLUSTER_FIELDS + ('owner_id',) if sender is Cluster else USAGE_FIELDS + ('cluster_id',)
+    instance._previous = sender.objects.filter(pk=instance.pk).values(*fields).first() if instance.pk else None
+
+
+@receiver(post_save, sender=Cluster)
+def cluster_saved(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous', None)
+    current = {field: getattr(instance, field) for field in CLUSTER_FIELDS}
+    if previous is None:
+        OrganizationCapacity.adjust(organizations_of(instance.owner_id), cluster_count=1, **current)
+    elif previous['owner_id'] != instance.owner_id:
+        # The usage moves with the cluster.
+        used = {
+            field: value or 0 for field, value in
+            ResourceUsage.objects.filter(cluster=instance).aggregate(**{
+                field: Sum(field) for field in USAGE_FIELDS
+            }).items()
+        }
+        moved = {'cluster_count': 1, **current, **used}
+        OrganizationCapacity.adjust(organizations_of(previous['owner_id']), **negate(
+            {**moved, **{field: previous[field] for field in CLUSTER_FIELDS}}
+        ))
+        OrganizationCapacity.adjust(organizations_of(instance.owner_id), **moved)
+    else:
+        OrganizationCapacity.adjust(organizations_of(instance.owner_id), **{
+            field: current[field] - previous[field] for field in CLUSTER_FIELDS
+        })
+
+
+@receiver(post_delete, sender=Cluster)
+def cluster_deleted(sender, instance, **kwargs):
+    # Its usage rows are deleted first by the cascade and subtracted there.
+    OrganizationCapacity.adjust(organizations_of(instance.owner_id), cluster_count=-1, **{
+        field: -getattr(instance, field) for field in CLUSTER_FIELDS
+    })
+
+
+@receiver(post_save, sender=ResourceUsage)
+def usage_saved(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous', None)
+    owner_id = Cluster.objects.filter(pk=instance.cluster_id).values_list('owner_id', flat=True).first()
+    if previous is not None and previous['cluster_id'] != instance.cluster_id:
+        previous_owner_id = Cluster.objects.filter(pk=previous['cluster_id']).values_list('owner_id', flat=True).first()
+        released = {field: -previous[field] for field in USAGE_FIELDS}
+        OrganizationCapacity.adjust(organizations_of(previous_owner_id), **released)
+        record_usage(previous['cluster_id'], **released)
+        previous = None
+    change = {field: getattr(instance, field) - (previous[field] if previous else 0) for field in USAGE_FIELDS}
+    OrganizationCapacity.reserve(organizations_of(owner_id), **change)
+    record_usage(instance.cluster_id, **change)
+
+
+@receiver(post_delete, sender=ResourceUsage)
+def usage_deleted(sender, instance, origin=None, **kwargs):
+    owner_id = Cluster.objects.filter(pk=instance.cluster_id).values_list('owner_id', flat=True).first()
+    released = {field: -getattr(instance, field) for field in USAGE_FIELDS}
+    OrganizationCapacity.adjust(organizations_of(owner_id), **released)
+    # When the cluster itself is being deleted its history goes with it.
+    if isinstance(origin, ResourceUsage) or getattr(origin, 'model', None) is ResourceUsage:
+        record_usage(instance.cluster_id, **released)
+
+
+@receiver(post_save, sender=OrganizationMembership)
+def member_joined(sender, instance, created, **kwargs):
+    if created:
+        OrganizationCapacity.adjust(
+            [instance.organization_id],
+            member_count=1,
+            **OrganizationCapacity.user_capacity(instance.user_id)
+        )
+
+
+@receiver(post_delete, sender=OrganizationMembership)
+def member_left(sender, instance, **kwargs):
+    OrganizationCapacity.adjust(
+        [instance.organization_id],
+        member_count=-1,
+        **negate(OrganizationCapacity.user_capacity(instance.user_id))
+    )
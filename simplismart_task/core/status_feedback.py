@@ -0,0 +1,127 @@
+import json
+import logging
+import time
+
+import pika
+from django.db import transaction
+from django.utils import timezone
+
+from common.queues import EXCHANGE, STATUS_QUEUE, STATUS_ROUTING_KEY, get_connection_parameters
+from common.statuses import STATUSES, can_transition
+
+from .models import Deployment
+
+logger = logging.getLogger(__name__)
+
+
+def apply_status_updates(updates):
+    """Apply ``{deployment_id: status}`` in one transaction.
+
+    Only rows whose status actually changes are written, with a single
+    ``bulk_update`` rather than a ``save()`` per deployment. Reports that
+    are not a valid transition from the current status (e.g. a late
+    ``running`` for a deployment stopped since) are skipped.
+    """
+    if not updates:
+        return 0
+    now = timezone.now()
+    with transaction.atomic():
+        changed = []
+        for deployment in Deployment.objects.filter(id__in=updates.keys()).only('id', 'status'):
+            status = updates[deployment.id]
+            if deployment.status == status:
+                continue
+            if not can_transition(deployment.status, status):
+                logger.warning(f"Skipping status {status!r} for {deployment.status} deployment {deployment.id}")
+                continue
+            deployment.status = status
+            deployment.updated_at = now
+            changed.append(deployment)
+        Deployment.objects.bulk_update(changed, ['status', 'updated_at'], batch_size=500)
+    return len(changed)
+
+
+def parse_status_message(body):
+    try:
+        message = json.loads(body)
+        deployment_id = int(message['id'])
+        status = message['status']
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f"Discarding malformed status message: {body!r}")
+        return None
+    if status not in STATUSES:
+        logger.warning(f"Discarding unknown status {status!r} for deployment {deployment_id}")
+        return None
+    return deployment_id, status
+
+
+class StatusFeedbackWorker:
+    def __init__(self, batch_size=500, max_wait=1.0):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.connection = None
+        self.channel = None
+
+    def setup_connection(self):
+        self.connection = pika.BlockingConnection(get_connection_parameters())
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=EXCHANGE,
+            exchange_type='direct',
+            durable=True
+        )
+        self.channel.queue_declare(queue=STATUS_QUEUE, durable=True)
+        self.channel.queue_bind(
+            exchange=EXCHANGE,
+            queue=STATUS_QUEUE,
+            routing_key=STATUS_ROUTING_KEY
+        )
+        self.channel.basic_qos(prefetch_count=self.batch_size)
+
+    def drain_batch(self):
+        updates = {}
+        last_tag = None
+        deadline = time.monotonic() + self.max_wait
+        received = 0
+        for method, properties, body in self.channel.consume(
+            STATUS_QUEUE, inactivity_timeout=self.max_wait
+        ):
+            if method is not None:
+                last_tag = method.delivery_tag
+                received += 1
+                parsed = parse_status_message(body)
+                if parsed:
+                    deployment_id, status = parsed
+                    updates[deployment_id] = status
+            if received >= self.batch_size or time.monotonic() >= deadline or method is None:
+                break
+        if last_tag is None:
+            return 0, 0
+        try:
+            applied = apply_status_updates(updates)
+        except Exception:
+            self.channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            raise
+        self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        return received, applied
+
+    def run(self, once=False):
+        self.setup_connection()
+        try:
+            while True:
+                received, applied = self.drain_batch()
+                if received:
+                    logger.info(f"Applied {applied} status changes from {received} messages")
+                if once and not received:
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        try:
+            if self.channel and self.channel.is_open:
+                self.channel.cancel()
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.error(f"Error closing status feedback connection: {str(e)}")
@@ -1,16 +1,64 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
-from rest_framework.test import APIClient
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from .models import Cluster, ResourceUsage
-from .rabbitmq import RabbitMQPublisher
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .models import Cluster, ResourceUsage, Deployment, OrganizationCapacity, OrganizationMembership, IdempotencyRecord, UsageEvent
+from .rabbitmq import (
+    RabbitMQPublisher,
+    QUEUE_STATS_CACHE_KEY
+)
+from common.queues import shard_for_cluster, shard_routing_key
+from common.tracing import parse_traceparent
+from common.versions import parse_version
+from .status_feedback import StatusFeedbackWorker, apply_status_updates
+from .dlq import DeadLetter, dead_letter_replayer
+from common.deadletters import MAX_UNACKED, DeadLetterReplayer
+from .serializers import DeploymentSerializer
+from .deployments import publish_queue, release_usage
+from .checks import allocation_throttle_cache
+from .idempotency import will_replay
+from .transports import UnixSocketPublisher
+from common.frames import encode_frame, read_frame
+from .tracing import load_traces
+from . import openapi
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from .management.commands.profile_startup import parse_importtime
+from io import StringIO
 import json
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+import socket
+import tempfile
+import threading
 from unittest.mock import patch, MagicMock
 import pika
+from prometheus_client import REGISTRY
 
 User = get_user_model()
 
+PRIORITY_MISMATCH = (
+    "PRECONDITION_FAILED - inequivalent arg 'x-max-priority' for queue 'deployments' in vhost '/': "
+    "received the value '3' of type 'signedint' but current value is none"
+)
+
+# Allocation buckets live in the cache, which outlives each test case, so
+# they are off except in TestAllocationRateThrottle.
+throttle_disabled = override_settings(ALLOCATION_THROTTLE={**settings.ALLOCATION_THROTTLE, 'ENABLED': False})
+
+def setUpModule():
+    throttle_disabled.enable()
+
+def tearDownModule():
+    throttle_disabled.disable()
+
 class TestUserModel(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -87,12 +135,28 @@ class TestRabbitMQPublisher(TestCase):
         mock_connection.return_value.channel.return_value = mock_channel
         
         publisher = RabbitMQPublisher()
+        mock_connection.assert_not_called()
+        publisher.ensure_connection()
         
         mock_connection.assert_called_once()
         mock_channel.exchange_declare.assert_called_once()
         mock_channel.queue_declare.assert_called_once()
         mock_channel.queue_bind.assert_called_once()
 
+    @patch('pika.BlockingConnection')
+    def test_connection_is_not_shared_after_fork(self, mock_connection):
+        publisher = RabbitMQPublisher()
+        publisher.ensure_connection()
+        parent_connection = publisher.connection
+        publisher.pid = -1
+        mock_connection.return_value = MagicMock()
+        
+        publisher.ensure_connection()
+        
+        self.assertIsNot(publisher.connection, parent_connection)
+        parent_connection.close.assert_not_called()
+        self.assertEqual(publisher.pid, os.getpid())
+
     @patch('pika.BlockingConnection')
     def test_publish_deployment(self, mock_connection):
         mock_channel = MagicMock()
@@ -114,6 +178,111 @@ class TestRabbitMQPublisher(TestCase):
         self.assertTrue(result)
         mock_channel.basic_publish.assert_called_once()
 
+    @patch('pika.BlockingConnection')
+    def test_publish_deployment_carries_version_header(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        
+        publisher = RabbitMQPublisher()
+        publisher.publish_deployment({'id': 7, 'updated_at': '2025-04-20T19:54:00.000001Z'})
+        
+        headers = mock_channel.basic_publish.call_args.kwargs['properties'].headers
+        self.assertEqual(headers['deployment_id'], 7)
+        self.assertEqual(headers['version'], 1745178840000001)
+
+    @patch('pika.BlockingConnection')
+    def test_publish_deployment_sets_priority(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        
+        publisher = RabbitMQPublisher()
+        publisher.publish_deployment({'id': 7, 'priority': 3})
+        
+        arguments = mock_channel.queue_declare.call_args.kwargs['arguments']
+        self.assertEqual(arguments['x-max-priority'], 3)
+        properties = mock_channel.basic_publish.call_args.kwargs['properties']
+        self.assertEqual(properties.priority, 3)
+        self.assertIn('published_at', properties.headers)
+
+    @patch('pika.BlockingConnection')
+    def test_existing_queue_without_priority_is_reused(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_channel.queue_declare.side_effect = [
+            pika.exceptions.ChannelClosedByBroker(406, PRIORITY_MISMATCH),
+            MagicMock()
+        ]
+        mock_connection.return_value.channel.return_value = mock_channel
+        
+        publisher = RabbitMQPublisher()
+        with self.assertLogs('core.rabbitmq', level='WARNING') as logs:
+            publisher.ensure_connection()
+        
+        self.assertIsNotNone(publisher.channel)
+        self.assertTrue(mock_channel.queue_declare.call_args.kwargs['passive'])
+        self.assertIn("without the current 'x-max-priority' argument", logs.output[0])
+
+    @patch('pika.BlockingConnection')
+    def test_migrate_queues_recreates_drained_queue(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_channel.queue_declare.side_effect = [
+            pika.exceptions.ChannelClosedByBroker(406, PRIORITY_MISMATCH),
+            MagicMock(),
+            MagicMock(),
+        ]
+        held = (MagicMock(delivery_tag=1), pika.BasicProperties(priority=2), b'{"id": 7}')
+        mock_channel.basic_get.side_effect = [held, (None, None, None)]
+        mock_connection.return_value.channel.return_value = mock_channel
+        out = StringIO()
+        
+        call_command('migrate_queues', stdout=out)
+        
+        mock_channel.queue_delete.assert_any_call(queue='deployments', if_unused=True, if_empty=True)
+        declared = mock_channel.queue_declare.call_args_list[-1].kwargs
+        self.assertEqual((declared['queue'], declared['arguments']['x-max-priority']), ('deployments', 3))
+        mock_channel.basic_publish.assert_called_once_with(
+            exchange='', routing_key='deployments', body=held[2], properties=held[1]
+        )
+        mock_channel.queue_delete.assert_called_with(queue='deployments.migrating')
+        self.assertIn('deployments: recreated with x-max-priority (1 deployments', out.getvalue())
+
+    @patch('pika.BlockingConnection')
+    def test_migrate_queues_skips_queue_with_backlog(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_channel.queue_declare.side_effect = [
+            pika.exceptions.ChannelClosedByBroker(406, PRIORITY_MISMATCH),
+            MagicMock(),
+        ]
+        mock_channel.queue_delete.side_effect = [
+            pika.exceptions.ChannelClosedByBroker(406, 'PRECONDITION_FAILED - queue not empty'),
+            None,
+        ]
+        mock_connection.return_value.channel.return_value = mock_channel
+        out = StringIO()
+        
+        call_command('migrate_queues', stdout=out)
+        
+        mock_channel.queue_delete.assert_called_with(queue='deployments.migrating')
+        mock_channel.basic_publish.assert_not_called()
+        self.assertEqual(mock_channel.queue_declare.call_count, 2)
+        self.assertIn('deployments: skipped (x-max-priority)', out.getvalue())
+
+    @patch('core.rabbitmq.time.sleep')
+    @patch('pika.BlockingConnection')
+    def test_batch_publish_gives_up_after_first_failure(self, mock_connection, mock_sleep):
+        mock_connection.side_effect = pika.exceptions.AMQPConnectionError('down')
+        publisher = RabbitMQPublisher()
+        
+        published = publisher.publish_deployments([{'id': deployment_id} for deployment_id in range(100)])
+        
+        self.assertEqual(published, 0)
+        self.assertEqual(mock_connection.call_count, 3)
+
+    def test_deployment_version_is_monotonic(self):
+        older = parse_version('2025-04-20T19:54:00Z')
+        newer = parse_version('2025-04-20T19:54:00.000001Z')
+        self.assertLess(older, newer)
+        self.assertEqual(parse_version(None), 0)
+
 class TestAPIEndpoints(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -182,4 +351,1131 @@ class TestAPIEndpoints(TestCase):
         self.client.force_authenticate(user=None)
         url = reverse('cluster-list')
         response = self.client.get(url)
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED) 
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED) 
+class TestStatusFeedback(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.cluster = Cluster.objects.create(
+            name='Test Cluster',
+            total_cpu=8,
+            total_ram=16,
+            total_gpu=2,
+            owner=self.user
+        )
+        self.deployments = [
+            Deployment.objects.create(
+                name=f'Deployment {i}',
+                cluster=self.cluster,
+                docker_image='test/image:latest',
+                required_cpu=1,
+                required_ram=1,
+                required_gpu=0
+            )
+            for i in range(3)
+        ]
+
+    def test_apply_status_updates_in_one_bulk_update(self):
+        updates = {d.id: 'running' for d in self.deployments}
+        with self.assertNumQueries(4):
+            applied = apply_status_updates(updates)
+        
+        self.assertEqual(applied, 3)
+        self.assertEqual(Deployment.objects.filter(status='running').count(), 3)
+
+    def test_apply_status_updates_skips_unchanged(self):
+        first, second, _ = self.deployments
+        applied = apply_status_updates({first.id: 'pending', second.id: 'failed'})
+        
+        self.assertEqual(applied, 1)
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'failed')
+
+    def test_apply_status_updates_skips_invalid_transitions(self):
+        first, second, _ = self.deployments
+        Deployment.objects.filter(id=first.id).update(status='stopped')
+        applied = apply_status_updates({first.id: 'running', second.id: 'running'})
+        
+        self.assertEqual(applied, 1)
+        first.refresh_from_db()
+        self.assertEqual(first.status, 'stopped')
+
+    def test_worker_acks_whole_batch_after_applying(self):
+        first, second, _ = self.deployments
+        messages = [
+            (MagicMock(delivery_tag=1), None, json.dumps({'id': first.id, 'status': 'running'})),
+            (MagicMock(delivery_tag=2), None, json.dumps({'id': first.id, 'status': 'failed'})),
+            (MagicMock(delivery_tag=3), None, json.dumps({'id': second.id, 'status': 'bogus'})),
+            (None, None, None),
+        ]
+        worker = StatusFeedbackWorker(batch_size=10, max_wait=5)
+        worker.channel = MagicMock()
+        worker.channel.consume.return_value = iter(messages)
+        
+        received, applied = worker.drain_batch()
+        
+        self.assertEqual((received, applied), (3, 1))
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, 'failed')
+        self.assertEqual(second.status, 'pending')
+
+class TestDeadLetterReplay(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.cluster = Cluster.objects.create(
+            name='Test Cluster',
+            total_cpu=8,
+            total_ram=16,
+            total_gpu=2,
+            owner=self.user
+        )
+        self.deployment = Deployment.objects.create(
+            name='Test Deployment',
+            cluster=self.cluster,
+            docker_image='test/image:latest',
+            required_cpu=1,
+            required_ram=1,
+            required_gpu=0
+        )
+
+    def dead_letter(self, tag, deployment_id, version, cluster=None):
+        properties = pika.BasicProperties(headers={
+            'deployment_id': deployment_id,
+            'version': version,
+            'x-death': [{'reason': 'expired', 'routing-keys': ['deployment']}],
+        })
+        body = json.dumps({'id': deployment_id, 'cluster': cluster or self.cluster.id})
+        return DeadLetter(MagicMock(delivery_tag=tag), properties, body)
+
+    def test_replays_current_and_skips_superseded(self):
+        current = parse_version(DeploymentSerializer(self.deployment).data['updated_at'])
+        replayer = dead_letter_replayer(rate=0)
+        replayer.channel = MagicMock()
+        
+        replayer.process_batch([
+            self.dead_letter(1, self.deployment.id, current),
+            self.dead_letter(2, self.deployment.id, current - 1),
+            self.dead_letter(3, self.deployment.id + 100, current),
+        ])
+        
+        self.assertEqual(replayer.stats['replayed'], 1)
+        self.assertEqual(replayer.stats['superseded'], 2)
+        replayer.channel.basic_publish.assert_called_once()
+        published = replayer.channel.basic_publish.call_args.kwargs
+        self.assertEqual(published['exchange'], 'deployments')
+        self.assertEqual(published['routing_key'], 'deployment')
+        self.assertNotIn('x-death', published['properties'].headers)
+        replayer.channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+    def test_non_matching_messages_are_kept_in_dlq(self):
+        current = parse_version(DeploymentSerializer(self.deployment).data['updated_at'])
+        replayer = dead_letter_replayer(rate=0, clusters=[self.cluster.id + 1])
+        replayer.channel = MagicMock()
+        
+        replayer.process_batch([self.dead_letter(1, self.deployment.id, current)])
+        
+        self.assertEqual(replayer.stats['kept'], 1)
+        published = replayer.channel.basic_publish.call_args.kwargs
+        self.assertEqual(published['exchange'], '')
+        self.assertEqual(published['routing_key'], 'deployments.dlq')
+
+    def test_kept_messages_replay_in_a_later_pass(self):
+        current = parse_version(DeploymentSerializer(self.deployment).data['updated_at'])
+        properties = pika.BasicProperties(headers={
+            'deployment_id': self.deployment.id,
+            'version': current,
+            'x-death': [{'reason': 'rejected', 'routing-keys': ['deployment.2']}],
+        })
+        body = json.dumps({'id': self.deployment.id, 'cluster': self.cluster.id})
+        first = dead_letter_replayer(rate=0, clusters=[self.cluster.id + 1])
+        first.channel = MagicMock()
+        
+        first.process_batch([DeadLetter(MagicMock(delivery_tag=1), properties, body)])
+        kept = first.channel.basic_publish.call_args.kwargs
+        second = dead_letter_replayer(rate=0, reasons=['rejected'])
+        second.channel = MagicMock()
+        second.process_batch([DeadLetter(MagicMock(delivery_tag=1), kept['properties'], kept['body'])])
+        
+        self.assertEqual(second.stats['replayed'], 1)
+        replayed = second.channel.basic_publish.call_args.kwargs
+        self.assertEqual((replayed['exchange'], replayed['routing_key']), ('deployments', 'deployment.2'))
+        self.assertNotIn('dlq-reason', replayed['properties'].headers)
+
+    def test_dry_run_bounds_messages_in_flight(self):
+        mock_connection = MagicMock()
+        mock_channel = mock_connection.channel.return_value
+        mock_channel.queue_declare.return_value.method.message_count = 10 ** 6
+        mock_channel.consume.return_value = iter([(None, None, None)])
+        replayer = DeadLetterReplayer(lambda: mock_connection, lambda ids: {}, rate=0, dry_run=True)
+        
+        replayer.replay()
+        replayer.inspect(sample=10 ** 6)
+        
+        prefetches = [call.kwargs['prefetch_count'] for call in mock_channel.basic_qos.call_args_list]
+        self.assertEqual(prefetches, [MAX_UNACKED, MAX_UNACKED])
+        self.assertEqual(replayer.total, MAX_UNACKED)
+
+class TestDeploymentBackpressure(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.cluster = Cluster.objects.create(
+            name='Test Cluster',
+            total_cpu=8,
+            total_ram=16,
+            total_gpu=2,
+            owner=self.user
+        )
+        self.data = {
+            'name': 'Test Deployment',
+            'cluster': self.cluster.id,
+            'docker_image': 'test/image:latest',
+            'required_cpu': 1,
+            'required_ram': 1,
+            'required_gpu': 0
+        }
+
+    @patch('core.views.deployment_publisher')
+    @patch('core.throttling.deployment_publisher')
+    def test_create_rejected_when_queue_backed_up(self, mock_throttle_publisher, mock_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 10000, 'consumers': 1}
+        
+        response = self.client.post(reverse('deployment-list'), self.data, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '15')
+        self.assertEqual(Deployment.objects.count(), 0)
+        mock_publisher.publish_deployment.assert_not_called()
+
+    @patch('core.views.deployment_publisher')
+    @patch('core.throttling.deployment_publisher')
+    def test_stalled_consumer_lowers_limit(self, mock_throttle_publisher, mock_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 150, 'consumers': 0}
+        
+        response = self.client.post(reverse('deployment-list'), self.data, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @patch('core.views.deployment_publisher')
+    @patch('core.throttling.deployment_publisher')
+    def test_create_allowed_below_limit_and_reads_unaffected(self, mock_throttle_publisher, mock_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 10, 'consumers': 1}
+        
+        response = self.client.post(reverse('deployment-list'), self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_publisher.publish_deployment.assert_called_once()
+        
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 10000, 'consumers': 0}
+        response = self.client.get(reverse('deployment-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @patch('core.views.deployment_publisher')
+    @patch('core.throttling.deployment_publisher')
+    def test_high_priority_bypasses_queue_depth_limit(self, mock_throttle_publisher, mock_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 10000, 'consumers': 1}
+        
+        response = self.client.post(reverse('deployment-list'), dict(self.data, priority=3), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Deployment.objects.get().priority, 3)
+        
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 25000, 'consumers': 1}
+        response = self.client.post(reverse('deployment-list'), dict(self.data, priority=3), format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @patch('pika.BlockingConnection')
+    def test_queue_stats_are_cached(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        mock_channel.queue_declare.return_value.method.message_count = 42
+        mock_channel.queue_declare.return_value.method.consumer_count = 2
+        cache.delete(QUEUE_STATS_CACHE_KEY)
+        publisher = RabbitMQPublisher()
+        publisher.ensure_connection()
+        mock_channel.queue_declare.reset_mock()
+        
+        first = publisher.queue_stats()
+        second = publisher.queue_stats()
+        
+        self.assertEqual(first['depth'], 42)
+        self.assertEqual(second['consumers'], 2)
+        mock_channel.queue_declare.assert_called_once_with(queue='deployments', passive=True)
+        cache.delete(QUEUE_STATS_CACHE_KEY)
+
+    @patch('pika.BlockingConnection')
+    def test_queue_stats_never_connect_inline(self, mock_connection):
+        cache.delete(QUEUE_STATS_CACHE_KEY)
+        publisher = RabbitMQPublisher()
+
+        with patch.object(publisher, 'connect_in_background') as mock_connect:
+            self.assertEqual(publisher.queue_stats(), {})
+
+        mock_connect.assert_called_once_with()
+        mock_connection.assert_not_called()
+        cache.delete(QUEUE_STATS_CACHE_KEY)
+
+class TestDeploymentSharding(TestCase):
+    def test_shard_for_cluster_is_stable_and_in_range(self):
+        shards = [shard_for_cluster(cluster_id, 4) for cluster_id in range(100)]
+        self.assertEqual(shards, [shard_for_cluster(cluster_id, 4) for cluster_id in range(100)])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        self.assertEqual(shard_for_cluster(12345, 1), 0)
+
+    @override_settings(DEPLOYMENT_SHARDS=4)
+    @patch('pika.BlockingConnection')
+    def test_publish_routes_by_cluster_shard(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        
+        publisher = RabbitMQPublisher()
+        publisher.ensure_connection()
+        self.assertEqual(mock_channel.queue_declare.call_count, 4)
+        
+        for cluster_id in (1, 2, 1):
+            publisher.publish_deployment({'id': 1, 'cluster': cluster_id})
+        
+        routing_keys = [c.kwargs['routing_key'] for c in mock_channel.basic_publish.call_args_list]
+        self.assertEqual(routing_keys[0], routing_keys[2])
+        self.assertEqual(routing_keys[0], shard_routing_key(shard_for_cluster(1, 4)))
+        self.assertEqual(routing_keys[1], shard_routing_key(shard_for_cluster(2, 4)))
+
+class TestUnixSocketTransport(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'deployments.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        self.received = []
+        threading.Thread(target=self.serve, daemon=True).start()
+        self.publisher = UnixSocketPublisher(self.path)
+
+    def tearDown(self):
+        self.publisher.close()
+        self.server.close()
+        os.unlink(self.path)
+
+    def serve(self):
+        try:
+            connection, _ = self.server.accept()
+        except OSError:
+            return
+        with connection:
+            while True:
+                try:
+                    message = read_frame(connection)
+                except ConnectionError:
+                    return
+                if message is None:
+                    return
+                self.received.append(message)
+                if message['type'] == 'stats':
+                    connection.sendall(encode_frame({'shards': [{'depth': 3, 'consumers': 1}]}))
+
+    def test_publish_matches_amqp_message(self):
+        self.assertTrue(self.publisher.publish_deployment(
+            {'id': 7, 'cluster': 1, 'priority': 2, 'updated_at': '2025-04-20T19:54:00.000001Z'}
+        ))
+        stats = self.publisher.sample_queue_stats()
+        
+        message = self.received[0]
+        self.assertEqual(message['routing_key'], shard_routing_key(0))
+        self.assertEqual(message['priority'], 2)
+        self.assertEqual(message['headers']['version'], 1745178840000001)
+        self.assertEqual(json.loads(message['body'])['id'], 7)
+        self.assertEqual((stats['depth'], stats['consumers']), (3, 1))
+
+    def test_publish_fails_without_consumer(self):
+        publisher = UnixSocketPublisher(self.path + '.missing')
+        
+        self.assertFalse(publisher.publish_deployment({'id': 7}))
+        self.assertIsNone(publisher.sample_queue_stats())
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def sample(self, name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_recorded_by_view(self):
+        labels = {'view': 'cluster-list', 'method': 'GET', 'status': '200'}
+        before = self.sample('django_http_request_duration_seconds_count', labels)
+        
+        self.client.get(reverse('cluster-list'))
+        
+        self.assertEqual(self.sample('django_http_request_duration_seconds_count', labels), before + 1)
+        self.assertGreater(self.sample('django_http_request_db_queries_sum', {'view': 'cluster-list'}), 0)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'django_http_request_duration_seconds_bucket', response.content)
+
+    @patch('time.sleep')
+    @patch('pika.BlockingConnection')
+    def test_publish_outcomes_and_retries(self, mock_connection, mock_sleep):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        publisher = RabbitMQPublisher()
+        retries = self.sample('deployment_publish_retries_total', {'transport': 'amqp'})
+        successes = self.sample('deployment_publish_total', {'transport': 'amqp', 'outcome': 'success'})
+        
+        mock_channel.basic_publish.side_effect = [pika.exceptions.AMQPChannelError(), None]
+        self.assertTrue(publisher.publish_deployment({'id': 1}))
+        
+        self.assertEqual(self.sample('deployment_publish_retries_total', {'transport': 'amqp'}), retries + 1)
+        self.assertEqual(
+            self.sample('deployment_publish_total', {'transport': 'amqp', 'outcome': 'success'}), successes + 1
+        )
+
+@override_settings(SQL_INSTRUMENTATION={
+    'ENABLED': True, 'SLOW_REQUEST_MS': 10000, 'REPEAT_THRESHOLD': 3, 'MAX_PATTERNS': 20
+})
+class TestSQLInspector(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        for index in range(3):
+            Cluster.objects.create(name=f'Cluster {index}', total_cpu=8, total_ram=16, owner=self.user)
+
+    def test_headers_and_n_plus_one_logged(self):
+        with self.assertLogs('core.sql', level='WARNING') as logs:
+            response = self.client.get(reverse('cluster-list'))
+        
+        self.assertGreater(int(response['X-DB-Queries']), 3)
+        self.assertGreaterEqual(float(response['X-DB-Time']), 0)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'cluster-list')
+        self.assertTrue(any('core_resourceusage' in sql for sql in record['n_plus_one']))
+        self.assertTrue(record['duplicates'])
+
+    @override_settings(SQL_INSTRUMENTATION={'ENABLED': False})
+    def test_disabled_by_default(self):
+        response = APIClient().get(reverse('api-root'))
+        self.assertNotIn('X-DB-Queries', response)
+
+class TestTracing(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'traces.jsonl')
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.cluster = Cluster.objects.create(
+            name='Test Cluster', total_cpu=8, total_ram=16, total_gpu=2, owner=self.user
+        )
+
+    @patch('core.throttling.deployment_publisher')
+    @patch('pika.BlockingConnection')
+    def test_trace_continues_from_request_into_message_headers(self, mock_connection, mock_throttle_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {}
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        
+        with override_settings(TRACING={'ENABLED': True, 'SAMPLE_RATE': 1.0, 'EXPORT_PATH': self.path}):
+            client = APIClient()
+            client.force_authenticate(user=self.user)
+            with patch('core.views.deployment_publisher', RabbitMQPublisher()):
+                response = client.post(reverse('deployment-list'), {
+                    'name': 'Traced', 'cluster': self.cluster.id, 'docker_image': 'test/image:latest',
+                    'required_cpu': 1, 'required_ram': 1, 'required_gpu': 0
+                }, format='json', HTTP_TRACEPARENT=f'00-{trace_id}-00f067aa0ba902b7-01')
+        
+        self.assertEqual(response['X-Trace-Id'], trace_id)
+        spans = {span['name']: span for span in load_traces([self.path])[trace_id]}
+        self.assertEqual(spans['http.request']['parent_id'], '00f067aa0ba902b7')
+        self.assertEqual(spans['deployment.publish']['parent_id'], spans['http.request']['span_id'])
+        headers = mock_channel.basic_publish.call_args.kwargs['properties'].headers
+        self.assertEqual(headers['traceparent'], f"00-{trace_id}-{spans['deployment.publish']['span_id']}-01")
+        
+        out = StringIO()
+        call_command('trace_report', self.path, stdout=out)
+        self.assertIn(trace_id, out.getvalue())
+        self.assertIn('django/deployment.publish', out.getvalue())
+
+    @patch('pika.BlockingConnection')
+    def test_no_trace_header_when_disabled(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        
+        RabbitMQPublisher().publish_deployment({'id': 1})
+        
+        headers = mock_channel.basic_publish.call_args.kwargs['properties'].headers
+        self.assertNotIn('traceparent', headers)
+
+    def test_parse_traceparent(self):
+        trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        self.assertEqual(parse_traceparent(f'00-{trace_id}-00f067aa0ba902b7-01'), (trace_id, '00f067aa0ba902b7', True))
+        self.assertEqual(parse_traceparent(f'00-{trace_id}-00f067aa0ba902b7-00')[2], False)
+        for value in (None, '', 'garbage', f'00-{trace_id}-0000000000000000-01', f'00-{trace_id[:-1]}-00f067aa0ba902b7-01'):
+            self.assertIsNone(parse_traceparent(value))
+
+class TestOpenAPISchema(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        openapi.loaded.clear()
+        self.addCleanup(openapi.loaded.clear)
+
+    def test_schema_served_from_artifact_with_etag(self):
+        with override_settings(OPENAPI_SCHEMA={'DIR': self.directory, 'MAX_AGE': 600}):
+            call_command('build_openapi', stdout=StringIO())
+            with patch('core.openapi.OpenAPISchemaGenerator') as mock_generator:
+                response = self.client.get(reverse('schema-json'))
+                cached = self.client.get(reverse('schema-json'), HTTP_IF_NONE_MATCH=response['ETag'])
+                yaml_response = self.client.get(reverse('schema-yaml'))
+        
+        mock_generator.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/clusters/', json.loads(response.content)['paths'])
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age=600', response['Cache-Control'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(yaml_response['ETag'], response['ETag'])
+        self.assertIn(b'swagger:', yaml_response.content)
+
+    def test_check_fails_until_built(self):
+        with override_settings(OPENAPI_SCHEMA={'DIR': self.directory, 'MAX_AGE': 600}):
+            with self.assertRaises(CommandError):
+                call_command('build_openapi', check=True, stdout=StringIO())
+            call_command('build_openapi', stdout=StringIO())
+            call_command('build_openapi', check=True, stdout=StringIO())
+
+    def test_requests_never_build_or_hash(self):
+        with override_settings(OPENAPI_SCHEMA={'DIR': self.directory, 'MAX_AGE': 600}):
+            with patch('core.openapi.schema_fingerprint') as mock_fingerprint, \
+                    patch('core.openapi.OpenAPISchemaGenerator') as mock_generator:
+                response = self.client.get(reverse('schema-json'))
+            
+            self.assertEqual(response.status_code, 503)
+            mock_fingerprint.assert_not_called()
+            mock_generator.assert_not_called()
+            
+            out = StringIO()
+            call_command('build_openapi', if_stale=True, stdout=out)
+            self.assertIn('Wrote', out.getvalue())
+            with patch('core.openapi.OpenAPISchemaGenerator') as mock_generator:
+                call_command('build_openapi', if_stale=True, stdout=out)
+            mock_generator.assert_not_called()
+            self.assertIn('up to date', out.getvalue())
+            self.assertEqual(self.client.get(reverse('schema-json')).status_code, 200)
+
+    def test_docs_ui_loads_prebuilt_schema(self):
+        response = self.client.get(reverse('schema-swagger-ui'))
+        self.assertContains(response, reverse('schema-json'))
+
+class TestProfileStartup(TestCase):
+    def test_parse_importtime(self):
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       120 |        120 |   core.metrics",
+            "import time:      2981 |      22541 | core.rabbitmq",
+            "Failed to setup RabbitMQ connection",
+        ])
+        self.assertEqual(parse_importtime(output), {
+            'core.metrics': (120, 120),
+            'core.rabbitmq': (2981, 22541),
+        })
+
+class TestCapacityAnalytics(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            username='testuser',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.cluster = Cluster.objects.create(
+            name='Test Cluster', total_cpu=10, total_ram=20, total_gpu=0, owner=self.user
+        )
+        now = timezone.now()
+        for days_ago, cpu, ram in ((20, 2, 4), (2, 4, 4)):
+            usage = ResourceUsage.objects.create(cluster=self.cluster, used_cpu=cpu, used_ram=ram, used_gpu=0)
+            ResourceUsage.objects.filter(id=usage.id).update(created_at=now - timedelta(days=days_ago))
+            UsageEvent.objects.filter(id=self.cluster.usage_events.latest('id').id).update(
+                created_at=now - timedelta(days=days_ago)
+            )
+        self.usage = usage
+        Deployment.objects.create(
+            name='Running', cluster=self.cluster, docker_image='test/image:latest',
+            required_cpu=1, required_ram=2, required_gpu=0, status='running'
+        )
+
+    @override_settings(CAPACITY_ANALYTICS={**settings.CAPACITY_ANALYTICS, 'WORKERS': 0})
+    def test_capacity_report(self):
+        response = self.client.get(reverse('cluster-analytics'), {'days': 30})
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['events'], 2)
+        report = response.data['clusters'][0]
+        self.assertEqual(report['cpu']['used'], 6)
+        self.assertEqual(report['cpu']['utilization']['peak'], 0.6)
+        self.assertGreater(report['cpu']['peak_to_average'], 1)
+        self.assertGreater(report['cpu']['hours_to_exhaustion'], 0)
+        self.assertIsNone(report['gpu']['utilization']['p50'])
+        # Free 4 CPU / 12 GB fits four 1 CPU / 2 GB deployments, stranding 4 GB.
+        self.assertAlmostEqual(report['fragmentation'], 0.2)
+        self.assertAlmostEqual(response.data['fleet']['fragmentation'], 0.2)
+
+    @override_settings(CAPACITY_ANALYTICS={**settings.CAPACITY_ANALYTICS, 'WORKERS': 0})
+    def test_released_usage_stays_in_history(self):
+        self.usage.delete()
+        ResourceUsage.objects.create(cluster=self.cluster, used_cpu=1, used_ram=1, used_gpu=0)
+        release_usage(ResourceUsage.objects.filter(used_cpu=1))
+
+        response = self.client.get(reverse('cluster-analytics'), {'days': 30})
+
+        self.assertEqual(response.data['events'], 5)
+        report = response.data['clusters'][0]
+        self.assertEqual(report['cpu']['used'], 2)
+        self.assertEqual(report['cpu']['utilization']['peak'], 0.6)
+        self.assertEqual(
+            list(UsageEvent.objects.order_by('id').values_list('used_cpu', flat=True)),
+            [2, 4, -4, 1, -1]
+        )
+
+        self.cluster.delete()
+        self.assertFalse(UsageEvent.objects.exists())
+
+    def test_baseline_before_window_and_validation(self):
+        with override_settings(CAPACITY_ANALYTICS={**settings.CAPACITY_ANALYTICS, 'WORKERS': 0}):
+            response = self.client.get(reverse('cluster-analytics'), {'days': 7, 'clusters': str(self.cluster.id)})
+        report = response.data['clusters'][0]
+        self.assertEqual(response.data['events'], 1)
+        self.assertEqual(report['cpu']['utilization']['p50'], 0.2)
+        self.assertEqual(report['cpu']['used'], 6)
+        
+        response = self.client.get(reverse('cluster-analytics'), {'days': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('cluster-analytics'), {'clusters': 'a,b'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class TestOrganizationCapacity(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(email='admin@example.com', username='admin', password='testpass123')
+        self.member = User.objects.create_user(email='member@example.com', username='member', password='testpass123')
+        self.outsider = User.objects.create_user(email='out@example.com', username='out', password='testpass123')
+        self.organization = self.admin.create_organization('Acme')
+        Cluster.objects.create(name='Admin', total_cpu=8, total_ram=16, total_gpu=2, owner=self.admin)
+        self.cluster = Cluster.objects.create(name='Member', total_cpu=4, total_ram=8, total_gpu=0, owner=self.member)
+        Cluster.objects.create(name='Outside', total_cpu=100, total_ram=100, total_gpu=100, owner=self.outsider)
+        OrganizationMembership.objects.create(user=self.member, organization=self.organization)
+
+    def assertMatchesRebuild(self):
+        capacity = OrganizationCapacity.objects.get(organization=self.organization)
+        rebuilt = OrganizationCapacity(organization=self.organization)
+        rebuilt.rebuild()
+        for field in ('member_count', 'cluster_count', 'total_cpu', 'total_ram', 'total_gpu', 'used_cpu', 'used_ram', 'used_gpu'):
+            self.assertEqual(getattr(capacity, field), getattr(rebuilt, field), field)
+        return capacity
+
+    def test_maintained_incrementally(self):
+        capacity = self.assertMatchesRebuild()
+        self.assertEqual((capacity.member_count, capacity.cluster_count, capacity.total_cpu), (2, 2, 12))
+        
+        usage = ResourceUsage.objects.create(cluster=self.cluster, used_cpu=3, used_ram=2, used_gpu=0)
+        self.assertEqual(self.assertMatchesRebuild().available_cpu, 9)
+        usage.used_cpu = 1
+        usage.save()
+        self.cluster.total_cpu = 6
+        self.cluster.save()
+        capacity = self.assertMatchesRebuild()
+        self.assertEqual((capacity.total_cpu, capacity.used_cpu), (14, 1))
+        
+        self.cluster.owner = self.outsider
+        self.cluster.save()
+        self.assertEqual(self.assertMatchesRebuild().cluster_count, 1)
+        self.cluster.owner = self.member
+        self.cluster.save()
+        
+        OrganizationMembership.objects.filter(user=self.member).delete()
+        self.assertEqual(self.assertMatchesRebuild().total_cpu, 8)
+        OrganizationMembership.objects.create(user=self.member, organization=self.organization)
+        self.member.delete()
+        capacity = self.assertMatchesRebuild()
+        self.assertEqual((capacity.member_count, capacity.used_cpu), (1, 0))
+
+    def test_capacity_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(user=self.member)
+        
+        with self.assertNumQueries(2):
+            response = client.get(reverse('organization-capacity', args=[self.organization.id]))
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['available_gpu'], 2)
+        client.force_authenticate(user=self.outsider)
+        response = client.get(reverse('organization-capacity', args=[self.organization.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rebuild_command_corrects_drift(self):
+        OrganizationCapacity.objects.filter(organization=self.organization).update(total_cpu=0)
+        out = StringIO()
+        call_command('rebuild_org_capacity', stdout=out)
+        self.assertIn('Corrected Acme', out.getvalue())
+        self.assertEqual(self.assertMatchesRebuild().total_cpu, 12)
+
+class TestAdminChangelists(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='admin@example.com', username='admin', password='testpass123')
+        self.client.force_login(self.admin)
+
+    def add_rows(self, count):
+        for index in range(count):
+            owner = User.objects.create_user(
+                email=f'owner{Cluster.objects.count()}@example.com',
+                username=f'owner{Cluster.objects.count()}',
+                password='testpass123'
+            )
+            cluster = Cluster.objects.create(name=f'Cluster {index}', total_cpu=8, total_ram=16, total_gpu=2, owner=owner)
+            ResourceUsage.objects.create(cluster=cluster, used_cpu=2, used_ram=4, used_gpu=1)
+            Deployment.objects.create(
+                name=f'Deployment {index}', cluster=cluster, docker_image='test/image:latest',
+                required_cpu=1, required_ram=1, required_gpu=0
+            )
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelists_use_constant_queries(self):
+        urls = [
+            reverse('admin:core_cluster_changelist'),
+            reverse('admin:core_resourceusage_changelist'),
+            reverse('admin:core_deployment_changelist'),
+        ]
+        self.add_rows(2)
+        few = [self.queries(url) for url in urls]
+        self.add_rows(5)
+        self.assertEqual([self.queries(url) for url in urls], few)
+
+    def test_cluster_changelist_shows_available_capacity(self):
+        self.add_rows(1)
+        response = self.client.get(reverse('admin:core_cluster_changelist'), {'o': '6'})
+        self.assertContains(response, '<td class="field-available_cpu">6</td>', html=True)
+
+    def test_available_columns_sort_by_availability(self):
+        self.add_rows(2)
+        busy = Cluster.objects.get(name='Cluster 1')
+        ResourceUsage.objects.create(cluster=busy, used_cpu=5, used_ram=0, used_gpu=0)
+        
+        response = self.client.get(reverse('admin:core_cluster_changelist'), {'o': '6'})
+        self.assertEqual([cluster.name for cluster in response.context['cl'].result_list], ['Cluster 1', 'Cluster 0'])
+        response = self.client.get(reverse('admin:core_cluster_changelist'), {'o': '-6'})
+        self.assertEqual([cluster.name for cluster in response.context['cl'].result_list], ['Cluster 0', 'Cluster 1'])
+
+@patch('core.views.deployment_publisher')
+@patch('core.deployments.deployment_publisher')
+class TestBulkStop(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', username='testuser', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.organization = self.user.create_organization('Acme')
+        self.cluster = Cluster.objects.create(name='Test Cluster', total_cpu=64, total_ram=64, total_gpu=0, owner=self.user)
+
+    def create_deployments(self, count):
+        ids = []
+        for index in range(count):
+            self.client.post(reverse('deployment-list'), {
+                'name': f'Deployment {index}', 'cluster': self.cluster.id, 'docker_image': 'test/image:latest',
+                'required_cpu': 2, 'required_ram': 1, 'required_gpu': 0
+            }, format='json')
+            ids.append(Deployment.objects.get(name=f'Deployment {index}').id)
+        return ids
+
+    def test_bulk_stop_releases_usage_in_constant_queries(self, mock_stop_publisher, mock_publisher):
+        mock_publisher.queue_stats.return_value = {}
+        with patch('core.throttling.deployment_publisher', mock_publisher):
+            ids = self.create_deployments(6)
+        self.assertEqual(self.cluster.available_cpu, 52)
+        other = Cluster.objects.create(name='Other', total_cpu=8, total_ram=8, total_gpu=0, owner=User.objects.create_user(
+            email='other@example.com', username='other', password='testpass123'
+        ))
+        foreign = Deployment.objects.create(
+            name='Foreign', cluster=other, docker_image='test/image:latest', required_cpu=1, required_ram=1, required_gpu=0
+        )
+        
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(reverse('deployment-bulk-stop'), {'ids': ids[:2]}, format='json')
+        mock_stop_publisher.reset_mock()
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.post(reverse('deployment-bulk-stop'), {'ids': ids[2:] + [foreign.id]}, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.data['stopped']), ids[2:])
+        self.assertEqual(response.data['released'], {'cpu': 8, 'ram': 4, 'gpu': 0})
+        self.assertEqual(len(large.captured_queries), len(small.captured_queries))
+        publish_queue.submit(lambda: None).result()
+        published = mock_stop_publisher.publish_deployments.call_args.args[0]
+        self.assertEqual(sorted(deployment['id'] for deployment in published), ids[2:])
+        self.assertEqual(Deployment.objects.filter(status='stopped').count(), 6)
+        self.assertEqual(Deployment.objects.get(id=foreign.id).status, 'pending')
+        self.assertEqual(self.cluster.available_cpu, 64)
+        self.assertEqual(OrganizationCapacity.objects.get(organization=self.organization).used_cpu, 0)
+
+    def test_admin_action(self, mock_stop_publisher, mock_publisher):
+        deployment = Deployment.objects.create(
+            name='Running', cluster=self.cluster, docker_image='test/image:latest',
+            required_cpu=4, required_ram=1, required_gpu=0, status='running'
+        )
+        ResourceUsage.objects.create(cluster=self.cluster, deployment=deployment, used_cpu=4, used_ram=1, used_gpu=0)
+        admin = User.objects.create_superuser(email='admin@example.com', username='admin', password='testpass123')
+        self.client.force_login(admin)
+        
+        response = self.client.post(reverse('admin:core_deployment_changelist'), {
+            'action': 'stop', '_selected_action': [deployment.id]
+        }, follow=True)
+        
+        self.assertContains(response, 'Stopped 1 deployments, released 4 CPU')
+        self.assertEqual(Deployment.objects.get(id=deployment.id).status, 'stopped')
+        publish_queue.submit(lambda: None).result()
+        [published] = mock_stop_publisher.publish_deployments.call_args.args[0]
+        self.assertEqual((published['id'], published['status']), (deployment.id, 'stopped'))
+        self.assertFalse(ResourceUsage.objects.filter(cluster=self.cluster).exists())
+
+class TestResourceLeases(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', username='testuser', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.organization = self.user.create_organization('Acme')
+        self.cluster = Cluster.objects.create(name='Test Cluster', total_cpu=16, total_ram=16, total_gpu=0, owner=self.user)
+
+    def lease(self, ttl, cpu=1):
+        response = self.client.post(reverse('cluster-use-resources', args=[self.cluster.id]), {
+            'used_cpu': cpu, 'used_ram': 1, 'used_gpu': 0, 'ttl': ttl
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return ResourceUsage.objects.get(id=response.data['id'])
+
+    def expire(self, usage):
+        ResourceUsage.objects.filter(id=usage.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_heartbeat_renews_live_lease_only(self):
+        usage = self.lease(60)
+        self.assertEqual(usage.lease_seconds, 60)
+        ResourceUsage.objects.filter(id=usage.id).update(lease_expires_at=timezone.now() + timedelta(seconds=5))
+        
+        response = self.client.post(reverse('resourceusage-heartbeat', args=[usage.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(ResourceUsage.objects.get(id=usage.id).lease_expires_at, timezone.now() + timedelta(seconds=55))
+        
+        self.expire(usage)
+        response = self.client.post(reverse('resourceusage-heartbeat', args=[usage.id]))
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        
+        permanent = ResourceUsage.objects.create(cluster=self.cluster, used_cpu=1, used_ram=1, used_gpu=0)
+        response = self.client.post(reverse('resourceusage-heartbeat', args=[permanent.id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ttl_is_bounded(self):
+        response = self.client.post(reverse('cluster-use-resources', args=[self.cluster.id]), {
+            'used_cpu': 1, 'used_ram': 1, 'used_gpu': 0, 'ttl': 10 ** 9
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sweeper_reclaims_expired_leases_in_batches(self):
+        expired = [self.lease(60, cpu=2) for _ in range(5)]
+        live = self.lease(60)
+        permanent = ResourceUsage.objects.create(cluster=self.cluster, used_cpu=1, used_ram=1, used_gpu=0)
+        for usage in expired:
+            self.expire(usage)
+        self.assertEqual(self.cluster.available_cpu, 4)
+        
+        out = StringIO()
+        call_command('sweep_leases', once=True, batch_size=2, stdout=out)
+        
+        self.assertIn('Reclaimed 5 leases (10 CPU', out.getvalue())
+        self.assertEqual(set(ResourceUsage.objects.values_list('id', flat=True)), {live.id, permanent.id})
+        self.assertEqual(self.cluster.available_cpu, 14)
+        self.assertEqual(OrganizationCapacity.objects.get(organization=self.organization).used_cpu, 2)
+
+@patch('core.throttling.deployment_publisher')
+@patch('core.views.deployment_publisher')
+class TestOrganizationQuotas(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(email='admin@example.com', username='admin', password='testpass123')
+        self.member = User.objects.create_user(email='member@example.com', username='member', password='testpass123')
+        self.organization = self.admin.create_organization('Acme')
+        self.other = self.member.create_organization('Other')
+        OrganizationMembership.objects.create(user=self.member, organization=self.organization)
+        self.cluster = Cluster.objects.create(name='Member', total_cpu=64, total_ram=64, total_gpu=4, owner=self.member)
+        OrganizationCapacity.objects.filter(organization=self.organization).update(quota_cpu=8)
+
+    def use(self, cpu):
+        self.client.force_authenticate(user=self.member)
+        return self.client.post(reverse('cluster-use-resources', args=[self.cluster.id]), {
+            'used_cpu': cpu, 'used_ram': 1, 'used_gpu': 0
+        }, format='json')
+
+    def test_allocation_refused_over_any_organization_quota(self, mock_publisher, mock_throttle_publisher):
+        self.assertEqual(self.use(6).status_code, status.HTTP_201_CREATED)
+        
+        response = self.use(3)
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("'Acme' CPU quota exceeded: 6 of 8 in use, 3 requested", response.data['error'])
+        self.assertEqual(ResourceUsage.objects.count(), 1)
+        # The organization within quota was rolled back as well.
+        self.assertEqual(OrganizationCapacity.objects.get(organization=self.other).used_cpu, 6)
+        self.assertEqual(self.use(2).status_code, status.HTTP_201_CREATED)
+
+    def test_deployment_refused_over_quota(self, mock_publisher, mock_throttle_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {}
+        self.client.force_authenticate(user=self.member)
+        
+        response = self.client.post(reverse('deployment-list'), {
+            'name': 'Big', 'cluster': self.cluster.id, 'docker_image': 'test/image:latest',
+            'required_cpu': 9, 'required_ram': 1, 'required_gpu': 0
+        }, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('quota exceeded', response.data['error'])
+        self.assertFalse(Deployment.objects.exists())
+        mock_publisher.publish_deployment.assert_not_called()
+
+    def test_quota_endpoint(self, mock_publisher, mock_throttle_publisher):
+        self.use(6)
+        url = reverse('organization-quota', args=[self.organization.id])
+        
+        response = self.client.get(url)
+        self.assertEqual(response.data['cpu'], {'used': 6, 'quota': 8, 'remaining': 2, 'utilization': 0.75})
+        self.assertIsNone(response.data['gpu']['quota'])
+        
+        self.assertEqual(self.client.patch(url, {'quota_gpu': 2}, format='json').status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.patch(url, {'quota_gpu': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['gpu']['remaining'], 2)
+        self.assertEqual(response.data['cpu']['quota'], 8)
+
+@patch('core.throttling.deployment_publisher')
+@patch('core.views.deployment_publisher')
+class TestIdempotencyKeys(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', username='testuser', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.cluster = Cluster.objects.create(name='Test Cluster', total_cpu=16, total_ram=16, total_gpu=0, owner=self.user)
+        self.deployment = {
+            'name': 'Retried', 'cluster': self.cluster.id, 'docker_image': 'test/image:latest',
+            'required_cpu': 1, 'required_ram': 1, 'required_gpu': 0
+        }
+
+    def post(self, url, data, key):
+        return self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_deployment_is_replayed(self, mock_publisher, mock_throttle_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {}
+        first = self.post(reverse('deployment-list'), self.deployment, 'create-1')
+        mock_throttle_publisher.queue_stats.return_value = {'depth': 10 ** 6, 'consumers': 1}
+        retry = self.post(reverse('deployment-list'), self.deployment, 'create-1')
+        
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Deployment.objects.count(), 1)
+        self.assertEqual(ResourceUsage.objects.count(), 1)
+        mock_publisher.publish_deployment.assert_called_once()
+        
+        response = self.post(reverse('deployment-list'), {**self.deployment, 'name': 'Other'}, 'create-1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_use_resources_in_flight_and_expired_keys(self, mock_publisher, mock_throttle_publisher):
+        url = reverse('cluster-use-resources', args=[self.cluster.id])
+        usage = {'used_cpu': 2, 'used_ram': 1, 'used_gpu': 0}
+        self.assertEqual(self.post(url, usage, 'use-1').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.post(url, usage, 'use-1').status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ResourceUsage.objects.count(), 1)
+        
+        IdempotencyRecord.objects.filter(key='use-1').update(status_code=None)
+        response = self.post(url, usage, 'use-1')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Retry-After'], '1')
+        
+        IdempotencyRecord.objects.filter(key='use-1').update(expires_at=timezone.now())
+        self.assertNotIn('Idempotent-Replayed', self.post(url, usage, 'use-1'))
+        self.assertEqual(ResourceUsage.objects.count(), 2)
+        
+        IdempotencyRecord.objects.update(expires_at=timezone.now())
+        out = StringIO()
+        call_command('purge_idempotency_keys', stdout=out)
+        self.assertIn('Purged 1', out.getvalue())
+
+    def test_abandoned_claims_lapse(self, mock_publisher, mock_throttle_publisher):
+        url = reverse('cluster-use-resources', args=[self.cluster.id])
+        usage = {'used_cpu': 2, 'used_ram': 1, 'used_gpu': 0}
+        self.post(url, usage, 'use-2')
+        record = IdempotencyRecord.objects.get(key='use-2')
+        self.assertGreater(record.expires_at, timezone.now() + timedelta(hours=23))
+        
+        # The worker holding the claim died before storing a response.
+        in_flight = timedelta(seconds=settings.IDEMPOTENCY['IN_FLIGHT_TTL'])
+        IdempotencyRecord.objects.filter(key='use-2').update(status_code=None, expires_at=timezone.now() + in_flight)
+        self.assertEqual(self.post(url, usage, 'use-2').status_code, status.HTTP_409_CONFLICT)
+        
+        with patch('django.utils.timezone.now', return_value=timezone.now() + in_flight):
+            response = self.post(url, usage, 'use-2')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(ResourceUsage.objects.count(), 2)
+
+    def test_unclaimable_key_is_not_run_unprotected(self, mock_publisher, mock_throttle_publisher):
+        url = reverse('cluster-use-resources', args=[self.cluster.id])
+        usage = {'used_cpu': 2, 'used_ram': 1, 'used_gpu': 0}
+        with patch('core.idempotency.claim', return_value=(None, False)):
+            response = self.post(url, usage, 'use-3')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(ResourceUsage.objects.exists())
+
+    def test_failed_validation_releases_key(self, mock_publisher, mock_throttle_publisher):
+        mock_throttle_publisher.queue_stats.return_value = {}
+        response = self.post(reverse('deployment-list'), {**self.deployment, 'cluster': None}, 'create-2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+@override_settings(ALLOCATION_THROTTLE={
+    'ENABLED': True,
+    'CACHE': 'default',
+    'CLUSTER': {'BURST': 2, 'RATE': 0.5},
+    'USER': {'BURST': 3, 'RATE': 0.5},
+})
+@patch('core.throttling.time')
+class TestAllocationRateThrottle(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', username='testuser', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        self.clusters = [
+            Cluster.objects.create(name=f'Cluster {i}', total_cpu=16, total_ram=16, total_gpu=0, owner=self.user)
+            for i in range(2)
+        ]
+        self.usage = {'used_cpu': 1, 'used_ram': 1, 'used_gpu': 0}
+
+    def use(self, cluster, usage=None, client=None, **headers):
+        url = reverse('cluster-use-resources', args=[cluster.id])
+        return (client or self.client).post(url, usage or self.usage, format='json', **headers)
+
+    def test_cluster_and_user_buckets(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        first, second = self.clusters
+        self.assertEqual(self.use(first).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.use(first).status_code, status.HTTP_201_CREATED)
+        
+        response = self.use(first)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '2')
+        
+        # That request still took the user's last token; the user bucket is
+        # checked before any query.
+        with CaptureQueriesContext(connection) as queries:
+            response = self.use(second)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(len(queries), 0)
+        
+        mock_time.time.return_value = 1002.0
+        self.assertEqual(self.use(first).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ResourceUsage.objects.count(), 3)
+
+    def test_other_users_cannot_drain_a_cluster(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        intruder = APIClient()
+        intruder.force_authenticate(user=User.objects.create_user(
+            email='other@example.com', username='other', password='testpass123'
+        ))
+        for _ in range(3):
+            self.assertEqual(self.use(self.clusters[0], client=intruder).status_code, status.HTTP_404_NOT_FOUND)
+        
+        self.assertEqual(self.use(self.clusters[0]).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.use(self.clusters[0]).status_code, status.HTTP_201_CREATED)
+
+    def test_refused_allocations_return_the_token(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        too_big = {'used_cpu': 100, 'used_ram': 1, 'used_gpu': 0}
+        self.assertEqual(self.use(self.clusters[0], too_big).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.use(self.clusters[0], too_big).status_code, status.HTTP_400_BAD_REQUEST)
+        mock_time.time.return_value = 1002.0
+        self.assertEqual(self.use(self.clusters[0]).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.use(self.clusters[0]).status_code, status.HTTP_201_CREATED)
+
+    def test_idempotent_replays_take_no_token(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.assertEqual(self.use(self.clusters[0], HTTP_IDEMPOTENCY_KEY='use-1').status_code, status.HTTP_201_CREATED)
+        for _ in range(3):
+            response = self.use(self.clusters[0], HTTP_IDEMPOTENCY_KEY='use-1')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.use(self.clusters[0]).status_code, status.HTTP_201_CREATED)
+
+    def test_replay_check_does_not_query(self, mock_time):
+        mock_time.time.return_value = 1000.0
+        self.use(self.clusters[0], HTTP_IDEMPOTENCY_KEY='use-1')
+        replay, fresh = (Request(APIRequestFactory().post('/', HTTP_IDEMPOTENCY_KEY=key)) for key in ('use-1', 'use-2'))
+        replay.user = fresh.user = self.user
+
+        with self.assertNumQueries(0):
+            self.assertTrue(will_replay(replay))
+            self.assertFalse(will_replay(fresh))
+
+    def test_warns_when_buckets_are_per_worker(self, mock_time):
+        self.assertEqual([w.id for w in allocation_throttle_cache(None)], ['core.W001'])
+        with override_settings(ALLOCATION_THROTTLE={**settings.ALLOCATION_THROTTLE, 'ENABLED': False}):
+            self.assertEqual(allocation_throttle_cache(None), [])
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('check', deploy=True, fail_level='WARNING', stdout=out, stderr=out)
+
+    @patch('core.throttling.DeploymentQueueThrottle.allow_request', return_value=True)
+    @patch('core.views.deployment_publisher')
+    def test_deployment_writes_share_the_cluster_bucket(self, mock_publisher, mock_allow, mock_time):
+        mock_time.time.return_value = 1000.0
+        cluster = self.clusters[0]
+        self.assertEqual(self.use(cluster).status_code, status.HTTP_201_CREATED)
+        response = self.client.post(reverse('deployment-list'), {
+            'name': 'Test', 'cluster': cluster.id, 'docker_image': 'test/image:latest',
+            'required_cpu': 1, 'required_ram': 1, 'required_gpu': 0
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.use(cluster).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        
+        usage = ResourceUsage.objects.first()
+        usage.lease_seconds = 60
+        usage.lease_expires_at = timezone.now() + timedelta(seconds=60)
+        usage.save()
+        response = self.client.post(reverse('resourceusage-heartbeat', args=[usage.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -0,0 +1,204 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.exceptions import Throttled
+from rest_framework.permissions import SAFE_METHODS
+from django_redis import get_redis_connection
+from django_redis.cache import RedisCache
+from rest_framework.throttling import BaseThrottle
+
+from .idempotency import will_replay
+from .transports import deployment_publisher
+
+logger = logging.getLogger(__name__)
+
+
+class DeploymentQueueThrottle(BaseThrottle):
+    """Rejects deployment writes with 429 while the consumer is behind.
+
+    The deployments queue is considered backed up when its depth reaches
+    ``QUEUE_DEPTH_LIMIT``, or ``STALLED_DEPTH_LIMIT`` while no consumer is
+    attached. Messages published then would likely sit until the 60s TTL
+    dead-letters them, so the client is told to retry later instead.
+    Writes at ``PRIORITY_THRESHOLD`` or above jump the queue on the broker,
+    so they are admitted up to the larger ``PRIORITY_DEPTH_LIMIT``.
+    """
+
+    def __init__(self):
+        self.retry_after = None
+
+    def allow_request(self, request, view):
+        if request.method in SAFE_METHODS:
+            return True
+        # A retry that will be answered from the stored response publishes
+        # nothing.
+        if will_replay(request):
+            return True
+        stats = deployment_publisher.queue_stats()
+        depth = stats.get('depth')
+        if depth is None:
+            return True
+        config = settings.DEPLOYMENT_BACKPRESSURE
+        limit = config['QUEUE_DEPTH_LIMIT']
+        if self.priority(request, view) >= config['PRIORITY_THRESHOLD']:
+            limit = config['PRIORITY_DEPTH_LIMIT']
+        if stats.get('consumers') == 0:
+            limit = min(limit, config['STALLED_DEPTH_LIMIT'])
+        if depth < limit:
+            return True
+        self.retry_after = min(
+            config['MAX_RETRY_AFTER'],
+            config['RETRY_AFTER'] * math.ceil((depth + 1) / max(limit, 1))
+        )
+        logger.warning(
+            f"Throttling deployment write: queue depth {depth} >= {limit} "
+            f"({stats.get('consumers')} consumers)"
+        )
+        return False
+
+    def priority(self, request, view):
+        try:
+            return int(request.data.get('priority', 1))
+        except (TypeError, ValueError, AttributeError):
+            return 1
+
+    def wait(self):
+        return self.retry_after
+
+
+# GCRA: a bucket is stored as the time (in microseconds) it will be full
+# again. Taking a token pushes that time on by one refill interval, and is
+# refused while it would end up more than BURST intervals ahead.
+TAKE_SCRIPT = """
+local now, interval, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local full_at = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now) + interval
+local wait = full_at - burst * interval - now
+if wait > 0 then
+    return wait
+end
+redis.call('SET', KEYS[1], string.format('%d', full_at), 'PX', string.format('%d', (full_at - now) / 1000 + 1000))
+return 0
+"""
+
+RETURN_SCRIPT = """
+local full_at = tonumber(redis.call('GET', KEYS[1]))
+if full_at then
+    redis.call('SET', KEYS[1], string.format('%d', full_at - tonumber(ARGV[1])), 'KEEPTTL')
+end
+return 0
+"""
+
+scripts = {}
+bucket_lock = threading.Lock()
+
+
+def run_script(cache, source, key, *args):
+    key = cache.make_and_validate_key(key)
+    client = get_redis_connection(settings.ALLOCATION_THROTTLE['CACHE'])
+    if source not in scripts:
+        scripts[source] = client.register_script(source)
+    return scripts[source](keys=[key], args=args, client=client)
+
+
+def take_token(key, rate):
+    """Take a token from the bucket ``key``.
+
+    Returns 0, or the seconds until a token is available. On Redis
+    (django-redis) this is a single atomic script. Other backends are
+    updated under a process-wide lock: with LocMemCache every worker keeps
+    its own buckets, so the limits only hold per worker, and other shared
+    backends (e.g. memcached) are approximate across processes. The
+    ``core.W001`` deploy check warns about this.
+    """
+    cache = caches[settings.ALLOCATION_THROTTLE['CACHE']]
+    now = int(time.time() * 1e6)
+    interval = int(1e6 / rate['RATE'])
+    if isinstance(cache, RedisCache):
+        return int(run_script(cache, TAKE_SCRIPT, key, now, interval, rate['BURST'])) / 1e6
+    with bucket_lock:
+        full_at = max(cache.get(key, now), now) + interval
+        wait = full_at - rate['BURST'] * interval - now
+        if wait > 0:
+            return wait / 1e6
+        cache.set(key, full_at, math.ceil((full_at - now) / 1e6) + 1)
+        return 0
+
+
+def return_token(key, rate):
+    """Put back a token taken by ``take_token`` for a request that was refused."""
+    cache = caches[settings.ALLOCATION_THROTTLE['CACHE']]
+    interval = int(1e6 / rate['RATE'])
+    if isinstance(cache, RedisCache):
+        run_script(cache, RETURN_SCRIPT, key, interval)
+        return
+    with bucket_lock:
+        full_at = cache.get(key)
+        if full_at is not None:
+            cache.set(key, full_at - interval, math.ceil((full_at - interval) / 1e6 - time.time()) + 1)
+
+
+class AllocationRateThrottle(BaseThrottle):
+    """Per-user token bucket for allocation writes.
+
+    Each user's bucket holds up to ``USER['BURST']`` requests and refills at
+    ``USER['RATE']`` per second (``ALLOCATION_THROTTLE`` in settings). A write
+    with an empty bucket is refused with 429 and ``Retry-After``. The check
+    never touches the database: a retry carrying an ``Idempotency-Key`` whose
+    response is stored is recognised by its cache marker and let through
+    without taking a token. The per-cluster bucket is taken by the views with
+    ``cluster_admission``, once the cluster is known to be the requester's.
+    """
+
+    def __init__(self):
+        self.retry_after = None
+
+    def allow_request(self, request, view):
+        config = settings.ALLOCATION_THROTTLE
+        if not config['ENABLED'] or request.method not in ('POST', 'PUT', 'PATCH'):
+            return True
+        if not request.user.is_authenticated:
+            return True
+        if will_replay(request):
+            return True
+        key = f"throttle:user:{request.user.pk}"
+        wait = take_token(key, config['USER'])
+        if wait:
+            self.retry_after = wait
+            logger.warning(f"Throttling allocation: {key} empty for {wait:.2f}s")
+            return False
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+@contextmanager
+def cluster_admission(request, cluster):
+    """Take a token from ``cluster``'s allocation bucket around an allocation.
+
+    Raises ``Throttled`` (429 with ``Retry-After``) when the bucket is empty.
+    Call it after the cluster has been checked to belong to the requester
+    and the request has been validated, so other users cannot drain the
+    bucket and invalid requests cost nothing. The token is put back if the
+    allocation raises, e.g. because it does not fit. Clusters owned by
+    someone else are not limited here; the user bucket still applies.
+    """
+    config = settings.ALLOCATION_THROTTLE
+    if not config['ENABLED'] or cluster.owner_id != request.user.pk:
+        yield
+        return
+    key = f"throttle:cluster:{cluster.pk}"
+    wait = take_token(key, config['CLUSTER'])
+    if wait:
+        logger.warning(f"Throttling allocation: {key} empty for {wait:.2f}s")
+        raise Throttled(wait=wait)
+    try:
+        yield
+    except Exception:
+        return_token(key, config['CLUSTER'])
+        raise
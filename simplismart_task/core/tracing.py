@@ -0,0 +1,147 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from common.tracing import parse_traceparent
+
+SERVICE = 'django'
+
+current = contextvars.ContextVar('current_span', default=None)
+export_lock = threading.Lock()
+
+
+def new_id(size):
+    return os.urandom(size).hex()
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, sampled, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.events = []
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, **attributes):
+        self.events.append({'name': name, 'time': time.time(), 'attributes': attributes})
+
+    def finish(self):
+        self.end = time.time()
+        if self.sampled:
+            export(self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'service': SERVICE,
+            'start': self.start,
+            'end': self.end,
+            'duration_ms': round((self.end - self.start) * 1000, 3),
+            'attributes': self.attributes,
+            'events': self.events,
+        }
+
+
+def export(span):
+    # One append per span keeps lines whole across gunicorn workers sharing
+    # the file.
+    line = json.dumps(span.to_dict(), default=str) + '\n'
+    with export_lock, open(settings.TRACING['EXPORT_PATH'], 'a') as f:
+        f.write(line)
+
+
+@contextmanager
+def start_span(name, traceparent=None, **attributes):
+    """Open a span under the current one, or continue ``traceparent``.
+
+    Yields ``None`` when tracing is disabled so callers can skip work.
+    """
+    if not settings.TRACING['ENABLED']:
+        yield None
+        return
+    parent = current.get()
+    if parent is not None:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        trace_id, parent_id, sampled = parse_traceparent(traceparent) or (
+            new_id(16), None, random.random() < settings.TRACING['SAMPLE_RATE']
+        )
+    span = Span(name, trace_id, parent_id, sampled, attributes)
+    token = current.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.set_attribute('error', repr(e))
+        raise
+    finally:
+        current.reset(token)
+        span.finish()
+
+
+def current_span():
+    return current.get()
+
+
+def add_event(name, **attributes):
+    span = current.get()
+    if span is not None:
+        span.add_event(name, **attributes)
+
+
+def load_traces(paths):
+    """Group exported spans from any number of services by trace id."""
+    traces = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    span = json.loads(line)
+                    traces.setdefault(span['trace_id'], []).append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda span: span['start'])
+    return traces
+
+
+def breakdown(spans):
+    """Summarise one trace as offsets and durations from its first span."""
+    started = min(span['start'] for span in spans)
+    ended = max(span['end'] for span in spans)
+    deployment_ids = {
+        span['attributes']['deployment_id'] for span in spans
+        if span['attributes'].get('deployment_id') is not None
+    }
+    return {
+        'trace_id': spans[0]['trace_id'],
+        'deployment_ids': sorted(deployment_ids),
+        'total_ms': round((ended - started) * 1000, 3),
+        'spans': [
+            {
+                'name': span['name'],
+                'service': span['service'],
+                'offset_ms': round((span['start'] - started) * 1000, 3),
+                'duration_ms': span['duration_ms'],
+                'events': [event['name'] for event in span.get('events', [])],
+            }
+            for span in spans
+        ],
+    }
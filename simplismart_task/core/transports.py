@@ -0,0 +1,110 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+from common.frames import encode_frame, read_frame
+
+from .rabbitmq import DeploymentPublisher, RabbitMQPublisher, deployment_message
+
+logger = logging.getLogger(__name__)
+
+
+class UnixSocketPublisher(DeploymentPublisher):
+    """Hands deployments straight to a consumer on the same host.
+
+    Each deployment is written to the consumer's Unix socket as one
+    length-prefixed JSON frame with the routing key, priority and headers
+    the AMQP publisher would have used, so the consumer applies it the same
+    way. There is no broker in between: nothing is persisted, and a publish
+    fails if the consumer is not listening.
+    """
+
+    transport = 'unix'
+
+    def __init__(self, path, timeout=5):
+        super().__init__()
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+    def request(self, message, reply=False):
+        # One reconnect per call covers a consumer restart between requests.
+        with self.lock:
+            if self.pid != os.getpid():
+                # Never share a socket with the process we were forked from.
+                self.sock = None
+                self.pid = os.getpid()
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(encode_frame(message))
+                    if not reply:
+                        return None
+                    response = read_frame(self.sock)
+                    if response is None:
+                        raise ConnectionError("Consumer closed the connection")
+                    return response
+                except OSError as e:
+                    self.close_socket()
+                    if attempt:
+                        raise
+                    self.record_retry(attempt + 1, e)
+
+    def send_deployment(self, deployment_data):
+        message = deployment_message(deployment_data, self.shards)
+        message['type'] = 'publish'
+        try:
+            self.request(message)
+        except OSError as e:
+            logger.error(f"Error publishing to {self.path}: {str(e)}")
+            return False
+        logger.info(f"Successfully published deployment: {deployment_data.get('id')}")
+        return True
+
+    def sample_queue_stats(self):
+        try:
+            shards = self.request({'type': 'stats'}, reply=True)['shards']
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Failed to sample deployments queue: {str(e)}")
+            return None
+        return {
+            'depth': max(shard['depth'] for shard in shards),
+            'consumers': min(shard['consumers'] for shard in shards),
+            'shards': shards,
+            'sampled_at': time.time(),
+        }
+
+    def close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def close(self):
+        with self.lock:
+            self.close_socket()
+
+
+def create_publisher():
+    transport = settings.DEPLOYMENT_TRANSPORT
+    if transport['BACKEND'] == 'unix':
+        return UnixSocketPublisher(transport['SOCKET_PATH'])
+    return RabbitMQPublisher()
+
+
+deployment_publisher = create_publisher()
@@ -1,11 +1,14 @@
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.conf import settings
+from django.db import transaction
 from django.contrib.auth import get_user_model
-from .models import Cluster, ResourceUsage, Deployment, Organization, OrganizationMembership
+from .models import Cluster, ResourceUsage, Deployment, Organization, OrganizationMembership, OrganizationCapacity
 from .serializers import (
     UserSerializer,
     ClusterSerializer,
@@ -16,10 +19,17 @@ from .serializers import (
     DeploymentCreateSerializer,
     OrganizationSerializer,
     OrganizationCreateSerializer,
+    OrganizationCapacitySerializer,
+    OrganizationQuotaSerializer,
     OrganizationInviteSerializer
 )
 from rest_framework.views import APIView
-from .rabbitmq import rabbitmq_publisher
+from .analytics import capacity_report
+from .deployments import stop_deployments
+from .idempotency import idempotent
+from .leases import renew_lease
+from .transports import deployment_publisher
+from .throttling import AllocationRateThrottle, DeploymentQueueThrottle, cluster_admission
 
 User = get_user_model()
 
@@ -90,6 +100,9 @@ class ClusterViewSet(viewsets.ModelViewSet):
         return ClusterSerializer
 
     def get_queryset(self):
+        # The prebuilt OpenAPI schema is generated without a request.
+        if getattr(self, 'swagger_fake_view', False):
+            return self.queryset.none()
         return self.queryset.filter(owner=self.request.user)
 
     def perform_create(self, serializer):
@@ -111,14 +124,37 @@ class ClusterViewSet(viewsets.ModelViewSet):
             ).data
         })
 
-    @action(detail=True, methods=['post'])
+    @action(detail=False, methods=['get'])
+    def analytics(self, request):
+        config = settings.CAPACITY_ANALYTICS
+        clusters = self.get_queryset()
+        try:
+            days = int(request.query_params.get('days', config['DEFAULT_DAYS']))
+            if request.query_params.get('clusters'):
+                cluster_ids = [int(cluster_id) for cluster_id in request.query_params['clusters'].split(',')]
+                clusters = clusters.filter(id__in=cluster_ids)
+        except ValueError:
+            return Response({'error': "'days' and 'clusters' must be integers"},
+                         status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= days <= config['MAX_DAYS']:
+            return Response({'error': f"'days' must be between 1 and {config['MAX_DAYS']}"},
+                         status=status.HTTP_400_BAD_REQUEST)
+        try:
+            return Response(capacity_report(list(clusters), days))
+        except TimeoutError:
+            return Response({'error': 'Capacity report timed out, try fewer clusters or days'},
+                         status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @action(detail=True, methods=['post'], throttle_classes=[AllocationRateThrottle])
+    @idempotent
     def use_resources(self, request, pk=None):
         cluster = self.get_object()
         serializer = ResourceUsageCreateSerializer(data=request.data)
         
         if serializer.is_valid():
             try:
-                usage = serializer.save(cluster=cluster)
+                with cluster_admission(request, cluster):
+                    usage = serializer.save(cluster=cluster)
                 return Response(ResourceUsageSerializer(usage).data, 
                              status=status.HTTP_201_CREATED)
             except ValueError as e:
@@ -128,6 +164,7 @@ class ClusterViewSet(viewsets.ModelViewSet):
 
 class ResourceUsageViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
+    throttle_classes = [AllocationRateThrottle]
     queryset = ResourceUsage.objects.all()
 
     def get_serializer_class(self):
@@ -136,10 +173,34 @@ class ResourceUsageViewSet(viewsets.ModelViewSet):
         return ResourceUsageSerializer
 
     def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return self.queryset.none()
         return self.queryset.filter(cluster__owner=self.request.user)
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        with cluster_admission(self.request, serializer.instance.cluster):
+            serializer.save()
+
+    # Renewing a lease allocates nothing new.
+    @action(detail=True, methods=['post'], throttle_classes=[])
+    def heartbeat(self, request, pk=None):
+        usage = self.get_object()
+        if usage.lease_seconds is None:
+            return Response({'error': 'This resource usage is not leased'},
+                         status=status.HTTP_400_BAD_REQUEST)
+        expires_at = renew_lease(usage)
+        if expires_at is None:
+            return Response({'error': 'Lease has expired and its resources are being reclaimed'},
+                         status=status.HTTP_410_GONE)
+        return Response({'id': usage.id, 'lease_expires_at': expires_at})
+
 class DeploymentViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
+    throttle_classes = [AllocationRateThrottle, DeploymentQueueThrottle]
     queryset = Deployment.objects.all()
 
     def get_serializer_class(self):
@@ -148,42 +209,68 @@ class DeploymentViewSet(viewsets.ModelViewSet):
         return DeploymentSerializer
 
     def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return self.queryset.none()
         return self.queryset.filter(cluster__owner=self.request.user)
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
     def perform_create(self, serializer):
-        deployment = serializer.save()
-        
-        ResourceUsage.objects.create(
-            cluster=deployment.cluster,
-            used_cpu=deployment.required_cpu,
-            used_ram=deployment.required_ram,
-            used_gpu=deployment.required_gpu
-        )
+        try:
+            with cluster_admission(self.request, serializer.validated_data['cluster']), transaction.atomic():
+                deployment = serializer.save()
+                
+                ResourceUsage.objects.create(
+                    cluster=deployment.cluster,
+                    deployment=deployment,
+                    used_cpu=deployment.required_cpu,
+                    used_ram=deployment.required_ram,
+                    used_gpu=deployment.required_gpu
+                )
+        except ValueError as e:
+            raise ValidationError({'error': str(e)})
         
         deployment_data = DeploymentSerializer(deployment).data
-        rabbitmq_publisher.publish_deployment(deployment_data)
+        deployment_publisher.publish_deployment(deployment_data)
 
     def perform_update(self, serializer):
         old_deployment = self.get_object()
-        new_deployment = serializer.save()
-        
-        if (old_deployment.required_cpu != new_deployment.required_cpu or
-            old_deployment.required_ram != new_deployment.required_ram or
-            old_deployment.required_gpu != new_deployment.required_gpu):
-            
-            resource_usage = ResourceUsage.objects.get(
-                cluster=new_deployment.cluster,
-                used_cpu=old_deployment.required_cpu,
-                used_ram=old_deployment.required_ram,
-                used_gpu=old_deployment.required_gpu
-            )
-            resource_usage.used_cpu = new_deployment.required_cpu
-            resource_usage.used_ram = new_deployment.required_ram
-            resource_usage.used_gpu = new_deployment.required_gpu
-            resource_usage.save()
+        cluster = serializer.validated_data.get('cluster', old_deployment.cluster)
+        try:
+            with cluster_admission(self.request, cluster), transaction.atomic():
+                new_deployment = serializer.save()
+                
+                if (old_deployment.required_cpu != new_deployment.required_cpu or
+                    old_deployment.required_ram != new_deployment.required_ram or
+                    old_deployment.required_gpu != new_deployment.required_gpu):
+                    
+                    resource_usage = new_deployment.resource_usages.first() or ResourceUsage.objects.get(
+                        cluster=new_deployment.cluster,
+                        used_cpu=old_deployment.required_cpu,
+                        used_ram=old_deployment.required_ram,
+                        used_gpu=old_deployment.required_gpu
+                    )
+                    resource_usage.used_cpu = new_deployment.required_cpu
+                    resource_usage.used_ram = new_deployment.required_ram
+                    resource_usage.used_gpu = new_deployment.required_gpu
+                    resource_usage.save()
+        except ValueError as e:
+            raise ValidationError({'error': str(e)})
         
         deployment_data = DeploymentSerializer(new_deployment).data
-        rabbitmq_publisher.publish_deployment(deployment_data)
+        deployment_publisher.publish_deployment(deployment_data)
+
+    # Not throttled: stopping frees capacity, and is what an operator reaches
+    # for while the queue is backed up.
+    @action(detail=False, methods=['post'], throttle_classes=[])
+    def bulk_stop(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not all(isinstance(deployment_id, int) for deployment_id in ids):
+            return Response({'error': "'ids' must be a list of deployment ids"},
+                         status=status.HTTP_400_BAD_REQUEST)
+        return Response(stop_deployments(self.get_queryset().filter(id__in=ids)))
 
 class OrganizationViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
@@ -195,6 +282,8 @@ class OrganizationViewSet(viewsets.ModelViewSet):
         return OrganizationSerializer
 
     def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return self.queryset.none()
         return self.queryset.filter(members=self.request.user)
 
     def perform_create(self, serializer):
@@ -215,6 +304,30 @@ class OrganizationViewSet(viewsets.ModelViewSet):
         
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
 
+    def get_capacity(self):
+        organization = self.get_object()
+        capacity, created = OrganizationCapacity.objects.get_or_create(organization=organization)
+        if created:
+            capacity.rebuild()
+        return capacity
+
+    @action(detail=True, methods=['get'])
+    def capacity(self, request, pk=None):
+        return Response(OrganizationCapacitySerializer(self.get_capacity()).data)
+
+    @action(detail=True, methods=['get', 'put', 'patch'])
+    def quota(self, request, pk=None):
+        capacity = self.get_capacity()
+        if request.method == 'GET':
+            return Response(OrganizationQuotaSerializer(capacity).data)
+        if not request.user.is_admin_of(capacity.organization):
+            return Response({'error': 'Only organization admins can change quotas'},
+                         status=status.HTTP_403_FORBIDDEN)
+        serializer = OrganizationQuotaSerializer(capacity, data=request.data, partial=request.method == 'PATCH')
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data)
+
 class GenerateInviteCodeView(APIView):
     permission_classes = [IsAuthenticated]
 
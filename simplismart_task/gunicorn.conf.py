@@ -0,0 +1,35 @@
+import os
+import shutil
+import subprocess
+import sys
+
+# Every worker records Prometheus samples into this directory so /metrics can
+# aggregate across the whole pool. It must be set before the app is imported.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/simplismart-prometheus')
+
+
+def on_starting(server):
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    # The image ships the OpenAPI schema, but a bind-mounted checkout (as in
+    # docker-compose) hides it or has newer code. Rebuild it before any
+    # worker serves it, in a child process so the arbiter never sets Django up.
+    subprocess.run(
+        [sys.executable, 'manage.py', 'build_openapi', '--if-stale'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True
+    )
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # Connect to the broker while the worker waits for its first request
+    # rather than inside it. Nothing is connected before the fork, so this is
+    # also safe with preload_app.
+    from core.transports import deployment_publisher
+    deployment_publisher.connect_in_background()
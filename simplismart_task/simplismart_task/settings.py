@@ -1,10 +1,16 @@
 
 
+import os
+import sys
 from pathlib import Path
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# The `common` package shared with the consumer sits next to this project in
+# a checkout; images copy it into BASE_DIR instead.
+sys.path.append(str(BASE_DIR.parent))
+
 
 SECRET_KEY = "django-insecure-%5qkbp2up_1=xjo-d98ey6-qx0&&+jy&hx_czj#%w1#ky1e088"
 
@@ -27,6 +33,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.middleware.MetricsMiddleware",
+    "core.middleware.SQLInspectorMiddleware",
+    "core.middleware.TracingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -63,6 +72,24 @@ DATABASES = {
     }
 }
 
+# Throttle buckets and the queue depth sample must be shared by all gunicorn
+# workers, so use Redis (django-redis) when REDIS_URL is set (docker-compose
+# sets it). The in-process fallback only holds limits per worker;
+# `manage.py check --deploy` warns about it (core.W001).
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -120,8 +147,119 @@ SWAGGER_SETTINGS = {
         }
     },
     'USE_SESSION_AUTH': False,
+    # The UIs load the prebuilt schema instead of generating it per page view.
+    'SPEC_URL': 'schema-json',
 }
 
 REDOC_SETTINGS = {
     'LAZY_RENDERING': True,
+    'SPEC_URL': 'schema-json',
+}
+
+# Built with `manage.py build_openapi` as schema-<fingerprint>.{json,yaml}
+# (in the Docker build, and by gunicorn's on_starting when the code changed);
+# the fingerprint covers the project's source. Requests only read the
+# artifact the `current` manifest names.
+OPENAPI_SCHEMA = {
+    'DIR': BASE_DIR / 'openapi',
+    'MAX_AGE': 3600,
+}
+
+# GET /api/clusters/analytics/. Reports are computed in a pool of WORKERS
+# processes (0 computes in the request) over GRID_POINTS samples per cluster.
+CAPACITY_ANALYTICS = {
+    'WORKERS': 2,
+    'GRID_POINTS': 720,
+    'DEFAULT_DAYS': 30,
+    'MAX_DAYS': 365,
+    'CHUNK_SIZE': 10000,
+    'TIMEOUT': 30,
+    'CACHE_TTL': 60,
+}
+
+# Optional TTL leases on resource usage (`ttl` on use_resources). Expired
+# leases are reclaimed by `manage.py sweep_leases`.
+RESOURCE_LEASES = {
+    'MIN_TTL': 10,
+    'MAX_TTL': 86400,
+    'SWEEP_BATCH_SIZE': 1000,
+    'SWEEP_INTERVAL': 15,
+}
+
+# First responses to POSTs sent with an Idempotency-Key are replayed to
+# retries for TTL seconds. A key claimed by a request that never stores its
+# response (the worker died) is freed after IN_FLIGHT_TTL seconds; keep it
+# at least the gunicorn worker timeout.
+IDEMPOTENCY = {
+    'TTL': 86400,
+    'IN_FLIGHT_TTL': 30,
+}
+
+DEPLOYMENT_SHARDS = 1
+
+# 'amqp' publishes through RabbitMQ; 'unix' writes straight to a consumer on
+# the same host listening on SOCKET_PATH (DEPLOYMENT_TRANSPORT=unix there).
+DEPLOYMENT_TRANSPORT = {
+    'BACKEND': 'amqp',
+    'SOCKET_PATH': '/tmp/simplismart-deployments.sock',
+}
+
+# Token buckets for allocation writes (use_resources, resource usage and
+# deployment writes), one per cluster and one per user: up to BURST requests
+# at once, refilled at RATE per second. Kept in the CACHE cache, which must be
+# shared by all workers (see CACHES) for the limits to hold across the pool.
+ALLOCATION_THROTTLE = {
+    'ENABLED': True,
+    'CACHE': 'default',
+    'CLUSTER': {'BURST': 20, 'RATE': 5},
+    'USER': {'BURST': 50, 'RATE': 10},
+}
+
+DEPLOYMENT_BACKPRESSURE = {
+    'QUEUE_DEPTH_LIMIT': 5000,
+    'STALLED_DEPTH_LIMIT': 100,
+    'PRIORITY_THRESHOLD': 2,
+    'PRIORITY_DEPTH_LIMIT': 20000,
+    'SAMPLE_TTL': 2,
+    'RETRY_AFTER': 5,
+    'MAX_RETRY_AFTER': 60,
+}
+
+# Per-request SQL breakdown (X-DB-Queries / X-DB-Time headers plus a log of
+# slow and N+1-looking requests). Off by default; it keeps every statement.
+SQL_INSTRUMENTATION = {
+    'ENABLED': False,
+    'SLOW_REQUEST_MS': 500,
+    'REPEAT_THRESHOLD': 5,
+    'MAX_PATTERNS': 20,
+}
+
+# Request -> publish spans, continued by the consumer through the
+# traceparent message header. Spans are appended as JSON lines to
+# EXPORT_PATH; combine them with the consumer's using `manage.py trace_report`.
+TRACING = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 1.0,
+    'EXPORT_PATH': BASE_DIR / 'traces.jsonl',
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'sql_file': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': BASE_DIR / 'sql_requests.log',
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'core.sql': {
+            'handlers': ['sql_file'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
 }
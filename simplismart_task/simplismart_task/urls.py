@@ -2,18 +2,12 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.documentation import include_docs_urls
 from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
 from rest_framework import permissions
+from core.metrics import metrics_view
+from core.openapi import API_INFO, schema_json, schema_yaml
 
 schema_view = get_schema_view(
-    openapi.Info(
-        title="SimpliSmart API",
-        default_version='v1',
-        description="API for SimpliSmart Task Management",
-        terms_of_service="https://www.google.com/policies/terms/",
-        contact=openapi.Contact(email="contact@simplismart.local"),
-        license=openapi.License(name="BSD License"),
-    ),
+    API_INFO,
     public=True,
     permission_classes=(permissions.AllowAny,),
 )
@@ -27,12 +21,16 @@ def api_root(request):
             "clusters": "/api/clusters/",
             "resource-usage": "/api/resource-usage/",
             "documentation": "/api/docs/",
+            "schema": "/api/schema.json",
         }
     }
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('core.urls')),
-    path('api/docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    path('api/redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('api/schema.json', schema_json, name='schema-json'),
+    path('api/schema.yaml', schema_yaml, name='schema-yaml'),
+    path('api/docs/', schema_view.with_ui('swagger', cache_timeout=3600), name='schema-swagger-ui'),
+    path('api/redoc/', schema_view.with_ui('redoc', cache_timeout=3600), name='schema-redoc'),
+    path('metrics', metrics_view, name='metrics'),
 ]